@@ -19,16 +19,24 @@
 ##    along with daedalus; see the file LICENSE.txt.
 ##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+import atexit
 import calendar
+import collections
+import errno
 import httplib
 import json
 import logging
 import math
 import optparse
+import os
+import socket
 import sys
+import threading
 import time
 import traceback
 import urllib
+import weakref
+import zlib
 
 
 ERROR = 'ERROR'
@@ -36,6 +44,22 @@ WARN = 'WARN'
 INFO = 'INFO'
 DEBUG = 'DEBUG'
 
+# What BufferedDaedalusClient does with new messages when the queue is full
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_BLOCK = 'block'
+
+# How DaedalusClient chooses the server for each request
+LB_ROUND_ROBIN = 'round-robin'
+LB_LEAST_OUTSTANDING = 'least-outstanding'
+
+# Compression of the body of the requests (the value of the header 'Content-Encoding')
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_DEFLATE = 'deflate'
+
+# Errors of sockets closed by the server (ex: idle keep-alive connections)
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, )
+
 
 #===============================================================================
 # This should be the same of `daedalus.utils.utc_now_from_epoch()`
@@ -133,6 +157,157 @@ class DaedalusException(Exception):
     pass
 
 
+def _is_stale_connection_error(error):
+    """
+    Returns True if `error` (raised while sending a request, or reading the status
+    line of the response) means the connection was closed by the server before
+    receiving the request, so it's safe to send the request again.
+    Timeouts are not considered stale connection errors.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return isinstance(error, socket.error) and error.errno in STALE_CONNECTION_ERRNOS
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps up to `max_idle` idle keep-alive connections to the server, to be
+    reused by the next requests. This pool never blocks: if there isn't an idle
+    connection, a new one is created (so it could be shared between threads).
+    """
+
+    def __init__(self, server_host, server_port, max_idle=1):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self, timeout=None):
+        """
+        Returns a tuple (connection, reused). `reused` is True if the connection
+        was used before, so could have been closed by the server.
+        The socket operations of the connection will timeout after `timeout` seconds.
+        """
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            return httplib.HTTPConnection(host=self.server_host, port=self.server_port,
+                timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def put(self, conn):
+        """
+        Returns a connection to the pool (or closes it, if there are too many idle connections).
+        """
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Closes all the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class DaedalusServer(object):
+    """
+    A Daedalus server used by DaedalusClient, with its connections, the count of
+    outstanding requests and the state of its circuit breaker: after `failure_threshold`
+    consecutive failures the server is ejected for `retry_timeout` seconds. Then a
+    single request is allowed: if it works the server is used again, else is ejected again.
+    """
+
+    def __init__(self, server_host, server_port, max_idle=1, failure_threshold=3, retry_timeout=30.0):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.failure_threshold = failure_threshold
+        self.retry_timeout = retry_timeout
+        self.connections = HTTPConnectionPool(server_host, server_port, max_idle=max_idle)
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "DaedalusServer({0}:{1})".format(self.server_host, self.server_port)
+
+    def is_available(self):
+        """
+        Returns True if the server isn't ejected (or its `retry_timeout` expired).
+        """
+        with self._lock:
+            return self.ejected_until is None or time.time() >= self.ejected_until
+
+    def acquire(self):
+        """
+        Must be called before sending a request to the server. Returns False if the
+        server is ejected (the request must not be sent). If the `retry_timeout` of an
+        ejected server expired, the server is ejected again until the result of this
+        request is recorded, so only one request is sent.
+        """
+        with self._lock:
+            if self.ejected_until is not None:
+                if time.time() < self.ejected_until:
+                    return False
+                self.ejected_until = time.time() + self.retry_timeout
+            self.outstanding += 1
+            return True
+
+    def release(self, success):
+        """
+        Must be called after the request to the server, with its result.
+        Returns True if the server was ejected because of this failure.
+        """
+        with self._lock:
+            self.outstanding -= 1
+            if success:
+                self.consecutive_failures = 0
+                self.ejected_until = None
+                return False
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.ejected_until = time.time() + self.retry_timeout
+                return True
+            return False
+
+    def close(self):
+        self.connections.close()
+
+
+def _parse_servers(servers, default_port):
+    """
+    Returns a list of tuples (host, port) from `servers`: a list of strings 'host:port'
+    (the port is optional) or tuples (host, port), or a string with them separated by commas.
+    """
+    if isinstance(servers, basestring):
+        servers = [server for server in servers.split(',') if server.strip()]
+    parsed = []
+    for server in servers:
+        if isinstance(server, basestring):
+            server = server.strip()
+            if ':' in server:
+                host, port = server.rsplit(':', 1)
+                server = (host, int(port))
+            else:
+                server = (server, int(default_port))
+        parsed.append((server[0], int(server[1])))
+    if not parsed:
+        raise(DaedalusException("No server specified"))
+    return parsed
+
+
 class DaedalusClient(object):
     """
     Creates an instance of a client to send messages to Daedalus.
@@ -145,18 +320,61 @@ class DaedalusClient(object):
     - log_client_errors: if True, the detected errors are logged.
     - raise_client_exceptions: if True, raises Exception when a error is detected.
     - custom_logger: custom logger to use instead of Python's `logging` framework.
+    - keep_alive: if True, the connections are reused (if the server supports keep-alive).
+    - max_idle_connections: how many idle connections to keep (useful if the client
+      is shared between threads).
+    - servers: to use many servers, list of 'host:port' or (host, port) (or a string with
+      them separated by commas). If used, `server_host` and `server_port` are ignored.
+    - load_balancing: how to choose the server of each request: LB_ROUND_ROBIN (default)
+      or LB_LEAST_OUTSTANDING (the server with less requests in progress).
+    - timeout: timeout (in seconds) of the socket operations (default: no timeout).
+    - latency_budget: if a server fails (or returns a 5xx status), the request is sent to
+      other server, while the time since the first attempt is less than this number of
+      seconds (default: try each server once). The timeout of each attempt is limited to
+      the remaining time. A message could be saved twice if a server fails after saving it.
+    - failure_threshold, retry_timeout: after `failure_threshold` consecutive failures,
+      the server isn't used for `retry_timeout` seconds (see DaedalusServer).
+    - compression: to compress the body of the requests: COMPRESSION_GZIP or
+      COMPRESSION_DEFLATE (default: None, the body isn't compressed).
+    - compression_min_size: only bodies of this number of bytes (or more) are compressed.
     """
     def __init__(self, server_host="127.0.0.1", server_port=64364,
         default_message_host=None, default_message_application=None,
         log_client_errors=True, raise_client_exceptions=False,
-        custom_logger=None):
-        self.server_host = server_host
-        self.server_port = server_port
+        custom_logger=None, keep_alive=True, max_idle_connections=1,
+        servers=None, load_balancing=LB_ROUND_ROBIN, timeout=None, latency_budget=None,
+        failure_threshold=3, retry_timeout=30.0, compression=None, compression_min_size=1024):
+        if servers is None:
+            servers = [(server_host, server_port)]
+        if load_balancing not in (LB_ROUND_ROBIN, LB_LEAST_OUTSTANDING):
+            raise(DaedalusException("Invalid load balancing: '{0}'".format(load_balancing)))
+        if compression not in (None, COMPRESSION_GZIP, COMPRESSION_DEFLATE):
+            raise(DaedalusException("Invalid compression: '{0}'".format(compression)))
+        self._servers = [DaedalusServer(host, port, max_idle=max_idle_connections,
+                failure_threshold=failure_threshold, retry_timeout=retry_timeout)
+            for host, port in _parse_servers(servers, server_port)]
+        self.server_host = self._servers[0].server_host
+        self.server_port = self._servers[0].server_port
         self.default_message_host = default_message_host
         self.default_message_application = default_message_application
         self.log_client_errors = log_client_errors
         self.raise_client_exceptions = raise_client_exceptions
+        self.keep_alive = keep_alive
+        self.load_balancing = load_balancing
+        self.timeout = timeout
+        self.latency_budget = latency_budget
+        self.compression = compression
+        self.compression_min_size = compression_min_size
         self._logger = _createCustomLogger(custom_logger)
+        self._next_server = 0
+        self._servers_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes the idle keep-alive connections.
+        """
+        for server in self._servers:
+            server.close()
 
     def send_message(self, message, severity=None, host=None, application=None):
         """
@@ -171,50 +389,411 @@ class DaedalusClient(object):
                 raise
             return False
 
-    def _send_message(self, message, severity='INFO', host=None, application=None):
+    def _build_message(self, message, severity='INFO', host=None, application=None):
+        """
+        Returns the dict to send to the server, using the current time as timestamp.
+        """
         timestamp = utc_str_timestamp()
         host = host or self.default_message_host or ''
         host = host.strip()
         application = application or self.default_message_application or ''
         application = application.strip()
-        msg_dict = {
+        return {
             'application': application,
             'host': host,
             'severity': severity,
             'timestamp': timestamp,
             'message': message,
         }
+
+    def _send_message(self, message, severity='INFO', host=None, application=None):
+        msg_dict = self._build_message(message, severity, host, application)
         params = urllib.urlencode(msg_dict)
-        conn = None
+        status, reason, response_data = self._post("/backend/save/", params,
+            {"Content-type": "application/x-www-form-urlencoded"})
+        if status == 201: # response.status == 201
+            try:
+                response_dict = json.loads(response_data)
+                if response_dict['status'] == 'ok':
+                    self._logger.debug("Log message sent OK.")
+                    return True
+                else:
+                    raise(DaedalusException("Server returned status != ok. Status: {0}".format(
+                        response_dict['status'])))
+            except: # http, json, etc.
+                msg = "Even when http status was 201, something happened " \
+                    "when trying to process the server response"
+                raise(DaedalusException(msg)) # @@@@@@@@@@
+        else: # response.status != 201
+            msg = "Invalid response from server. - status: {0} - reason: {1}".format(
+                status, reason)
+            raise(DaedalusException(msg))
+
+    def _send_messages(self, msg_dicts):
+        """
+        Sends many messages (dicts created by `_build_message()`) in a single request,
+        using the bulk endpoint of the server.
+
+        Returns the dict returned by the server, with the count of 'accepted'
+        and 'rejected' messages, and the result of each one.
+        """
+        body = '\n'.join([json.dumps(msg_dict) for msg_dict in msg_dicts])
+        status, reason, response_data = self._post("/backend/save-bulk/", body,
+            {"Content-type": "application/x-ndjson"})
+        if status != 201:
+            msg = "Invalid response from server. - status: {0} - reason: {1}".format(
+                status, reason)
+            raise(DaedalusException(msg))
         try:
-            conn = httplib.HTTPConnection(host=self.server_host, port=self.server_port)
-            conn.request("POST", "/backend/save/", params, {})
-            response = conn.getresponse()
-            if response.status == 201: # response.status == 201
-                try:
-                    response_data = response.read()
-                    response_dict = json.loads(response_data)
-                    if response_dict['status'] == 'ok':
-                        self._logger.debug("Log message sent OK.")
-                        return True
-                    else:
-                        raise(DaedalusException("Server returned status != ok. Status: {0}".format(
-                            response_dict['status'])))
-                except: # http, json, etc.
-                    msg = "Even when http status was 201, something happened " \
-                        "when trying to process the server response"
-                    raise(DaedalusException(msg)) # @@@@@@@@@@
-            else: # response.status != 201
-                msg = "Invalid response from server. - status: {0} - reason: {1}".format(
-                    response.status, response.reason)
-                raise(DaedalusException(msg))
-        finally:
-            if conn is not None:
+            response_dict = json.loads(response_data)
+        except ValueError:
+            raise(DaedalusException("Even when http status was 201, something happened "
+                "when trying to process the server response"))
+        if response_dict['status'] != 'ok':
+            raise(DaedalusException("Server returned status != ok. Status: {0}".format(
+                response_dict['status'])))
+        return response_dict
+
+    def _close_connection(self, conn):
+        try:
+            conn.close()
+        except:
+            if self.log_client_errors: # Don't rethrow this exception, it's not so important
+                self._logger.exception("Error detected when trying to close http connection")
+
+    def _choose_server(self, exclude):
+        """
+        Returns the server to use for the next request (see `load_balancing`), ignoring
+        the servers in `exclude` and the ejected servers. Returns None if all the servers
+        not in `exclude` are ejected.
+        """
+        available = [server for server in self._servers
+            if server not in exclude and server.is_available()]
+        if not available:
+            return None
+        # The servers are rotated, so the ties of LB_LEAST_OUTSTANDING are resolved by round-robin
+        with self._servers_lock:
+            self._next_server = (self._next_server + 1) % len(self._servers)
+            first = self._next_server
+        rotated = self._servers[first:] + self._servers[:first]
+        available = [server for server in rotated if server in available]
+        if self.load_balancing == LB_LEAST_OUTSTANDING:
+            return min(available, key=lambda server: server.outstanding)
+        return available[0]
+
+    def _compress(self, body, headers):
+        """
+        Returns a tuple (body, headers) with the body compressed, and the
+        header 'Content-Encoding', if needed (see `compression`).
+        """
+        if self.compression is None or len(body) < self.compression_min_size:
+            return body, headers
+        if self.compression == COMPRESSION_GZIP:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj()
+        headers = dict(headers)
+        headers["Content-Encoding"] = self.compression
+        return compressor.compress(body) + compressor.flush(), headers
+
+    def _post(self, url, body, headers):
+        """
+        Sends a POST request to one of the servers (compressing the body, if needed).
+        If the server fails (or returns a 5xx status), the request is sent to other
+        server (see `latency_budget`).
+
+        Returns a tuple (status, reason, response body) of the last server used.
+
+        Raises:
+            DaedalusException: if all the servers are ejected.
+        """
+        body, headers = self._compress(body, headers)
+        start = time.time()
+        tried = []
+        result = None
+        last_error = None
+        sent = False
+        while True:
+            timeout = self.timeout
+            if self.latency_budget is not None:
+                remaining = self.latency_budget - (time.time() - start)
+                if remaining <= 0:
+                    break
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+            server = self._choose_server(tried)
+            if server is None:
+                break
+            tried.append(server)
+            if not server.acquire():
+                continue
+            sent = True
+            success = False
+            try:
+                result = self._post_to_server(server, url, body, headers, timeout)
+                success = result[0] < 500
+            except (httplib.HTTPException, socket.error), e:
+                last_error = sys.exc_info()
+                if self.log_client_errors and len(self._servers) > 1:
+                    self._logger.error("Couldn't send request to {0}: {1}".format(server, e))
+            finally:
+                if server.release(success) and self.log_client_errors:
+                    self._logger.error("{0} failed too many times: it won't be used for {1} seconds".format(
+                        server, server.retry_timeout))
+            if success:
+                return result
+        if result is not None:
+            return result
+        if last_error is not None:
+            raise last_error[0], last_error[1], last_error[2]
+        if not sent:
+            raise(DaedalusException("Couldn't send request: all the servers are ejected"))
+        raise(DaedalusException("Couldn't send request to any server"))
+
+    def _post_to_server(self, server, url, body, headers, timeout):
+        """
+        Sends a POST request to `server`, reusing an idle connection if possible. If a reused
+        connection was closed by the server (see `_is_stale_connection_error()`), the request
+        is sent again using other connection. Other errors (including timeouts) are raised,
+        since the server could have received the request.
+
+        Returns a tuple (status, reason, response body).
+        """
+        while True:
+            conn, reused = server.connections.get(timeout)
+            try:
                 try:
-                    conn.close()
-                except:
-                    if self.log_client_errors: # Don't rethrow this exception, it's not so important
-                        self._logger.exception("Error detected when trying to close http connection")
+                    conn.request("POST", url, body, headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error), e:
+                    if not reused or not _is_stale_connection_error(e):
+                        raise
+                    self._close_connection(conn)
+                    self._logger.debug("Reused connection was closed by the server. "
+                        "Retrying with other connection.")
+                    continue
+                response_data = response.read()
+            except:
+                self._close_connection(conn)
+                raise
+
+            if self.keep_alive and not response.will_close:
+                server.connections.put(conn)
+            else:
+                self._close_connection(conn)
+            return response.status, response.reason, response_data
+
+
+class BufferedDaedalusClient(DaedalusClient):
+    """
+    Client that queues the messages in memory, and sends them in batches from a
+    background thread, using the bulk endpoint of the server. This way,
+    `send_message()` doesn't wait for the server.
+
+    Accepts the same parameters of DaedalusClient, plus:
+    - max_queue_size: max. number of messages waiting to be sent.
+    - flush_size: the messages are sent when this number of messages are queued...
+    - flush_interval: ... or after waiting this number of seconds.
+    - overflow_policy: what to do with new messages when the queue is full:
+      OVERFLOW_DROP_OLDEST (default), OVERFLOW_DROP_NEWEST or OVERFLOW_BLOCK.
+    - close_timeout: seconds to wait for the queued messages to be sent when
+      the client is closed (the client is closed on exit).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_queue_size = kwargs.pop('max_queue_size', 10000)
+        self.flush_size = kwargs.pop('flush_size', 100)
+        self.flush_interval = kwargs.pop('flush_interval', 1.0)
+        self.overflow_policy = kwargs.pop('overflow_policy', OVERFLOW_DROP_OLDEST)
+        self.close_timeout = kwargs.pop('close_timeout', 5.0)
+        if self.overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK):
+            raise(DaedalusException("Invalid overflow policy: '{0}'".format(self.overflow_policy)))
+        DaedalusClient.__init__(self, *args, **kwargs)
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+        self._worker = None
+        self._worker_pid = None
+        self._counters = {
+            'queued': 0,
+            'sent': 0,
+            'rejected': 0,
+            'failed': 0,
+            'dropped': 0,
+        }
+        _buffered_clients.add(self)
+
+    def get_counters(self):
+        """
+        Returns a dict with the count of messages:
+        - queued: accepted by `send_message()`
+        - sent: sent and saved by the server
+        - rejected: sent, but rejected by the server (ej: invalid severity)
+        - failed: lost because of errors while sending them (ej: server down)
+        - dropped: lost because the queue was full, or the client was closed
+        """
+        with self._condition:
+            return dict(self._counters)
+
+    def send_message(self, message, severity=None, host=None, application=None):
+        """
+        Queues a message, to be sent to the server in background.
+        Returns False if the message was dropped.
+        """
+        try:
+            msg_dict = self._build_message(message, severity, host, application)
+        except:
+            if self.log_client_errors:
+                self._logger.exception("Couldn't queue message")
+            if self.raise_client_exceptions:
+                raise
+            return False
+        return self._enqueue(msg_dict)
+
+    def _enqueue(self, msg_dict):
+        with self._condition:
+            while True:
+                # The client could be closed while waiting (OVERFLOW_BLOCK)
+                if self._closed:
+                    self._counters['dropped'] += 1
+                    return False
+                if len(self._queue) < self.max_queue_size:
+                    break
+                if self.overflow_policy == OVERFLOW_DROP_NEWEST:
+                    self._counters['dropped'] += 1
+                    return False
+                elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self._queue.popleft()
+                    self._counters['dropped'] += 1
+                else:
+                    self._condition.wait()
+            self._queue.append(msg_dict)
+            self._counters['queued'] += 1
+            self._start_worker()
+            self._condition.notify_all()
+            return True
+
+    def _start_worker(self):
+        # Must be called with the lock acquired. The worker is started
+        # again if the process was forked (threads don't survive fork()).
+        if self._worker is None or self._worker_pid != os.getpid():
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name='BufferedDaedalusClient')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _take_batch(self):
+        """
+        Waits until a batch must be sent, and returns it.
+        Returns None when the client was closed and there are no more messages.
+        """
+        with self._condition:
+            deadline = None
+            while len(self._queue) < self.flush_size and not self._flush_requested \
+                    and not self._closed:
+                if not self._queue:
+                    deadline = None
+                    self._condition.wait()
+                    continue
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            if not self._queue:
+                if self._closed:
+                    return None
+                self._flush_requested = False
+                self._condition.notify_all()
+                return []
+
+            batch = [self._queue.popleft() for _ in xrange(0, min(self.flush_size, len(self._queue)))]
+            self._in_flight = len(batch)
+            self._condition.notify_all() # there is space for producers waiting (OVERFLOW_BLOCK)
+            return batch
+
+    def _send_batch(self, batch):
+        try:
+            response_dict = self._send_messages(batch)
+            with self._condition:
+                self._counters['sent'] += response_dict['accepted']
+                self._counters['rejected'] += response_dict['rejected']
+            if response_dict['rejected'] and self.log_client_errors:
+                self._logger.error("The server rejected {0} messages".format(response_dict['rejected']))
+        except:
+            with self._condition:
+                self._counters['failed'] += len(batch)
+            if self.log_client_errors:
+                self._logger.exception("Couldn't send {0} messages to the server".format(len(batch)))
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            if batch:
+                self._send_batch(batch)
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Sends the queued messages, and waits until they're sent (at most `timeout` seconds).
+        Returns True if all the messages were sent.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            if self._queue:
+                self._start_worker()
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._queue or self._in_flight:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            return True
+
+    def close(self):
+        """
+        Sends the queued messages (waiting at most `close_timeout` seconds),
+        stops the background thread and closes the connections.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+            worker = self._worker
+        if worker is not None and worker.is_alive():
+            worker.join(self.close_timeout)
+        with self._condition:
+            self._counters['dropped'] += len(self._queue)
+            self._queue.clear()
+        DaedalusClient.close(self)
+        _buffered_clients.discard(self)
+
+
+# The instances of BufferedDaedalusClient not closed yet (weak references, so the
+# clients can be garbage collected), to send their queued messages at exit
+_buffered_clients = weakref.WeakSet()
+
+
+def _close_buffered_clients():
+    for client in list(_buffered_clients):
+        client.close()
+
+atexit.register(_close_buffered_clients)
 
 
 #===============================================================================
@@ -233,7 +812,7 @@ By default, a severity of INFO is used.
 def _main(cli_args, stdin_file=sys.stdin, stdout_file=sys.stdout):
     parser = optparse.OptionParser(description=description)
     parser.add_option('-s', '--daedalus-server', default="localhost",
-        help="Hostname or IP of Daedalus server",
+        help="Hostname or IP of Daedalus server (or many 'host:port' separated by commas)",
         dest="daedalus_server")
     parser.add_option('-p', '--daedalus-port', default="64364", type="int",
         help="Port of Daedalus server",
@@ -302,7 +881,8 @@ def _main(cli_args, stdin_file=sys.stdin, stdout_file=sys.stdout):
 
     client = DaedalusClient(opts.daedalus_server, int(opts.daedalus_port),
         opts.host, opts.application,
-        log_client_errors=False, raise_client_exceptions=opts.show_client_exceptions)
+        log_client_errors=False, raise_client_exceptions=opts.show_client_exceptions,
+        servers=opts.daedalus_server)
 
     # If an exceptino is raised, the exit status will be non-zero
     if opts.from_stdin and opts.message:
@@ -22,7 +22,8 @@
 import logging
 import pprint
 
-from daedalus_client import DaedalusClient, ERROR, WARN, INFO, DEBUG
+from daedalus_client import DaedalusClient, BufferedDaedalusClient, \
+    ERROR, WARN, INFO, DEBUG
 
 PYTHON2DAEDALUS = {
     'CRITICAL': ERROR,
@@ -43,6 +44,10 @@ def print_record(record):
 
 
 class CustomHandler(logging.Handler):
+    """
+    Handler that sends the records to Daedalus. To use many servers, `daedalus_host`
+    could be a list of 'host:port' separated by commas (see DaedalusClient).
+    """
 
     def __init__(self, daedalus_host, daedalus_port, host, application, daedalus_debug=False, *args, **kwargs):
         logging.Handler.__init__(self, *args, **kwargs)
@@ -51,9 +56,13 @@ class CustomHandler(logging.Handler):
         self._host = host
         self._application = application
         self._debug = daedalus_debug
-        self._daedalus_client = DaedalusClient(
+        self._daedalus_client = self._create_client()
+
+    def _create_client(self):
+        return DaedalusClient(
             self._daedalus_host,
             self._daedalus_port,
+            servers=self._daedalus_host,
             default_message_host=self._host,
             default_message_application=self._application,
             log_client_errors=self._debug,
@@ -69,3 +78,45 @@ class CustomHandler(logging.Handler):
             self._host,
             self._application
         )
+
+    def close(self):
+        self._daedalus_client.close()
+        logging.Handler.close(self)
+
+
+class QueuedCustomHandler(CustomHandler):
+    """
+    Variant of CustomHandler that doesn't send the messages from `emit()`. The
+    records are queued, and sent in batches from a background thread (see
+    BufferedDaedalusClient). The pending messages are sent by `flush()`
+    and `close()`, so `logging.shutdown()` sends them before exiting.
+
+    Accepts the parameters of CustomHandler, plus the buffering parameters of
+    BufferedDaedalusClient: max_queue_size, flush_size, flush_interval,
+    overflow_policy and close_timeout.
+    """
+
+    BUFFERING_PARAMETERS = ('max_queue_size', 'flush_size', 'flush_interval',
+        'overflow_policy', 'close_timeout')
+
+    def __init__(self, *args, **kwargs):
+        self._buffering_kwargs = {}
+        for key in self.BUFFERING_PARAMETERS:
+            if key in kwargs:
+                self._buffering_kwargs[key] = kwargs.pop(key)
+        CustomHandler.__init__(self, *args, **kwargs)
+
+    def _create_client(self):
+        return BufferedDaedalusClient(
+            self._daedalus_host,
+            self._daedalus_port,
+            servers=self._daedalus_host,
+            default_message_host=self._host,
+            default_message_application=self._application,
+            log_client_errors=self._debug,
+            custom_logger='StdOutCustomLogger',
+            **self._buffering_kwargs
+        )
+
+    def flush(self):
+        self._daedalus_client.flush(self._daedalus_client.close_timeout)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+##    daedalus - Centralized log server
+##    Copyright (C) 2012 - Horacio Guillermo de Oro <hgdeoro@gmail.com>
+##
+##    This file is part of daedalus.
+##
+##    daedalus is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation version 2.
+##
+##    daedalus is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License version 2 for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with daedalus; see the file LICENSE.txt.
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+
+import logging
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from daedalus.backend.spool import drain
+from daedalus.storage import get_service_cm
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Saves on Cassandra the messages of the local spool of the backend' #@ReservedAssignment
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep draining the spool (every DAEDALUS_SPOOL_DRAIN_INTERVAL seconds)'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                with get_service_cm(pool_profile='backend') as service:
+                    count = drain(service)
+                if count is None:
+                    self.stdout.write("Other drainer is running\n")
+                elif count or not options['loop']:
+                    self.stdout.write("Saved {0} messages\n".format(count))
+            except:
+                if not options['loop']:
+                    raise
+                logger.exception("Error detected while draining the spool. Will retry.")
+            if not options['loop']:
+                break
+            time.sleep(settings.DAEDALUS_SPOOL_DRAIN_INTERVAL)
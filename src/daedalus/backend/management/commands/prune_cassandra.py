@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+##    daedalus - Centralized log server
+##    Copyright (C) 2012 - Horacio Guillermo de Oro <hgdeoro@gmail.com>
+##
+##    This file is part of daedalus.
+##
+##    daedalus is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation version 2.
+##
+##    daedalus is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License version 2 for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with daedalus; see the file LICENSE.txt.
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from daedalus.storage import get_service_cm
+
+
+class Command(BaseCommand):
+    help = 'Removes the references to the minutes whose messages expired' #@ReservedAssignment
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Check all the minutes, not only the ones expired since the previous run'),
+    )
+
+    def handle(self, *args, **options):
+        with get_service_cm() as service:
+            counts = service.prune_expired(full=options['full'])
+            self.stdout.write("Removed {minutes} minutes, {days} days, {rollup_rows} rollup rows "
+                "and {multimessages} multi-messages\n".format(**counts))
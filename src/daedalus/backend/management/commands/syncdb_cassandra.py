@@ -30,3 +30,11 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         with get_service_cm() as service:
             service.create_keyspace_and_cfs()
+            if hasattr(service, 'migrate_timestamp_bitmap'):
+                count = service.migrate_timestamp_bitmap()
+                if count:
+                    self.stdout.write("Migrated {0} minutes of the timestamp bitmap\n".format(count))
+            if hasattr(service, 'migrate_multimessage_timestamps'):
+                count = service.migrate_multimessage_timestamps()
+                if count:
+                    self.stdout.write("Migrated the timestamp of {0} multi-messages\n".format(count))
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+##    daedalus - Centralized log server
+##    Copyright (C) 2012 - Horacio Guillermo de Oro <hgdeoro@gmail.com>
+##
+##    This file is part of daedalus.
+##
+##    daedalus is free software; you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation version 2.
+##
+##    daedalus is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License version 2 for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with daedalus; see the file LICENSE.txt.
+##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+"""
+Local spool (write-ahead buffer) of the backend.
+
+The accepted messages are appended (one JSON object per line) to segment files on
+`settings.DAEDALUS_SPOOL_DIR`, and saved on Cassandra later by `drain()` (see the
+`drain_spool` management command).
+
+- Each process writes its own segment, so no locking is needed between processes.
+  The segments are named '<creation time in ms>-<pid>-<seq>', plus the extension
+  '.open' while the segment is written, or '.spool' once closed.
+- A segment is closed when it reaches `DAEDALUS_SPOOL_SEGMENT_MAX_SIZE` bytes or
+  `DAEDALUS_SPOOL_SEGMENT_MAX_AGE` seconds, and when the process exits.
+- The file is flushed after each write (so the messages survive a crash of the process),
+  but fsync() is called at most every `DAEDALUS_SPOOL_FSYNC_INTERVAL` seconds. The writes
+  not synced are synced by a timer, at most `DAEDALUS_SPOOL_FSYNC_INTERVAL` seconds later.
+- The drained offset of each segment is saved on a '.offset' file. The messages are saved
+  on Cassandra before updating the offset, so after a crash of the drainer some messages
+  could be saved twice (at least once delivery).
+"""
+
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from daedalus.storage import validate_log
+from daedalus_client import DaedalusException
+
+logger = logging.getLogger(__name__)
+
+OPEN_SEGMENT_EXTENSION = '.open'
+CLOSED_SEGMENT_EXTENSION = '.spool'
+OFFSET_EXTENSION = '.offset'
+DRAIN_LOCK_FILENAME = 'drain.lock'
+
+# Seconds (besides DAEDALUS_SPOOL_SEGMENT_MAX_AGE) to wait before considering abandoned
+# an open segment (ex: the process that was writting it died)
+ABANDONED_SEGMENT_GRACE_PERIOD = 60
+
+
+def _segment_created(segment_path):
+    """
+    Returns the creation time (seconds from epoch) of a segment, from its name.
+    """
+    return int(os.path.basename(segment_path).split('-')[0]) / 1000.0
+
+
+class SpoolWriter(object):
+    """
+    Appends messages to the segments of the spool of the current process.
+    Thread-safe.
+    """
+
+    def __init__(self, spool_dir=None):
+        self._spool_dir = spool_dir or settings.DAEDALUS_SPOOL_DIR
+        self._lock = threading.Lock()
+        self._pid = None
+        self._seq = 0
+        self._file = None
+        self._path = None
+        self._created = None
+        self._last_fsync = 0
+        self._fsync_timer = None
+
+    def _open_segment(self):
+        if not os.path.isdir(self._spool_dir):
+            try:
+                os.makedirs(self._spool_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._seq += 1
+        self._created = time.time()
+        self._path = os.path.join(self._spool_dir, '{0:015d}-{1}-{2}{3}'.format(
+            int(self._created * 1000), os.getpid(), self._seq, OPEN_SEGMENT_EXTENSION))
+        self._file = open(self._path, 'ab')
+        self._last_fsync = time.time()
+
+    def _close_segment(self):
+        """
+        Fsync and close the current segment, and renames it, so the drainer can remove it
+        once drained.
+        """
+        self._cancel_fsync_timer()
+        if self._file is None:
+            return
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.rename(self._path, self._path[:-len(OPEN_SEGMENT_EXTENSION)] + CLOSED_SEGMENT_EXTENSION)
+        except (IOError, OSError):
+            logger.exception("Error detected when closing spool segment '%s'", self._path)
+        self._file = None
+        self._path = None
+
+    def _get_file(self):
+        if self._pid != os.getpid():
+            # After a fork(), the segment (and the timer) of the parent process must not be used
+            self._pid = os.getpid()
+            self._file = None
+            self._path = None
+            self._fsync_timer = None
+        elif self._file is not None:
+            if self._file.tell() >= settings.DAEDALUS_SPOOL_SEGMENT_MAX_SIZE or \
+                    time.time() - self._created >= settings.DAEDALUS_SPOOL_SEGMENT_MAX_AGE:
+                self._close_segment()
+        if self._file is None:
+            self._open_segment()
+        return self._file
+
+    def append(self, messages):
+        """
+        Appends the messages (list of dicts, already validated) to the spool.
+        """
+        data = ''.join([json.dumps(message) + '\n' for message in messages])
+        with self._lock:
+            a_file = self._get_file()
+            a_file.write(data)
+            a_file.flush()
+            if time.time() - self._last_fsync >= settings.DAEDALUS_SPOOL_FSYNC_INTERVAL:
+                self._cancel_fsync_timer()
+                os.fsync(a_file.fileno())
+                self._last_fsync = time.time()
+            elif self._fsync_timer is None:
+                delay = settings.DAEDALUS_SPOOL_FSYNC_INTERVAL - (time.time() - self._last_fsync)
+                self._fsync_timer = threading.Timer(max(delay, 0), self._fsync_from_timer)
+                self._fsync_timer.daemon = True
+                self._fsync_timer.start()
+
+    def _cancel_fsync_timer(self):
+        if self._fsync_timer is not None:
+            self._fsync_timer.cancel()
+            self._fsync_timer = None
+
+    def _fsync_from_timer(self):
+        """
+        Syncs the writes done since the last fsync(), so they aren't left unsynced
+        when no more messages are appended.
+        """
+        with self._lock:
+            # The timer could have been cancelled while waiting for the lock
+            if self._fsync_timer is not threading.current_thread() or self._file is None:
+                return
+            self._fsync_timer = None
+            try:
+                os.fsync(self._file.fileno())
+            except (IOError, OSError):
+                logger.exception("Error detected when syncing spool segment '%s'", self._path)
+            self._last_fsync = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._close_segment()
+
+
+_spool_writer = None
+_spool_writer_lock = threading.Lock()
+
+
+def get_spool_writer():
+    """
+    Returns the SpoolWriter of the process. The segment is closed when the process exits.
+    """
+    global _spool_writer
+    with _spool_writer_lock:
+        if _spool_writer is None:
+            _spool_writer = SpoolWriter()
+            atexit.register(_spool_writer.close)
+        return _spool_writer
+
+
+def _get_offset_path(segment_path):
+    """
+    Returns the path of the '.offset' file of the segment (the same for the open
+    and closed segment, since the segment is renamed when closed).
+    """
+    return os.path.splitext(segment_path)[0] + OFFSET_EXTENSION
+
+
+def _read_offset(segment_path):
+    try:
+        with open(_get_offset_path(segment_path)) as offset_file:
+            return int(offset_file.read().strip() or 0)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+
+def _write_offset(segment_path, offset):
+    tmp_path = _get_offset_path(segment_path) + '.tmp'
+    with open(tmp_path, 'w') as offset_file:
+        offset_file.write(str(offset))
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+    os.rename(tmp_path, _get_offset_path(segment_path))
+
+
+def _remove_segment(segment_path):
+    for path in (segment_path, _get_offset_path(segment_path)):
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _drain_segment(segment_path, storage_service, batch_size):
+    """
+    Saves the messages of the segment not yet drained, in batches of `batch_size`.
+    Only complete lines are read, since the segment could be being written.
+
+    Returns:
+    - tuple with (count of messages saved, True if the whole segment was drained)
+    """
+    count = 0
+    offset = _read_offset(segment_path)
+    with open(segment_path, 'rb') as segment:
+        segment.seek(offset)
+        batch = []
+        while True:
+            line = segment.readline()
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            try:
+                message = json.loads(line)
+                validate_log(message.get('application'), message.get('host'),
+                    message.get('severity'), message.get('timestamp'), message.get('message'))
+                batch.append(message)
+            except (DaedalusException, ValueError, AttributeError):
+                logger.exception("Ignoring invalid line of spool segment '%s'", segment_path)
+            if len(batch) >= batch_size:
+                storage_service.save_logs(batch)
+                count += len(batch)
+                batch = []
+                _write_offset(segment_path, offset)
+        if batch:
+            storage_service.save_logs(batch)
+            count += len(batch)
+        _write_offset(segment_path, offset)
+        return count, offset == os.fstat(segment.fileno()).st_size
+
+
+def drain(storage_service, spool_dir=None, batch_size=None):
+    """
+    Saves the spooled messages using `storage_service`, from the oldest segment to the
+    newest. The closed segments, and the open segments abandoned by its writer, are removed
+    once drained. Only one drainer runs at a time: returns None if other drainer is running.
+
+    Raises:
+    - any exception raised by `storage_service` (the not-saved messages stay on the spool).
+
+    Returns:
+    - count of messages saved
+    """
+    spool_dir = spool_dir or settings.DAEDALUS_SPOOL_DIR
+    batch_size = batch_size or settings.DAEDALUS_SAVE_BULK_BATCH_SIZE
+    if not os.path.isdir(spool_dir):
+        return 0
+
+    with open(os.path.join(spool_dir, DRAIN_LOCK_FILENAME), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        count = 0
+        segments = glob.glob(os.path.join(spool_dir, '*' + OPEN_SEGMENT_EXTENSION)) + \
+            glob.glob(os.path.join(spool_dir, '*' + CLOSED_SEGMENT_EXTENSION))
+        for segment_path in sorted(segments, key=os.path.basename):
+            try:
+                saved, fully_drained = _drain_segment(segment_path, storage_service, batch_size)
+            except (IOError, OSError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue # the segment was closed (renamed) while draining
+            count += saved
+            if segment_path.endswith(CLOSED_SEGMENT_EXTENSION):
+                if not fully_drained:
+                    logger.error("Ignoring incomplete last line of spool segment '%s'", segment_path)
+                _remove_segment(segment_path)
+            elif fully_drained and time.time() - _segment_created(segment_path) > \
+                    settings.DAEDALUS_SPOOL_SEGMENT_MAX_AGE + ABANDONED_SEGMENT_GRACE_PERIOD:
+                _remove_segment(segment_path)
+
+        return count
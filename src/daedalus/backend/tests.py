@@ -19,15 +19,26 @@
 ##    along with daedalus; see the file LICENSE.txt.
 ##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+import calendar
 import datetime
+import gc
+import gzip
+import httplib
 import json
 import logging
 import multiprocessing
 import os
 import pprint
 import random
+import shutil
+import socket
+import tempfile
+import threading
 import time
+import urllib
 import uuid
+import weakref
+import zlib
 
 from contextlib import contextmanager
 from StringIO import StringIO
@@ -35,19 +46,29 @@ from django.test.testcases import TestCase, LiveServerTestCase
 from django.conf import settings
 from pycassa.system_manager import SystemManager
 from pycassa.columnfamily import ColumnFamily
-from pycassa.pool import ConnectionPool
+from pycassa.pool import ConnectionPool, AllServersUnavailable
+from pycassa.batch import Mutator
 from pycassa.util import convert_time_to_uuid, convert_uuid_to_time
 
 from daedalus_client import DaedalusClient, DaedalusException, \
+    BufferedDaedalusClient, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_BLOCK, \
+    LB_LEAST_OUTSTANDING, COMPRESSION_GZIP, COMPRESSION_DEFLATE, \
     utc_now_from_epoch as utc_now_from_epoch_from_client, \
     utc_str_timestamp as utc_str_timestamp_from_client, _main as cli_main, \
+    _buffered_clients, \
     ERROR, WARN, INFO, DEBUG
 
+from daedalus import storage
+from daedalus.backend import spool
+from daedalus.backend import views as backend_views
+from daedalus.backend.views import _save_or_spool
+from daedalus_logging_handler import CustomHandler, QueuedCustomHandler
 from daedalus.proto.random_log_generator import log_dict_generator
-from daedalus.storage import get_service_cm, get_service,\
+from daedalus.storage import get_service_cm, get_service, get_shared_pool, Projection,\
     StorageServiceRowPerMinute, MULTIMSG_STATUS_FINISHED_ERROR,\
     MULTIMSG_STATUS_FINISHED_OK, MULTIMSG_STATUS_FINISHED_UNKNOWN,\
-    MULTIMSG_STATUS_OPEN
+    MULTIMSG_STATUS_OPEN, CF_SEARCH_INDEX, tokenize, get_retention_days, get_retention_ttl,\
+    encode_log_value, decode_log_value, extract_template, render_template
 from daedalus.utils import utc_str_timestamp, utc_timestamp2datetime,\
     utc_now, utc_now_from_epoch, ymd_from_epoch, ymd_from_uuid1,\
     backward_time_series_generator, time_series_generator,\
@@ -68,6 +89,8 @@ def _truncate_all_column_families():
         cf.truncate()
     sys_mgr.close()
     pool.dispose()
+    # The cached templates aren't on CF_MESSAGE_TEMPLATES anymore
+    storage._get_template_cache().clear()
 
 
 def sparse_timestamp_generator(random_seed):
@@ -276,6 +299,173 @@ class StorageTest(StorageBaseTest):
         hosts = self.get_service().list_hosts()
         self.assertListEqual(hosts, ['localhost'])
 
+    def test_save_logs(self):
+        _truncate_all_column_families()
+
+        messages = []
+        for message in log_dict_generator(1):
+            messages.append(message)
+            if len(messages) == 50:
+                break
+
+        # Use a small queue, to force many batches
+        result = self.get_service().save_logs(messages, queue_size=7)
+        self.assertEqual(len(result), 50)
+        self.assertEqual(len(self.get_service().query()), 50)
+        self.assertListEqual(sorted(self.get_service().list_applications()),
+            sorted(set([msg['application'] for msg in messages])))
+        self.assertListEqual(sorted(self.get_service().list_hosts()),
+            sorted(set([msg['host'] for msg in messages])))
+
+        # If any message is invalid, nothing is saved
+        _truncate_all_column_families()
+        invalid_message = dict(messages[0])
+        invalid_message['severity'] = u"xxx"
+        self.assertRaises(DaedalusException, self.get_service().save_logs,
+            [messages[1], invalid_message])
+        self.assertEqual(len(self.get_service().query()), 0)
+
+    def test_counters(self):
+        _truncate_all_column_families()
+        self.assertEqual(self.get_service().get_count(), 0)
+        self.assertEqual(self.get_service().get_error_count(), 0)
+
+        messages = []
+        for message in log_dict_generator(1):
+            messages.append(message)
+            if len(messages) == 50:
+                break
+        self.get_service().save_logs(messages[0:40])
+        for message in messages[40:]:
+            self.get_service().save_log(**message)
+
+        self.assertEqual(self.get_service().get_count(), 50)
+        day = str(ymdhm_int_from_timestamp(float(messages[0]['timestamp'])))[0:8]
+        self.assertEqual(self.get_service().get_count(day=day), len([msg for msg in messages
+            if str(ymdhm_int_from_timestamp(float(msg['timestamp'])))[0:8] == day]))
+        self.assertEqual(self.get_service().get_error_count(),
+            len([msg for msg in messages if msg['severity'] == 'ERROR']))
+        self.assertEqual(self.get_service().get_warn_count(),
+            len([msg for msg in messages if msg['severity'] == 'WARN']))
+        self.assertEqual(self.get_service().get_info_count(),
+            len([msg for msg in messages if msg['severity'] == 'INFO']))
+        self.assertEqual(self.get_service().get_debug_count(),
+            len([msg for msg in messages if msg['severity'] == 'DEBUG']))
+        for host in self.get_service().list_hosts():
+            self.assertEqual(self.get_service().get_count('host', host),
+                len([msg for msg in messages if msg['host'] == host]))
+        for application in self.get_service().list_applications():
+            self.assertEqual(self.get_service().get_count('application', application),
+                len([msg for msg in messages if msg['application'] == application]))
+
+    def test_rollups(self):
+        _truncate_all_column_families()
+        now = time.time()
+        # One message per minute during the last 2 hours, and one per hour during the last 2 days
+        timestamps = [now - (minute * 60) for minute in range(120)] + \
+            [now - (hour * 60 * 60) for hour in range(2, 48)]
+        self.get_service().save_logs([{
+            'application': u'someapp',
+            'host': u'somehost',
+            'severity': u'INFO',
+            'timestamp': "{0:0.25f}".format(timestamp),
+            'message': u"Message",
+        } for timestamp in timestamps])
+
+        for granularity in storage.ROLLUP_GRANULARITIES:
+            counts = self.get_service().get_rollup_counts(granularity, now - (60 * 60 * 24 * 3), now + 1)
+            self.assertEqual(sum(counts.values()), len(timestamps))
+            for bucket, count in counts.iteritems():
+                self.assertEqual(bucket % granularity, 0)
+                self.assertEqual(count, len([timestamp for timestamp in timestamps
+                    if bucket <= timestamp < bucket + granularity]))
+
+        for generate_method, hours in ((self.get_service().generate_6hs_charts_data, 6),
+                (self.get_service().generate_24hs_charts_data, 24),
+                (self.get_service().generate_48hs_charts_data, 48)):
+            charts_data = generate_method()
+            first_timestamp = calendar.timegm(charts_data[0][0].utctimetuple())
+            self.assertEqual(sum([count for _, _, count in charts_data]),
+                len([timestamp for timestamp in timestamps if timestamp >= first_timestamp]))
+            self.assertTrue(now - (hours * 60 * 60) - first_timestamp < 60 * 60)
+
+    def test_counters_with_retried_batches(self):
+        _truncate_all_column_families()
+        original_mutator = storage.Mutator
+
+        class RetriedMutator(Mutator):
+            # Sends twice the batches allowed to be retried, like a `batch_mutate`
+            # retried by the pool after a timeout, and fails the other batches
+            def send(self, *args, **kwargs):
+                if not self.allow_retries:
+                    raise(Exception("Timeout sending the batch"))
+                buffer = list(self._buffer)
+                Mutator.send(self, *args, **kwargs)
+                self._buffer = buffer
+                Mutator.send(self, *args, **kwargs)
+
+        now = time.time()
+        message = {
+            'application': u'someapp',
+            'host': u'somehost',
+            'severity': u'INFO',
+            'timestamp': "{0:0.25f}".format(now),
+            'message': u"Message",
+        }
+        storage.Mutator = RetriedMutator
+        try:
+            self.get_service().save_logs([message, message])
+            self.get_service().save_log(**message)
+        finally:
+            storage.Mutator = original_mutator
+
+        # The messages are saved, and the increments are dropped, not applied twice
+        self.assertEqual(len(self.get_service().query()), 3)
+        self.assertEqual(self.get_service().get_count(), 0)
+        for granularity in storage.ROLLUP_GRANULARITIES:
+            counts = self.get_service().get_rollup_counts(granularity, now - 60 * 60 * 24, now + 1)
+            self.assertEqual(sum(counts.values()), 0)
+
+        self.get_service().save_log(**message)
+        self.assertEqual(self.get_service().get_count(), 1)
+        for granularity in storage.ROLLUP_GRANULARITIES:
+            counts = self.get_service().get_rollup_counts(granularity, now - 60 * 60 * 24, now + 1)
+            self.assertEqual(sum(counts.values()), 1)
+
+    def test_charts_breakdown(self):
+        _truncate_all_column_families()
+        messages = []
+        for message in log_dict_generator(1):
+            messages.append(message)
+            if len(messages) == 100:
+                break
+        self.get_service().save_logs(messages)
+
+        def _check(charts_data, key, values, severity=None):
+            filtered = [msg for msg in messages if severity is None or msg['severity'] == severity]
+            self.assertEqual(sum([item[2] for item in charts_data]), len(filtered))
+            for item in charts_data:
+                self.assertListEqual([value for value, _ in item[3]], values)
+                self.assertEqual(sum([count for _, count in item[3]]), item[2])
+            for index, value in enumerate(values):
+                self.assertEqual(sum([item[3][index][1] for item in charts_data]),
+                    len([msg for msg in filtered if msg[key] == value]))
+
+        _check(self.get_service().generate_6hs_charts_data('severity'), 'severity',
+            ['ERROR', 'WARN', 'INFO', 'DEBUG'])
+        _check(self.get_service().generate_6hs_charts_data('host'), 'host',
+            sorted(self.get_service().list_hosts()))
+        _check(self.get_service().generate_24hs_charts_data('application'), 'application',
+            sorted(self.get_service().list_applications()))
+        _check(self.get_service().generate_6hs_charts_data('host', 'ERROR'), 'host',
+            sorted(self.get_service().list_hosts()), severity='ERROR')
+
+        self.assertEqual(sum([item[2] for item in self.get_service().generate_6hs_charts_data(
+            severity='WARN')]), len([msg for msg in messages if msg['severity'] == 'WARN']))
+        self.assertRaises(DaedalusException, self.get_service().generate_6hs_charts_data, 'xxx')
+        self.assertRaises(DaedalusException, self.get_service().generate_6hs_charts_data,
+            'severity', 'ERROR')
+
     def test_save_500_log(self):
         """
         Saves 500 messages on the configured keyspace (settings.KEYSPACE)
@@ -293,6 +483,394 @@ class StorageTest(StorageBaseTest):
         result = self.get_service().query()
         self.assertEqual(len(result), 100)
 
+    def test_query_across_days(self):
+        _truncate_all_column_families()
+        # One message per day, during the last 5 days
+        now = time.time()
+        for day in range(5):
+            self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                "{0:0.25f}".format(now - (day * 60 * 60 * 24)), u"Message {0}".format(day))
+
+        result = self.get_service().query()
+        self.assertListEqual([msg['message'] for msg in result],
+            [u"Message {0}".format(day) for day in range(5)])
+
+        # Pagination from the 3rd message
+        from_col = self.get_service().str_to_column_key(result[2]['_id'])
+        result = self.get_service().query(from_col)
+        self.assertListEqual([msg['message'] for msg in result],
+            [u"Message 3", u"Message 4"])
+
+    def test_migrate_timestamp_bitmap(self):
+        _truncate_all_column_families()
+        now = time.time()
+        for day in range(3):
+            self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                "{0:0.25f}".format(now - (day * 60 * 60 * 24)), u"Message {0}".format(day))
+
+        # Leave the minutes only on the legacy row, as saved by previous versions
+        minutes = list(self.get_service()._iter_bitmap_keys())
+        self.assertEqual(len(minutes), 3)
+        cf = ColumnFamily(get_shared_pool(), storage.CF_TIMESTAMP_BITMAP)
+        cf.truncate()
+        cf.insert(storage.TIMESTAMP_BITMAP_LEGACY_ROW, dict([(minute, '') for minute in minutes]))
+        self.assertEqual(len(self.get_service().query()), 0)
+
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(service.migrate_timestamp_bitmap(), 3)
+            self.assertEqual(service.migrate_timestamp_bitmap(), 0)
+        self.assertListEqual(list(self.get_service()._iter_bitmap_keys()), minutes)
+        self.assertEqual(len(self.get_service().query()), 3)
+
+    def test_query_read_ahead(self):
+        _truncate_all_column_families()
+        now = time.time()
+        messages = []
+        for message in log_dict_generator(1):
+            # Many rows, some of them with many messages
+            message['timestamp'] = "{0:0.25f}".format(now - (len(messages) % 150) * 60 - len(messages) * 0.01)
+            messages.append(message)
+            if len(messages) == 450:
+                break
+        self.get_service().save_logs(messages)
+        messages.sort(key=lambda msg: float(msg['timestamp']), reverse=True)
+
+        original_read_ahead = settings.DAEDALUS_QUERY_READ_AHEAD
+        try:
+            for read_ahead in (1, 7, 100):
+                settings.DAEDALUS_QUERY_READ_AHEAD = read_ahead
+                retrieved = []
+                from_col = None
+                while True:
+                    result = self.get_service().query(from_col)
+                    if not result:
+                        break
+                    retrieved.extend([msg['message'] for msg in result])
+                    from_col = self.get_service().str_to_column_key(result[-1]['_id'])
+                self.assertListEqual(retrieved, [msg['message'] for msg in messages])
+        finally:
+            settings.DAEDALUS_QUERY_READ_AHEAD = original_read_ahead
+
+    def test_query_range(self):
+        _truncate_all_column_families()
+        now = time.time()
+        messages = []
+        for message in log_dict_generator(1, timestamp_generator=sparse_timestamp_generator(0)):
+            messages.append(message)
+            if len(messages) == 400:
+                break
+        self.get_service().save_logs(messages)
+        messages.sort(key=lambda msg: float(msg['timestamp']), reverse=True)
+
+        start_ts = now - (60 * 60 * 24 * 60) - 1234.5
+        end_ts = now - (60 * 60 * 24 * 20) + 77.7
+        for filters in ({}, {'severity': 'ERROR'}, {'host': messages[0]['host']},
+                {'host': messages[0]['host'], 'severity': 'INFO'},
+                {'application': messages[0]['application']}):
+            expected = [msg['message'] for msg in messages
+                if start_ts <= float(msg['timestamp']) <= end_ts and
+                    all([msg[key] == value for key, value in filters.iteritems()])]
+            retrieved = []
+            from_col = None
+            while True:
+                result = self.get_service().query_range(start_ts, end_ts, filters, limit=37,
+                    from_col=from_col)
+                if not result:
+                    break
+                retrieved.extend([msg['message'] for msg in result])
+                from_col = self.get_service().str_to_column_key(result[-1]['_id'])
+            self.assertListEqual(retrieved, expected)
+
+        self.assertEqual(len(self.get_service().query_range(limit=1000)), 400)
+        self.assertRaises(DaedalusException, self.get_service().query_range,
+            filters={'message': 'xxx'})
+
+    def test_query_with_projection(self):
+        _truncate_all_column_families()
+        message = u"First line of a long message\n" + (u"Other line\n" * 100)
+        self.get_service().save_log(u'someapp', u'somehost', u'ERROR', time.time(), message)
+
+        result = self.get_service().query()
+        self.assertEqual(len(result), 1)
+        # The keys of the column key doesn't need to decode the message
+        self.assertEqual(result[0]['host'], u'somehost')
+        self.assertEqual(result[0]['application'], u'someapp')
+        self.assertEqual(result[0]['severity'], u'ERROR')
+        self.assertIsNone(result[0]._values)
+        self.assertEqual(result[0]['message'], message)
+        self.assertEqual(result[0].to_dict()['_id'], result[0]['_id'])
+
+        projection = Projection(('_id', 'severity', 'message'), message_max_length=10)
+        for result in (self.get_service().query(projection=projection),
+                self.get_service().query_by_severity('ERROR', projection=projection)):
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0]['message'], message[0:10])
+            self.assertEqual(result[0]['severity'], u'ERROR')
+            self.assertRaises(KeyError, lambda: result[0]['host'])
+            self.assertIsNone(result[0].get('timestamp'))
+
+    def test_query_by_indexes(self):
+        _truncate_all_column_families()
+        messages = []
+        for message in log_dict_generator(1, timestamp_generator=sparse_timestamp_generator(0)):
+            messages.append(message)
+            if len(messages) == 300:
+                break
+        self.get_service().save_logs(messages)
+        messages.sort(key=lambda msg: float(msg['timestamp']), reverse=True)
+
+        def _check(query_method, key, value):
+            expected = [msg['message'] for msg in messages if msg[key] == value]
+            result = query_method(value)
+            self.assertListEqual([msg['message'] for msg in result], expected[0:100])
+            if len(expected) > 100:
+                # Next page
+                from_col = self.get_service().str_to_column_key(result[-1]['_id'])
+                result = query_method(value, from_col)
+                self.assertListEqual([msg['message'] for msg in result], expected[100:200])
+
+        for severity in ('ERROR', 'WARN', 'INFO', 'DEBUG'):
+            _check(self.get_service().query_by_severity, 'severity', severity)
+        for application in self.get_service().list_applications():
+            _check(self.get_service().query_by_application, 'application', application)
+        for host in self.get_service().list_hosts():
+            _check(self.get_service().query_by_host, 'host', host)
+
+    def test_query_by_host_with_rare_host(self):
+        _truncate_all_column_families()
+        now = time.time()
+        # Old messages of a rare host, followed by many minutes of messages of other host
+        for day in range(1, 4):
+            self.get_service().save_log(u'someapp', u'rarehost', u'INFO',
+                "{0:0.25f}".format(now - (day * 60 * 60 * 24)), u"Message {0}".format(day))
+        self.get_service().save_logs([{
+            'application': u'someapp',
+            'host': u'busyhost',
+            'severity': u'INFO',
+            'timestamp': "{0:0.25f}".format(now - (minute * 60)),
+            'message': u"Busy message",
+        } for minute in range(200)])
+
+        result = self.get_service().query_by_host('rarehost')
+        self.assertListEqual([msg['message'] for msg in result],
+            [u"Message 1", u"Message 2", u"Message 3"])
+
+    def test_tokenize(self):
+        self.assertListEqual(tokenize(u"User 'JohnDoe' locked: user_id=123, a"),
+            ['user', 'johndoe', 'locked', 'user_id', '123'])
+        self.assertListEqual(tokenize(u"one two three", max_tokens=2), ['one', 'two'])
+        self.assertListEqual(tokenize(u"  "), [])
+
+    def test_search(self):
+        _truncate_all_column_families()
+        now = time.time()
+        messages = []
+        for minute in range(300):
+            messages.append({
+                'application': u'someapp',
+                'host': u'somehost',
+                'severity': u'INFO',
+                'timestamp': "{0:0.25f}".format(now - (minute * 60 * 10)),
+                'message': u"Message {0} {1} {2}".format(minute,
+                    'even' if minute % 2 == 0 else 'odd',
+                    'fizz' if minute % 3 == 0 else 'buzz'),
+            })
+        self.get_service().save_logs(messages)
+
+        def _check(text, expected):
+            result = self.get_service().search(text)
+            self.assertListEqual([msg['message'] for msg in result], expected[0:100])
+            if len(expected) > 100:
+                # Next page
+                from_col = self.get_service().str_to_column_key(result[-1]['_id'])
+                result = self.get_service().search(text, from_col=from_col)
+                self.assertListEqual([msg['message'] for msg in result], expected[100:200])
+
+        original_chunk_size = settings.DAEDALUS_SEARCH_CHUNK_SIZE
+        try:
+            # With chunks of 1 reference, the first chunk of the next page has only `from_col`
+            for chunk_size in (original_chunk_size, 1):
+                settings.DAEDALUS_SEARCH_CHUNK_SIZE = chunk_size
+                _check(u"odd", [msg['message'] for msg in messages if ' odd ' in msg['message']])
+                _check(u"EVEN fizz", [msg['message'] for msg in messages
+                    if ' even fizz' in msg['message']])
+                _check(u"message 17 odd", [u"Message 17 odd buzz"])
+                _check(u"odd 18", [])
+                _check(u"nonexistent", [])
+                _check(u"!!", [])
+        finally:
+            settings.DAEDALUS_SEARCH_CHUNK_SIZE = original_chunk_size
+
+    def test_retention_policies(self):
+        original_policies = settings.DAEDALUS_RETENTION_POLICIES
+        original_default = settings.DAEDALUS_RETENTION_DEFAULT_DAYS
+        try:
+            settings.DAEDALUS_RETENTION_POLICIES = ((None, 'DEBUG', 2), ('intranet', None, 30), )
+            settings.DAEDALUS_RETENTION_DEFAULT_DAYS = None
+            self.assertEqual(get_retention_days('intranet', 'DEBUG'), 2)
+            self.assertEqual(get_retention_days('intranet', 'ERROR'), 30)
+            self.assertEqual(get_retention_days('extranet', 'ERROR'), None)
+            self.assertEqual(get_retention_ttl('extranet', 'ERROR', time.time()), None)
+            settings.DAEDALUS_RETENTION_DEFAULT_DAYS = 7
+            self.assertEqual(get_retention_days('extranet', 'ERROR'), 7)
+            ttl = get_retention_ttl('extranet', 'DEBUG', time.time() - 24 * 60 * 60)
+            self.assertTrue(24 * 60 * 60 - 5 < ttl <= 24 * 60 * 60)
+            self.assertEqual(get_retention_ttl('extranet', 'DEBUG', time.time() - 3 * 24 * 60 * 60), 1)
+        finally:
+            settings.DAEDALUS_RETENTION_POLICIES = original_policies
+            settings.DAEDALUS_RETENTION_DEFAULT_DAYS = original_default
+
+    def test_prune_expired(self):
+        _truncate_all_column_families()
+        original_policies = settings.DAEDALUS_RETENTION_POLICIES
+        try:
+            settings.DAEDALUS_RETENTION_POLICIES = ((None, 'DEBUG', 1), )
+            old_timestamp = time.time() - 3 * 24 * 60 * 60
+            # Expired minute, and a minute with an expired and a valid message
+            self.get_service().save_log(u'someapp', u'somehost', u'DEBUG',
+                "{0:0.25f}".format(old_timestamp), u"Expired message")
+            self.get_service().save_log(u'someapp', u'somehost', u'DEBUG',
+                "{0:0.25f}".format(old_timestamp + 120), u"Expired message")
+            self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                "{0:0.25f}".format(old_timestamp + 120.5), u"Valid message")
+            # A day with only expired messages
+            expired_timestamp = time.time() - 6 * 24 * 60 * 60
+            expired_day = time.strftime('%Y%m%d', time.gmtime(expired_timestamp))
+            self.get_service().save_log(u'someapp', u'somehost', u'DEBUG',
+                "{0:0.25f}".format(expired_timestamp), u"Obsolete message")
+            # A multi-message whose start message expired (ex: saved with other retention
+            # policies), and a valid one
+            expired_multimessage_id = self.get_service().start_multimessage(u'someapp', u'somehost',
+                u'INFO', "{0:0.25f}".format(old_timestamp - 600), u"Expired message")
+            row_key, str_column_key = self.get_service().get_multimessage(
+                expired_multimessage_id)['meta']['start_message'].split(',', 1)
+            self.get_service()._get_cf_logs().remove(row_key,
+                columns=[self.get_service().str_to_column_key(str_column_key)])
+            valid_multimessage_id = self.get_service().start_multimessage(u'someapp', u'somehost',
+                u'INFO', "{0:0.25f}".format(old_timestamp - 540), u"Valid message")
+            time.sleep(2)
+
+            self.assertListEqual([msg['message'] for msg in self.get_service().query()],
+                [u"Valid message", u"Valid message"])
+            self.assertListEqual([msg['message'] for msg in self.get_service().search(u"message")],
+                [u"Valid message", u"Valid message"])
+            counts = self.get_service().prune_expired()
+            self.assertEqual(counts['minutes'], 3)
+            self.assertEqual(counts['multimessages'], 1)
+            self.assertEqual(self.get_service().get_multimessage(expired_multimessage_id), None)
+            self.assertNotEqual(self.get_service().get_multimessage(valid_multimessage_id), None)
+            self.assertEqual(len(list(self.get_service()._iter_bitmap_keys())), 2)
+            self.assertEqual(self.get_service().prune_expired()['minutes'], 0)
+
+            # The expired day was removed from the index of days of the search index
+            cf_metadata = self.get_service()._get_cf_metadata()
+            for token in (u'obsolete', u'message'):
+                self.assertFalse(expired_day in dict(cf_metadata.xget(
+                    self.get_service()._get_index_days_row_key('search', token))))
+            self.assertEqual(len(list(cf_metadata.xget(
+                storage.SEARCH_TOKENS_DAY_ROW_PREFIX + expired_day))), 0)
+
+            # A day on the index of days, without minutes
+            cf_bitmap = self.get_service()._get_cf_timestamp_bitmap()
+            empty_day = int(time.strftime('%Y%m%d', time.gmtime(time.time() - 5 * 24 * 60 * 60)))
+            cf_bitmap.insert(storage.TIMESTAMP_BITMAP_DAYS_ROW, {empty_day: ''})
+            # The days older than the cutoff of the previous run aren't checked again...
+            self.assertEqual(self.get_service().prune_expired()['days'], 0)
+            self.assertTrue(empty_day in dict(cf_bitmap.xget(storage.TIMESTAMP_BITMAP_DAYS_ROW)))
+            # ... unless all of them are checked
+            self.assertEqual(self.get_service().prune_expired(full=True)['days'], 1)
+            self.assertFalse(empty_day in dict(cf_bitmap.xget(storage.TIMESTAMP_BITMAP_DAYS_ROW)))
+        finally:
+            settings.DAEDALUS_RETENTION_POLICIES = original_policies
+
+    def test_log_value_codec(self):
+        column_key = (convert_time_to_uuid(time.time(), randomize=True), u'somehost',
+            u'someapp', u'ERROR')
+        timestamp = time.time()
+        for message in (u"Short message", u"Long messag\u00e9 " * 100):
+            for multimessage_id in (None, u"201201010000,abcdef,somehost,someapp,ERROR"):
+                value = encode_log_value(column_key, timestamp, message, multimessage_id)
+                self.assertTrue(value.startswith(storage.LOG_VALUE_VERSION_COMPACT))
+                self.assertTrue(len(value) < len(message.encode('utf-8')) + 80)
+                decoded = decode_log_value(column_key, value)
+                self.assertEqual(decoded['message'], message)
+                self.assertEqual(decoded['timestamp'], timestamp)
+                self.assertEqual(decoded['host'], u'somehost')
+                self.assertEqual(decoded.get('multimessage_id'), multimessage_id)
+                self.assertEqual(self.get_service().str_to_column_key(decoded['_id']), column_key)
+
+        self.assertRaises(DaedalusException, decode_log_value, column_key, '\xff')
+
+    def test_log_value_json_compatibility(self):
+        _truncate_all_column_families()
+        original_format = settings.DAEDALUS_LOG_VALUE_FORMAT
+        try:
+            settings.DAEDALUS_LOG_VALUE_FORMAT = 'json'
+            self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                "{0:0.25f}".format(time.time() - 60), u"Message in JSON")
+            settings.DAEDALUS_LOG_VALUE_FORMAT = 'compact'
+            self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                "{0:0.25f}".format(time.time()), u"Compact message")
+        finally:
+            settings.DAEDALUS_LOG_VALUE_FORMAT = original_format
+
+        result = self.get_service().query()
+        self.assertListEqual([msg['message'] for msg in result],
+            [u"Compact message", u"Message in JSON"])
+        for msg in result:
+            self.assertDictEqual(self.get_service().get_by_id(msg['_id']), msg.to_dict())
+
+    def test_message_templates(self):
+        template, params = extract_template(u"Flush of Memtable@1523(2039/40 bytes, 12 ops) at 21:11:09,339")
+        self.assertEqual(template.replace(storage.TEMPLATE_PARAM_MARK, u'<*>'),
+            u"Flush of Memtable@<*>(<*> bytes, <*> ops) at <*>")
+        self.assertListEqual(params, ['1523', '2039/40', '12', '21:11:09,339'])
+        self.assertEqual(render_template(template, params),
+            u"Flush of Memtable@1523(2039/40 bytes, 12 ops) at 21:11:09,339")
+        self.assertRaises(DaedalusException, render_template, template, params[1:])
+
+        _truncate_all_column_families()
+        original_enabled = settings.DAEDALUS_MESSAGE_TEMPLATES_ENABLED
+        try:
+            settings.DAEDALUS_MESSAGE_TEMPLATES_ENABLED = True
+            now = time.time()
+            messages = [u"Scheduling key cache save to each {0} seconds".format(num) for num in range(5)]
+            messages += [u"Initializing row cache (capacity: 10 MBs)", u"Unicode \u00e9 message 1"]
+            for num, message in enumerate(messages):
+                self.get_service().save_log(u'someapp', u'somehost', u'INFO',
+                    "{0:0.25f}".format(now - num), message)
+            storage._get_template_cache().clear()
+            result = self.get_service().query()
+            self.assertListEqual([msg['message'] for msg in result], messages)
+            self.assertEqual(self.get_service().get_by_id(result[0]['_id'])['message'], messages[0])
+
+            templates = self.get_service().list_templates()
+            self.assertEqual((templates[0]['template'], templates[0]['count']),
+                (u"Scheduling key cache save to each <*> seconds", 5))
+            self.assertSetEqual(set((item['template'], item['count']) for item in templates[1:]), set([
+                (u"Initializing row cache (capacity: <*> MBs)", 1),
+                (u"Unicode \u00e9 message <*>", 1),
+            ]))
+            self.assertEqual(templates[0]['template_id'], result[0]['template_id'])
+        finally:
+            settings.DAEDALUS_MESSAGE_TEMPLATES_ENABLED = original_enabled
+
+    def test_rebuild_indexes(self):
+        _truncate_all_column_families()
+        for message in log_dict_generator(1):
+            self.get_service().save_log(**message)
+            break
+        for cf_name, _ in StorageServiceRowPerMinute.INDEXES.values():
+            ColumnFamily(get_shared_pool(), cf_name).truncate()
+        ColumnFamily(get_shared_pool(), CF_SEARCH_INDEX).truncate()
+        self.assertEqual(len(self.get_service().query_by_host(message['host'])), 0)
+        self.assertEqual(len(self.get_service().search(u"message")), 0)
+
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(service.rebuild_indexes(), 1)
+        self.assertEqual(len(self.get_service().query_by_host(message['host'])), 1)
+        self.assertEqual(len(self.get_service().search(message['message'])), 1)
+
     def test_queries_on_empty_db(self):
         _truncate_all_column_families()
         self.get_service().query_by_severity('ERROR')
@@ -368,6 +946,100 @@ class StorageTest(StorageBaseTest):
             1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
 
 
+class SharedPoolTest(StorageBaseTest):
+
+    def test_services_share_pool(self):
+        with get_service_cm() as service:
+            pool = service._get_pool()
+        # the shared pool isn't disposed when the service is closed
+        with get_service_cm() as service:
+            self.assertTrue(service._get_pool() is pool)
+            service.query()
+        self.assertTrue(get_shared_pool() is pool)
+
+    def test_pool_per_profile(self):
+        backend_pool = get_shared_pool('backend')
+        frontend_pool = get_shared_pool('frontend')
+        self.assertFalse(backend_pool is frontend_pool)
+        self.assertTrue(get_shared_pool('backend') is backend_pool)
+        with get_service_cm(pool_profile='backend') as service:
+            self.assertTrue(service._get_pool() is backend_pool)
+        self.assertRaises(DaedalusException, get_shared_pool, 'invalid-profile')
+
+    def test_backend_profile_fails_fast(self):
+        original_hosts = settings.CASSANDRA_HOSTS
+        settings.CASSANDRA_HOSTS = ["127.0.0.1:1"]
+        try:
+            start = time.time()
+            self.assertRaises(AllServersUnavailable, storage._get_connection, profile='backend')
+            self.assertTrue(time.time() - start < 5.0)
+        finally:
+            settings.CASSANDRA_HOSTS = original_hosts
+
+    def test_pool_is_recreated_after_fork(self):
+        pool = get_shared_pool()
+        # simulate a fork()
+        storage._shared_pool_registry._pid = -1
+        new_pool = get_shared_pool()
+        self.assertFalse(new_pool is pool)
+        self.assertTrue(get_shared_pool() is new_pool)
+        pool.dispose()
+
+    def test_unhealthy_pool_is_recreated(self):
+
+        class BrokenPool(object):
+            disposed = False
+
+            def get(self):
+                raise(Exception("This pool is broken"))
+
+            def dispose(self):
+                self.disposed = True
+
+        get_shared_pool()
+        broken_pool = BrokenPool()
+        storage._shared_pool_registry._pools[(settings.KEYSPACE,
+            settings.CASSANDRA_POOL_PROFILE)] = broken_pool
+        original_interval = settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL
+        settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL = 0
+        try:
+            new_pool = get_shared_pool()
+        finally:
+            settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL = original_interval
+        self.assertFalse(new_pool is broken_pool)
+        self.assertTrue(broken_pool.disposed)
+        with get_service_cm() as service:
+            service.query()
+
+    def test_slow_health_check_doesnt_block_other_pools(self):
+
+        class SlowPool(object):
+
+            def get(self):
+                time.sleep(2)
+                raise(Exception("This pool doesn't respond"))
+
+            def dispose(self):
+                pass
+
+        get_shared_pool('backend')
+        get_shared_pool()
+        storage._shared_pool_registry._pools[(settings.KEYSPACE,
+            settings.CASSANDRA_POOL_PROFILE)] = SlowPool()
+        original_interval = settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL
+        settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL = 0
+        checking_thread = threading.Thread(target=get_shared_pool)
+        try:
+            checking_thread.start()
+            time.sleep(0.5)
+            start = time.time()
+            self.assertTrue(get_shared_pool('backend') is not None)
+            self.assertTrue(time.time() - start < 1.0)
+        finally:
+            checking_thread.join()
+            settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL = original_interval
+
+
 class BulkSave(StorageBaseTest):
     """
     Varios method to run bulk-saves on REAL keyspace (the keyspace used by the application)
@@ -388,8 +1060,8 @@ class BulkSave(StorageBaseTest):
         Saves messages on REAL keyspace until canceled.
         """
         logging.basicConfig(level=logging.INFO)
-        settings.CASSANDRA_CONNECT_RETRY_WAIT = 1
-        print "Patched value of CASSANDRA_CONNECT_RETRY_WAIT to 1"
+        settings.CASSANDRA_POOL_PROFILES[settings.CASSANDRA_POOL_PROFILE]['connect_retry_wait'] = 1
+        print "Patched value of 'connect_retry_wait' to 1"
         max_rate = os.environ.get('max_rate', None)
         if max_rate:
             _bulk_save_random_messages_to_real_keyspace(0, max_rate=float(max_rate))
@@ -401,8 +1073,8 @@ class BulkSave(StorageBaseTest):
         Saves messages on REAL keyspace, with dates from a month ago to today.
         """
         logging.basicConfig(level=logging.INFO)
-        settings.CASSANDRA_CONNECT_RETRY_WAIT = 1
-        print "Patched value of CASSANDRA_CONNECT_RETRY_WAIT to 1"
+        settings.CASSANDRA_POOL_PROFILES[settings.CASSANDRA_POOL_PROFILE]['connect_retry_wait'] = 1
+        print "Patched value of 'connect_retry_wait' to 1"
         _bulk_save_random_messages_to_real_keyspace(max_count,
             timestamp_generator=sparse_timestamp_generator(0))
 
@@ -417,8 +1089,8 @@ class BulkSave(StorageBaseTest):
         Saves messages on REAL keyspace until canceled.
         """
         logging.basicConfig(level=logging.INFO)
-        settings.CASSANDRA_CONNECT_RETRY_WAIT = 1
-        print "Patched value of CASSANDRA_CONNECT_RETRY_WAIT to 1"
+        settings.CASSANDRA_POOL_PROFILES[settings.CASSANDRA_POOL_PROFILE]['connect_retry_wait'] = 1
+        print "Patched value of 'connect_retry_wait' to 1"
 
         def callback(queue, count):
             # ret = _bulk_save_random_messages_to_real_keyspace(count)
@@ -618,6 +1290,133 @@ class MultiMessageTest(StorageBaseTest):
             self.assertEqual(multi_message['meta']['status'], final_status)
             self.assertNotEqual(last_message_received, multi_message['meta']['last_message_received'])
 
+    def test_save_multimessage_logs(self):
+        _truncate_all_column_families()
+        multi_msg_id = self.get_service().start_multimessage(**self._gen_msg("Backup started"))
+
+        messages = [self._gen_msg("Backup of database 'database{0}' finished OK".format(num))
+            for num in range(5)]
+        invalid_message = dict(messages[0], severity='INVALID')
+        self.assertRaises(DaedalusException, self.get_service().save_multimessage_logs,
+            multi_msg_id, messages + [invalid_message])
+        self.assertEqual(len(self.get_service().get_multimessage(multi_msg_id)['messages']), 1)
+
+        result = self.get_service().save_multimessage_logs(multi_msg_id, messages)
+        self.assertEqual(len(result), 5)
+        multi_message = self.get_service().get_multimessage(multi_msg_id)
+        self.assertEqual(len(multi_message['messages']), 6)
+        self.assertEqual(multi_message['meta']['status'], MULTIMSG_STATUS_OPEN)
+        self.assertEqual(multi_message['meta']['last_message_received'],
+            ','.join([result[-1][0]] + [str(i) for i in result[-1][1]]))
+        self.assertTrue(all(msg['multimessage_id'] == multi_msg_id
+            for msg in multi_message['messages']))
+
+        self.get_service().save_multimessage_logs(multi_msg_id,
+            [self._gen_msg("Step 6"), self._gen_msg("Backup finished")],
+            final_status=MULTIMSG_STATUS_FINISHED_ERROR)
+        multi_message = self.get_service().get_multimessage(multi_msg_id)
+        self.assertEqual(len(multi_message['messages']), 8)
+        self.assertEqual(multi_message['meta']['status'], MULTIMSG_STATUS_FINISHED_ERROR)
+        self.assertEqual(multi_message['meta']['finish_message'],
+            multi_message['meta']['last_message_received'])
+
+    def test_list_multimessages(self):
+        _truncate_all_column_families()
+        now = time.time()
+        ids = {}
+        for num, (host, final_status) in enumerate((
+                (u'host1', None), (u'host1', MULTIMSG_STATUS_FINISHED_OK),
+                (u'host2', None), (u'host2', MULTIMSG_STATUS_FINISHED_ERROR))):
+            message = self._gen_msg("Backup started")
+            message['host'] = host
+            message['timestamp'] = "{0:0.25f}".format(now - num * 60 * 60)
+            multi_msg_id = self.get_service().start_multimessage(**message)
+            if final_status is not None:
+                message['multimessage_id'] = multi_msg_id
+                message['final_status'] = final_status
+                self.get_service().finish_multimessage(**message)
+            ids[(host, final_status)] = multi_msg_id
+
+        def _list(**kwargs):
+            return set([item['multimessage_id'] for item in self.get_service().list_multimessages(**kwargs)])
+
+        self.assertSetEqual(_list(status=MULTIMSG_STATUS_OPEN),
+            set([ids[(u'host1', None)], ids[(u'host2', None)]]))
+        self.assertSetEqual(_list(status=MULTIMSG_STATUS_OPEN, host=u'host2'), set([ids[(u'host2', None)]]))
+        self.assertSetEqual(_list(host=u'host1'),
+            set([ids[(u'host1', None)], ids[(u'host1', MULTIMSG_STATUS_FINISHED_OK)]]))
+        self.assertSetEqual(_list(application=u'os/backup', from_timestamp=now - 90 * 60),
+            set([ids[(u'host1', None)], ids[(u'host1', MULTIMSG_STATUS_FINISHED_OK)]]))
+        self.assertSetEqual(_list(application=u'os/backup', to_timestamp=now - 150 * 60),
+            set([ids[(u'host2', MULTIMSG_STATUS_FINISHED_ERROR)]]))
+        # The range is inclusive
+        self.assertSetEqual(_list(application=u'os/backup', from_timestamp=now - 60 * 60,
+            to_timestamp=now - 60 * 60), set([ids[(u'host1', MULTIMSG_STATUS_FINISHED_OK)]]))
+        self.assertRaises(DaedalusException, self.get_service().list_multimessages)
+
+        # Pagination
+        found = []
+        from_id = None
+        while True:
+            result = self.get_service().list_multimessages(application=u'os/backup', from_id=from_id, limit=1)
+            if not result:
+                break
+            self.assertEqual(len(result), 1)
+            found.append(result[0]['multimessage_id'])
+            from_id = result[0]['multimessage_id']
+        self.assertListEqual(sorted(found), sorted(ids.values()))
+
+    def test_migrate_multimessage_timestamps(self):
+        _truncate_all_column_families()
+        start_timestamp = time.time() - 60 * 60
+        message = self._gen_msg("Backup started")
+        message['timestamp'] = "{0:0.25f}".format(start_timestamp)
+        multi_msg_id = self.get_service().start_multimessage(**message)
+        # Previous versions saved the timestamp as received
+        self.get_service()._get_cf_multi_messsagelogs().insert(multi_msg_id,
+            {'meta:timestamp': message['timestamp']})
+
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(service.migrate_multimessage_timestamps(), 1)
+            self.assertEqual(service.migrate_multimessage_timestamps(), 0)
+        self.assertEqual(self.get_service().get_multimessage(multi_msg_id)['meta']['timestamp'],
+            storage.MULTIMSG_TIMESTAMP_FORMAT.format(start_timestamp))
+        result = self.get_service().list_multimessages(status=MULTIMSG_STATUS_OPEN,
+            from_timestamp=start_timestamp - 1, to_timestamp=start_timestamp + 1)
+        self.assertListEqual([item['multimessage_id'] for item in result], [multi_msg_id])
+
+    def test_multimessage_pages(self):
+        _truncate_all_column_families()
+        start_timestamp = time.time() - 60 * 60
+        message = self._gen_msg("Backup started")
+        message['timestamp'] = "{0:0.25f}".format(start_timestamp)
+        multi_msg_id = self.get_service().start_multimessage(**message)
+        # 30 minutes, 3 messages per minute
+        for num in range(1, 91):
+            message = self._gen_msg("Backup step {0}".format(num))
+            message['timestamp'] = "{0:0.25f}".format(start_timestamp + num * 20)
+            message['multimessage_id'] = multi_msg_id
+            self.get_service().save_multimessage_log(**message)
+
+        messages = []
+        from_ref = None
+        pages = 0
+        while True:
+            multi_message = self.get_service().get_multimessage(multi_msg_id, from_ref=from_ref, limit=10)
+            self.assertEqual(multi_message['meta']['status'], MULTIMSG_STATUS_OPEN)
+            # 3 messages per minute: the pages end in the middle of the minutes
+            self.assertTrue(len(multi_message['messages']) == 10 or multi_message['next_ref'] is None)
+            messages += [msg['message'] for msg in multi_message['messages']]
+            pages += 1
+            from_ref = multi_message['next_ref']
+            if from_ref is None:
+                break
+
+        self.assertEqual(pages, 10)
+        self.assertListEqual(messages,
+            [u"Backup started"] + [u"Backup step {0}".format(num) for num in range(1, 91)])
+        self.assertEqual(len(self.get_service().get_multimessage(multi_msg_id)['messages']), 91)
+
 
 class WebBackendTest(TestCase):
 
@@ -763,6 +1562,107 @@ class WebBackendTest(TestCase):
     def test_save_100_log(self):
         self._save_random_messages_via_web(100)
 
+    def test_bulk_insert_via_web(self):
+        generator = log_dict_generator(1)
+        lines = [json.dumps(generator.next()) for _ in xrange(0, 20)]
+        invalid_message = generator.next()
+        invalid_message['host'] = u'___'
+        lines.insert(5, json.dumps(invalid_message))
+        lines.insert(10, 'this is not json')
+        body = '\n'.join(lines) + '\n'
+
+        gzipped_body = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=gzipped_body, mode='wb')
+        gzip_file.write(body)
+        gzip_file.close()
+
+        for data, extra in ((body, {}), (gzipped_body.getvalue(), {'HTTP_CONTENT_ENCODING': 'gzip'})):
+            _truncate_all_column_families()
+            respose = self.client.post('/backend/save-bulk/', data,
+                content_type='application/x-ndjson', **extra)
+            self.assertEqual(respose.status_code, 201)
+            content = json.loads(respose.content)
+            self.assertEquals(content['status'], 'ok')
+            self.assertEquals(content['accepted'], 20)
+            self.assertEquals(content['rejected'], 2)
+            self.assertEquals(len(content['results']), 22)
+            self.assertEquals([item['line'] for item in content['results'] if item['status'] == 'error'],
+                [6, 11])
+            self.assertEquals(len(get_service(cache_enabled=False).query()), 20)
+
+    def test_bulk_insert_via_web_with_failed_batch(self):
+        _truncate_all_column_families()
+        generator = log_dict_generator(1)
+        body = '\n'.join([json.dumps(generator.next()) for _ in xrange(0, 20)])
+        original_save_or_spool = backend_views._save_or_spool
+        original_batch_size = settings.DAEDALUS_SAVE_BULK_BATCH_SIZE
+        calls = []
+
+        def _failing_save_or_spool(storage_service, messages):
+            calls.append(len(messages))
+            if len(calls) == 2:
+                raise(Exception("Cassandra is down"))
+            original_save_or_spool(storage_service, messages)
+
+        backend_views._save_or_spool = _failing_save_or_spool
+        settings.DAEDALUS_SAVE_BULK_BATCH_SIZE = 5
+        try:
+            respose = self.client.post('/backend/save-bulk/', body, content_type='application/x-ndjson')
+        finally:
+            backend_views._save_or_spool = original_save_or_spool
+            settings.DAEDALUS_SAVE_BULK_BATCH_SIZE = original_batch_size
+
+        self.assertEqual(respose.status_code, 201)
+        content = json.loads(respose.content)
+        self.assertEquals(content['accepted'], 15)
+        self.assertEquals(content['rejected'], 5)
+        self.assertEquals([item['line'] for item in content['results'] if item['status'] == 'error'],
+            [6, 7, 8, 9, 10])
+        self.assertEquals(len(get_service(cache_enabled=False).query()), 15)
+
+    def test_insert_via_web_compressed(self):
+        _truncate_all_column_families()
+        body = urllib.urlencode(log_dict_generator(1).next())
+        for wbits, content_encoding in ((16 + zlib.MAX_WBITS, 'gzip'), (zlib.MAX_WBITS, 'deflate')):
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, wbits)
+            respose = self.client.post('/backend/save/', compressor.compress(body) + compressor.flush(),
+                content_type='application/x-www-form-urlencoded', HTTP_CONTENT_ENCODING=content_encoding)
+            self.assertEqual(respose.status_code, 201)
+        self.assertEquals(len(get_service(cache_enabled=False).query()), 2)
+
+        respose = self.client.post('/backend/save/', body,
+            content_type='application/x-www-form-urlencoded', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(respose.status_code, 400)
+
+    def test_insert_via_web_compressed_too_big(self):
+        _truncate_all_column_families()
+        original_max_size = backend_views.MAX_DECOMPRESSED_BODY_SIZE
+        backend_views.MAX_DECOMPRESSED_BODY_SIZE = 64 * 1024
+        try:
+            def _gzip(body):
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                return compressor.compress(body) + compressor.flush()
+
+            message = log_dict_generator(1).next()
+            line = json.dumps(message)
+            for url, body in (
+                    ('/backend/save/', urllib.urlencode(dict(message, message='x' * 100 * 1024))),
+                    ('/backend/save-bulk/', '\n'.join([line] * (100 * 1024 / len(line)))),
+                    ('/backend/save-bulk/', 'x' * 100 * 1024)):
+                respose = self.client.post(url, _gzip(body),
+                    content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip')
+                self.assertEqual(respose.status_code, 413)
+                self.assertEquals(json.loads(respose.content)['status'], 'error')
+        finally:
+            backend_views.MAX_DECOMPRESSED_BODY_SIZE = original_max_size
+
+    def test_bulk_insert_via_web_with_invalid_encoding(self):
+        respose = self.client.post('/backend/save-bulk/', 'this is not gzip',
+            content_type='application/x-ndjson', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(respose.status_code, 400)
+        content = json.loads(respose.content)
+        self.assertEquals(content['status'], 'error')
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Utility non-test methods
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -790,6 +1690,95 @@ class WebBackendTest(TestCase):
         logging.info("%d messages inserted. Avg: %f insert/sec", count, avg)
 
 
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.original_settings = (settings.DAEDALUS_SPOOL_MODE, settings.DAEDALUS_SPOOL_DIR,
+            settings.DAEDALUS_SPOOL_SEGMENT_MAX_SIZE)
+        settings.DAEDALUS_SPOOL_DIR = self.spool_dir
+        spool._spool_writer = None
+
+    def tearDown(self):
+        if spool._spool_writer is not None:
+            spool._spool_writer.close()
+            spool._spool_writer = None
+        settings.DAEDALUS_SPOOL_MODE, settings.DAEDALUS_SPOOL_DIR, \
+            settings.DAEDALUS_SPOOL_SEGMENT_MAX_SIZE = self.original_settings
+        shutil.rmtree(self.spool_dir)
+
+    def test_spool_always_via_web(self):
+        _truncate_all_column_families()
+        settings.DAEDALUS_SPOOL_MODE = 'always'
+        generator = log_dict_generator(1)
+        for _ in range(10):
+            respose = self.client.post('/backend/save/', generator.next())
+            self.assertEqual(respose.status_code, 201)
+        body = '\n'.join([json.dumps(generator.next()) for _ in range(5)])
+        respose = self.client.post('/backend/save-bulk/', body, content_type='application/x-ndjson')
+        self.assertEqual(respose.status_code, 201)
+        self.assertEqual(len(get_service(cache_enabled=False).query()), 0)
+
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(spool.drain(service), 15)
+            self.assertEqual(spool.drain(service), 0)
+        self.assertEqual(len(get_service(cache_enabled=False).query()), 15)
+
+    def test_spool_fallback(self):
+        settings.DAEDALUS_SPOOL_MODE = 'fallback'
+
+        class BrokenService(object):
+            def save_logs(self, messages):
+                raise(Exception("Cassandra is down"))
+
+        messages = [log_dict_generator(1).next()]
+        _save_or_spool(BrokenService(), messages)
+        settings.DAEDALUS_SPOOL_MODE = None
+        self.assertRaises(Exception, _save_or_spool, BrokenService(), messages)
+
+        _truncate_all_column_families()
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(spool.drain(service), 1)
+        self.assertEqual(len(get_service(cache_enabled=False).query()), 1)
+
+    def test_segments(self):
+        _truncate_all_column_families()
+        settings.DAEDALUS_SPOOL_SEGMENT_MAX_SIZE = 1024
+        writer = spool.SpoolWriter()
+        generator = log_dict_generator(1)
+        for _ in range(20):
+            writer.append([generator.next(), generator.next()])
+        self.assertTrue(len(os.listdir(self.spool_dir)) > 1)
+
+        # A partial line (being written) isn't drained
+        with open(writer._path, 'ab') as segment:
+            segment.write('{"partial": ')
+        with get_service_cm(cache_enabled=False) as service:
+            self.assertEqual(spool.drain(service), 40)
+            writer.close()
+            self.assertEqual(spool.drain(service), 0)
+        self.assertListEqual(os.listdir(self.spool_dir), [spool.DRAIN_LOCK_FILENAME])
+        self.assertEqual(len(get_service(cache_enabled=False).query()), 40)
+
+    def test_fsync_after_last_append(self):
+        original_fsync, original_interval = os.fsync, settings.DAEDALUS_SPOOL_FSYNC_INTERVAL
+        synced = []
+        writer = spool.SpoolWriter()
+        try:
+            os.fsync = lambda fd: synced.append(fd)
+            settings.DAEDALUS_SPOOL_FSYNC_INTERVAL = 0.2
+            generator = log_dict_generator(1)
+            for _ in range(5):
+                writer.append([generator.next()])
+            self.assertEqual(synced, [])
+            # The messages are synced, even when no more messages are appended
+            time.sleep(0.5)
+            self.assertEqual(synced, [writer._file.fileno()])
+        finally:
+            writer.close()
+            os.fsync, settings.DAEDALUS_SPOOL_FSYNC_INTERVAL = original_fsync, original_interval
+
+
 class TimeRelatedUtilTest(TestCase):
     """
     Tests timezone aware functions.
@@ -1087,6 +2076,65 @@ class DaedalusClientTest(LiveServerTestCase):
         all_the_msg = storage_service.query()
         self.assertEquals(len(all_the_msg), 31)
 
+    def test_failover(self):
+        _truncate_all_column_families()
+        storage_service = get_service(cache_enabled=False)
+        live_server = "{0}:{1}".format(self.server_thread.host, self.server_thread.port)
+        # Nothing listens on port 1
+        for load_balancing in (LB_LEAST_OUTSTANDING, 'round-robin'):
+            daedalus_client = DaedalusClient(servers=[live_server, '127.0.0.1:1'],
+                default_message_host='host', default_message_application='app',
+                log_client_errors=False, raise_client_exceptions=True,
+                load_balancing=load_balancing, failure_threshold=2, retry_timeout=60)
+            for _ in xrange(0, 10):
+                self.assertTrue(daedalus_client.send_message("some message", 'INFO'))
+            # The server that isn't running was ejected
+            self.assertTrue(daedalus_client._servers[1].ejected_until is not None)
+            self.assertTrue(daedalus_client._servers[0].ejected_until is None)
+            daedalus_client.close()
+        self.assertEquals(len(storage_service.query()), 20)
+
+        # All the servers are down
+        daedalus_client = DaedalusClient(servers='127.0.0.1:1,127.0.0.1:2',
+            log_client_errors=False, raise_client_exceptions=False)
+        self.assertFalse(daedalus_client.send_message("some message", 'INFO', 'host', 'app'))
+
+    def test_failover_all_servers_ejected(self):
+        # Nothing listens on ports 1 and 2
+        daedalus_client = DaedalusClient(servers='127.0.0.1:1,127.0.0.1:2',
+            default_message_host='host', default_message_application='app',
+            log_client_errors=False, raise_client_exceptions=True,
+            failure_threshold=1, retry_timeout=60)
+        self.assertRaises(socket.error, daedalus_client.send_message, "some message", 'INFO')
+        ejected_until = [server.ejected_until for server in daedalus_client._servers]
+        self.assertTrue(None not in ejected_until)
+
+        # The request fails without being sent to any server
+        try:
+            daedalus_client.send_message("some message", 'INFO')
+            self.fail("DaedalusException not raised")
+        except DaedalusException, e:
+            self.assertTrue('ejected' in str(e))
+        self.assertEquals([server.ejected_until for server in daedalus_client._servers], ejected_until)
+
+        # Once the `retry_timeout` expired, a single request is sent to the server
+        daedalus_client._servers[0].ejected_until = time.time() - 1
+        self.assertRaises(socket.error, daedalus_client.send_message, "some message", 'INFO')
+        self.assertTrue(daedalus_client._servers[0].ejected_until > time.time())
+        self.assertRaises(DaedalusException, daedalus_client.send_message, "some message", 'INFO')
+        daedalus_client.close()
+
+    def test_client_compression(self):
+        _truncate_all_column_families()
+        for compression in (COMPRESSION_GZIP, COMPRESSION_DEFLATE):
+            daedalus_client = DaedalusClient(self.server_thread.host, int(self.server_thread.port),
+                'host', 'app', raise_client_exceptions=True, compression=compression,
+                compression_min_size=0)
+            self.assertTrue(daedalus_client.send_message(u"Compressed message\n" * 100, 'INFO'))
+            body, headers = daedalus_client._compress("x" * 100, {})
+            self.assertEquals(headers['Content-Encoding'], compression)
+        self.assertEquals(len(get_service(cache_enabled=False).query()), 2)
+
     def test_clients_default_host_and_app(self):
         _truncate_all_column_families()
         storage_service = get_service(cache_enabled=False)
@@ -1168,6 +2216,55 @@ class DaedalusClientTest(LiveServerTestCase):
         pprint.pprint(get_service(cache_enabled=False).query())
         self.assertEquals(len(storage_service.query()), 0)
 
+    def test_client_reconnects(self):
+        _truncate_all_column_families()
+        storage_service = get_service(cache_enabled=False)
+
+        daedalus_client = DaedalusClient(self.server_thread.host, int(self.server_thread.port),
+            'somehost', 'someapp', raise_client_exceptions=True)
+        daedalus_client.send_message("some message", ERROR)
+
+        # Simulate an idle keep-alive connection closed by the server
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(1)
+        stale_conn = httplib.HTTPConnection(*listening_socket.getsockname())
+        stale_conn.connect()
+        server_socket, _ = listening_socket.accept()
+        server_socket.close()
+        listening_socket.close()
+        daedalus_client._servers[0].connections.put(stale_conn)
+
+        self.assertTrue(daedalus_client.send_message("some message", ERROR))
+        self.assertEquals(len(storage_service.query()), 2)
+        daedalus_client.close()
+
+    def test_client_doesnt_retry_timeouts(self):
+        _truncate_all_column_families()
+
+        # A reused connection to a server that receives the request, but never responds
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.bind(('127.0.0.1', 0))
+        listening_socket.listen(1)
+        host, port = listening_socket.getsockname()
+        daedalus_client = DaedalusClient(host, port, 'somehost', 'someapp',
+            raise_client_exceptions=True, log_client_errors=False, timeout=0.5)
+        slow_conn = httplib.HTTPConnection(host, port)
+        slow_conn.connect()
+        server_socket, _ = listening_socket.accept()
+        daedalus_client._servers[0].connections.put(slow_conn)
+
+        try:
+            self.assertRaises(socket.timeout, daedalus_client.send_message, "some message", ERROR)
+            # The request was sent only once, and wasn't retried with a new connection
+            self.assertTrue(server_socket.recv(65536).startswith("POST "))
+            listening_socket.setblocking(0)
+            self.assertRaises(socket.error, listening_socket.accept)
+        finally:
+            server_socket.close()
+            listening_socket.close()
+            daedalus_client.close()
+
     def test_custom_logger(self):
         DaedalusClient(self.server_thread.host, int(self.server_thread.port),
             custom_logger='StdOutCustomLogger')
@@ -1185,6 +2282,129 @@ class DaedalusClientTest(LiveServerTestCase):
             inspect.getsource(utc_str_timestamp_from_client))
 
 
+class BufferedDaedalusClientTest(LiveServerTestCase):
+
+    def test_client(self):
+        _truncate_all_column_families()
+        storage_service = get_service(cache_enabled=False)
+
+        daedalus_client = BufferedDaedalusClient(self.server_thread.host, int(self.server_thread.port),
+            'somehost', 'someapp', flush_size=10, flush_interval=0.1)
+        for num in xrange(0, 25):
+            self.assertTrue(daedalus_client.send_message("message {0}".format(num), ERROR))
+        # invalid severity: rejected by the server
+        daedalus_client.send_message("invalid message", 'INVALID_SEVERITY')
+        self.assertTrue(daedalus_client.flush(timeout=30))
+        daedalus_client.close()
+
+        counters = daedalus_client.get_counters()
+        self.assertEquals(counters['queued'], 26)
+        self.assertEquals(counters['sent'], 25)
+        self.assertEquals(counters['rejected'], 1)
+        self.assertEquals(counters['failed'], 0)
+        self.assertEquals(counters['dropped'], 0)
+        self.assertEquals(len(storage_service.query()), 25)
+
+        # After close(), the messages are dropped
+        self.assertFalse(daedalus_client.send_message("message", ERROR))
+        self.assertEquals(daedalus_client.get_counters()['dropped'], 1)
+
+    def test_clients_closed_at_exit(self):
+        daedalus_client = BufferedDaedalusClient(self.server_thread.host, int(self.server_thread.port),
+            'somehost', 'someapp')
+        self.assertTrue(daedalus_client in _buffered_clients)
+        daedalus_client.close()
+        self.assertFalse(daedalus_client in _buffered_clients)
+
+        # The clients not closed can be garbage collected
+        client_ref = weakref.ref(BufferedDaedalusClient(self.server_thread.host,
+            int(self.server_thread.port), 'somehost', 'someapp'))
+        gc.collect()
+        self.assertTrue(client_ref() is None)
+
+    def test_overflow_policies(self):
+        for overflow_policy, expected_messages in (
+                (OVERFLOW_DROP_OLDEST, ["message 3", "message 4", "message 5", "message 6", "message 7"]),
+                (OVERFLOW_DROP_NEWEST, ["message 0", "message 1", "message 2", "message 3", "message 4"])):
+            _truncate_all_column_families()
+            daedalus_client = BufferedDaedalusClient(self.server_thread.host, int(self.server_thread.port),
+                'somehost', 'someapp', max_queue_size=5, flush_size=100, flush_interval=60,
+                overflow_policy=overflow_policy)
+            for num in xrange(0, 8):
+                daedalus_client.send_message("message {0}".format(num), ERROR)
+            self.assertTrue(daedalus_client.flush(timeout=30))
+            daedalus_client.close()
+
+            self.assertEquals(daedalus_client.get_counters()['dropped'], 3)
+            messages = get_service(cache_enabled=False).query()
+            self.assertEquals(sorted([msg['message'] for msg in messages]), expected_messages)
+
+    def test_overflow_block_and_close(self):
+        _truncate_all_column_families()
+        daedalus_client = BufferedDaedalusClient(self.server_thread.host, int(self.server_thread.port),
+            'somehost', 'someapp', max_queue_size=1, flush_size=100, flush_interval=60,
+            overflow_policy=OVERFLOW_BLOCK)
+        self.assertTrue(daedalus_client.send_message("message 0", ERROR))
+        results = []
+        blocked_thread = threading.Thread(
+            target=lambda: results.append(daedalus_client.send_message("message 1", ERROR)))
+        blocked_thread.start()
+        time.sleep(0.5)
+        daedalus_client.close()
+        blocked_thread.join(10)
+
+        # The message of the blocked thread is dropped, not queued after close()
+        self.assertListEqual(results, [False])
+        counters = daedalus_client.get_counters()
+        self.assertEquals(counters['queued'], 1)
+        self.assertEquals(counters['sent'], 1)
+        self.assertEquals(counters['dropped'], 1)
+        messages = get_service(cache_enabled=False).query()
+        self.assertEquals([msg['message'] for msg in messages], ["message 0"])
+
+    def test_server_down(self):
+        daedalus_client = BufferedDaedalusClient(self.server_thread.host, 1,
+            'somehost', 'someapp', log_client_errors=False)
+        daedalus_client.send_message("message", ERROR)
+        self.assertTrue(daedalus_client.flush(timeout=30))
+        daedalus_client.close()
+        self.assertEquals(daedalus_client.get_counters()['failed'], 1)
+
+
+class QueuedCustomHandlerTest(LiveServerTestCase):
+
+    def test_handler(self):
+        _truncate_all_column_families()
+        handler = QueuedCustomHandler(self.server_thread.host, self.server_thread.port,
+            'somehost', 'someapp', flush_interval=0.1)
+        test_logger = logging.getLogger('daedalus.tests.queued_handler')
+        test_logger.propagate = False
+        test_logger.setLevel(logging.DEBUG)
+        test_logger.addHandler(handler)
+
+        debug_msg = "This is a DEBUG message {0}.".format(uuid.uuid4())
+        warn_msg = "This is a WARN message {0}.".format(uuid.uuid4())
+        critical_msg = "This is a CRITICAL message {0}.".format(uuid.uuid4())
+        try:
+            test_logger.debug(debug_msg)
+            test_logger.warn(warn_msg)
+            test_logger.critical(critical_msg)
+        finally:
+            test_logger.removeHandler(handler)
+            # close() sends the pending messages
+            handler.close()
+
+        result = get_service(cache_enabled=False).query()
+        self.assertEqual(dict([(msg['message'], msg['severity']) for msg in result]), {
+            debug_msg: DEBUG,
+            warn_msg: WARN,
+            critical_msg: ERROR,
+        })
+        for msg in result:
+            self.assertEqual(msg['host'], 'somehost')
+            self.assertEqual(msg['application'], 'someapp')
+
+
 class DaedalusLoggingHandlerTest(LiveServerTestCase):
 
     def _gen_dict_config(self, daedalus_host, daedalus_port,
@@ -1318,3 +2538,13 @@ class DaedalusLoggingHandlerTest(LiveServerTestCase):
         logging.error(error_msg)
 
         self._assertMessagesEquals([error_msg])
+
+    def test_close(self):
+        handler = CustomHandler(self.server_thread.host, self.server_thread.port,
+            'somehost', 'someapp')
+        handler.handle(logging.makeLogRecord({'msg': "Some message", 'levelname': 'ERROR'}))
+        connections = handler._daedalus_client._servers[0].connections
+        self.assertEqual(len(connections._idle), 1)
+        # close() closes the keep-alive connections
+        handler.close()
+        self.assertEqual(len(connections._idle), 0)
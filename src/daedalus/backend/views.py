@@ -20,13 +20,32 @@
 ##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 import json
+import logging
+import zlib
 
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, QueryDict
 from django.views.decorators.csrf import csrf_exempt
 
-from daedalus.storage import get_service_cm
+from daedalus.backend.spool import get_spool_writer
+from daedalus.storage import get_service_cm, validate_log
 from daedalus_client import DaedalusException
 
+logger = logging.getLogger(__name__)
+
+# Size of the chunks read from the body of the request in `save_bulk()`
+BULK_READ_CHUNK_SIZE = 64 * 1024
+
+# Max size of the decompressed body of the requests to `save_log()` and `save_bulk()`,
+# and of each line of the requests to `save_bulk()`
+MAX_DECOMPRESSED_BODY_SIZE = 16 * 1024 * 1024
+
+
+class _BodyTooLarge(DaedalusException):
+    """
+    Raised when the (decompressed) body of a request, or a line of it, is too big.
+    """
+
 
 def home(request):
     return HttpResponse("Daedalus here :-D")
@@ -44,17 +63,195 @@ def error_500(request):
     return HttpResponse("500: internal error")
 
 
+def _save_or_spool(storage_service, messages):
+    """
+    Saves the messages (list of dicts, already validated) using `storage_service`, or
+    appends them to the local spool, depending on `settings.DAEDALUS_SPOOL_MODE`:
+    - 'always': the messages are spooled, without contacting Cassandra.
+    - 'fallback': the messages are spooled if they couldn't be saved on Cassandra.
+    """
+    if settings.DAEDALUS_SPOOL_MODE == 'always':
+        get_spool_writer().append(messages)
+        return
+    try:
+        storage_service.save_logs(messages)
+    except DaedalusException:
+        raise
+    except:
+        if settings.DAEDALUS_SPOOL_MODE != 'fallback':
+            raise
+        logger.exception("Couldn't save %d messages on Cassandra. The messages will be spooled",
+            len(messages))
+        get_spool_writer().append(messages)
+
+
+def _get_post_data(request):
+    """
+    Returns the QueryDict with the form-encoded body of the request, decompressing
+    it if needed (see `_get_decompressor()`).
+
+    Raises:
+    - DaedalusException if the body couldn't be decompressed.
+    """
+    decompressor = _get_decompressor(request)
+    if decompressor is None:
+        return request.POST
+    try:
+        body = decompressor.decompress(request.body, MAX_DECOMPRESSED_BODY_SIZE)
+        if decompressor.unconsumed_tail:
+            raise(_BodyTooLarge("The decompressed body is too big"))
+        body += decompressor.flush()
+        if len(body) > MAX_DECOMPRESSED_BODY_SIZE:
+            raise(_BodyTooLarge("The decompressed body is too big"))
+    except zlib.error, e:
+        raise(DaedalusException("Couldn't decompress the body: {0}".format(e)))
+    return QueryDict(body, encoding=request.encoding)
+
+
 @csrf_exempt
 def save_log(request):
-    application = request.POST.get('application', None)
-    host = request.POST.get('host', None)
-    severity = request.POST.get('severity', None)
-    timestamp = request.POST.get('timestamp', None)
-    message = request.POST.get('message', None)
+    """
+    Saves a message, received as a form-encoded body. The body could be compressed
+    (using the header 'Content-Encoding: gzip' or 'Content-Encoding: deflate').
+    """
+    try:
+        post_data = _get_post_data(request)
+    except _BodyTooLarge, btl:
+        return HttpResponse(json.dumps({'status': 'error', 'error': unicode(btl.message)}), status=413)
+    except DaedalusException, de:
+        return HttpResponseBadRequest(json.dumps({'status': 'error', 'error': unicode(de.message)}))
+    application = post_data.get('application', None)
+    host = post_data.get('host', None)
+    severity = post_data.get('severity', None)
+    timestamp = post_data.get('timestamp', None)
+    message = post_data.get('message', None)
 
-    with get_service_cm() as storage_service:
+    with get_service_cm(pool_profile='backend') as storage_service:
         try:
-            storage_service.save_log(application, host, severity, timestamp, message)
+            validate_log(application, host, severity, timestamp, message)
+            _save_or_spool(storage_service, [{
+                'application': application,
+                'host': host,
+                'severity': severity,
+                'timestamp': timestamp,
+                'message': message,
+            }])
         except DaedalusException, de:
             return HttpResponseBadRequest(json.dumps({'status': 'error', 'error': unicode(de.message)}))
     return HttpResponse(json.dumps({'status': 'ok'}), status=201)
+
+
+def _get_decompressor(request):
+    """
+    Returns a zlib decompress object for the Content-Encoding of the
+    request, or None if the body isn't compressed.
+    """
+    content_encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if content_encoding in ('', 'identity'):
+        return None
+    if content_encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        return zlib.decompressobj()
+    raise(DaedalusException("Unsupported Content-Encoding: '{0}'".format(content_encoding)))
+
+
+def _iter_body_lines(request):
+    """
+    Generator. Reads the body of the request in chunks (decompressing it if needed)
+    and returns it line by line, without the line terminator.
+
+    Raises:
+    - _BodyTooLarge if the decompressed body, or a line, is bigger than MAX_DECOMPRESSED_BODY_SIZE.
+    """
+    decompressor = _get_decompressor(request)
+    decompressed_size = 0
+    pending = ''
+    while True:
+        chunk = request.read(BULK_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decompressor is not None:
+            # max_length == 0 means 'no limit', so at least 1 byte is requested
+            chunk = decompressor.decompress(chunk, MAX_DECOMPRESSED_BODY_SIZE - decompressed_size + 1)
+            decompressed_size += len(chunk)
+            if decompressor.unconsumed_tail or decompressed_size > MAX_DECOMPRESSED_BODY_SIZE:
+                raise(_BodyTooLarge("The decompressed body is too big"))
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        if len(pending) > MAX_DECOMPRESSED_BODY_SIZE:
+            raise(_BodyTooLarge("Line too long"))
+        for line in lines:
+            yield line
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if decompressed_size + len(chunk) > MAX_DECOMPRESSED_BODY_SIZE:
+            raise(_BodyTooLarge("The decompressed body is too big"))
+        pending += chunk
+    for line in pending.split('\n'):
+        yield line
+
+
+@csrf_exempt
+def save_bulk(request):
+    """
+    Saves many messages, received as newline-delimited JSON (one JSON object
+    per line, with the same fields used by `save_log()`). The body could be
+    compressed (using the header 'Content-Encoding: gzip' or 'Content-Encoding: deflate').
+
+    Valid messages are saved (or spooled, see `_save_or_spool()`) in batches
+    of `DAEDALUS_SAVE_BULK_BATCH_SIZE`. If a batch can't be saved, only the
+    lines of that batch are rejected.
+    The response includes the result of each (non empty) line, so the client
+    can retry only the rejected ones.
+    """
+    results = []
+    batch = []
+    batch_results = []
+    counts = {'accepted': 0}
+
+    def _save_batch():
+        try:
+            _save_or_spool(storage_service, batch)
+            counts['accepted'] += len(batch)
+        except Exception, e:
+            logger.exception("Couldn't save a batch of %d messages", len(batch))
+            for result in batch_results:
+                result['status'] = 'error'
+                result['error'] = u"Couldn't save the message: {0}".format(unicode(e))
+        del batch[:]
+        del batch_results[:]
+
+    with get_service_cm(pool_profile='backend') as storage_service:
+        try:
+            for line_num, line in enumerate(_iter_body_lines(request), 1):
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise(DaedalusException("Each line must be a JSON object"))
+                    validate_log(message.get('application'), message.get('host'),
+                        message.get('severity'), message.get('timestamp'), message.get('message'))
+                except (DaedalusException, ValueError), e:
+                    results.append({'line': line_num, 'status': 'error', 'error': unicode(e)})
+                    continue
+                batch.append(message)
+                results.append({'line': line_num, 'status': 'ok'})
+                batch_results.append(results[-1])
+                if len(batch) >= settings.DAEDALUS_SAVE_BULK_BATCH_SIZE:
+                    _save_batch()
+            if batch:
+                _save_batch()
+        except _BodyTooLarge, btl:
+            return HttpResponse(json.dumps({'status': 'error', 'error': unicode(btl.message),
+                'results': results}), status=413)
+        except (DaedalusException, zlib.error), e:
+            return HttpResponseBadRequest(json.dumps({'status': 'error', 'error': unicode(e)}))
+
+    return HttpResponse(json.dumps({
+        'status': 'ok',
+        'accepted': counts['accepted'],
+        'rejected': len(results) - counts['accepted'],
+        'results': results,
+    }), status=201)
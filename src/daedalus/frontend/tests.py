@@ -51,6 +51,11 @@ class WebFrontendTest(TestCase):
         response = self.client.get(reverse(views.home))
         self.assertTemplateUsed(response, 'daedalus/frontend/index.html')
 
+        for query_string in ('?start=2012-01-01+00:00', '?end=2030-01-01+10:30',
+                '?start=2012-01-01+00:00&end=2030-01-01+10:30', '?start=xxx'):
+            response = self.client.get(reverse(views.home) + query_string)
+            self.assertTemplateUsed(response, 'daedalus/frontend/index.html')
+
         for severity in ('ERROR', 'WARN', 'INFO', 'DEBUG'):
             logger.info("Testing search by severity: '%s'", severity)
             response = self.client.get(reverse(views.search_by_severity, args=[severity]))
@@ -61,6 +66,21 @@ class WebFrontendTest(TestCase):
             response = self.client.get(reverse(views.search_by_application, args=[app]))
             self.assertTemplateUsed(response, 'daedalus/frontend/index.html')
 
+        for query_string in ('?q=error', '?q=user+account', '?q=', '?q=%21%21'):
+            response = self.client.get(reverse(views.search) + query_string)
+            self.assertTemplateUsed(response, 'daedalus/frontend/index.html')
+
+        for query_string in ('', '?status=FINISHED_OK&application=intranet',
+                '?status=&host=webserver1&start=2012-01-01+00:00', '?status=', '?status=xxx'):
+            response = self.client.get(reverse(views.list_multimessages) + query_string)
+            self.assertTemplateUsed(response, 'daedalus/frontend/multi_message_list.html')
+
+        for chart_type in ('6hs', '24hs', '48hs', '7d'):
+            for query_string in ('', '?breakdown=severity', '?breakdown=host&severity=ERROR',
+                    '?breakdown=application', '?breakdown=xxx'):
+                response = self.client.get(reverse(views.charts, args=[chart_type]) + query_string)
+                self.assertTemplateUsed(response, 'daedalus/frontend/charts.html')
+
     def repeated_test(self):
         logging.basicConfig(level=logging.INFO)
         while True:
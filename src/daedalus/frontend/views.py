@@ -19,76 +19,122 @@
 ##    along with daedalus; see the file LICENSE.txt.
 ##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+import calendar
 import json
 import logging
+import time
+import urllib
 
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 from django.core.cache import cache
 
-from daedalus.storage import get_service_cm
+from daedalus.storage import get_service_cm, Projection, SEVERITIES, \
+    MULTIMSG_STATUS_OPEN, MULTIMSG_STATUSES
 from django.core.urlresolvers import reverse
 
 logger = logging.getLogger(__name__)
 
+# Keys of the messages used to render the list of messages (the full
+# message is loaded with `get_message_detail()`)
+LIST_PROJECTION = Projection(('_id', 'timestamp', 'host', 'application', 'severity',
+    'multimessage_id', 'message'), message_max_length=500)
 
-def _ctx(**kwargs):
+# Format of the dates used to filter the messages (in UTC)
+DATETIME_FILTER_FORMAT = '%Y-%m-%d %H:%M'
+
+# Valid values for the breakdown of the charts
+CHARTS_BREAKDOWNS = ('severity', 'host', 'application', )
+
+
+def _ctx(service, **kwargs):
     """
     Generates a context instance for rendering the Django view.
     """
     ctx = dict(kwargs)
     ctx['render_messages'] = []
-    with get_service_cm() as service:
-        try:
-            ctx['app_list'] = service.list_applications()
-        except:
-            ctx['render_messages'].append("Error detected while trying to get application list")
-            logger.exception(ctx['render_messages'][-1])
-    
-        try:
-            ctx['host_list'] = service.list_hosts()
-        except:
-            ctx['render_messages'].append("Error detected while trying to get host list")
-            logger.exception(ctx['render_messages'][-1])
-    
-        try:
-            ctx['error_count'] = service.get_error_count()
-        except:
-            ctx['error_count'] = '?'
-            ctx['render_messages'].append("Error detected while trying to get the count of ERRORs")
-            logger.exception(ctx['render_messages'][-1])
-    
-        try:
-            ctx['warn_count'] = service.get_warn_count()
-        except:
-            ctx['warn_count'] = '?'
-            ctx['render_messages'].append("Error detected while trying to get the count of WARNs")
-            logger.exception(ctx['render_messages'][-1])
-    
-        try:
-            ctx['info_count'] = service.get_info_count()
-        except:
-            ctx['info_count'] = '?'
-            ctx['render_messages'].append("Error detected while trying to get the count of INFOs")
-            logger.exception(ctx['render_messages'][-1])
-    
-        try:
-            ctx['debug_count'] = service.get_debug_count()
-        except:
-            ctx['debug_count'] = '?'
-            ctx['render_messages'].append("Error detected while trying to get the count of DEBUGs")
-            logger.exception(ctx['render_messages'][-1])
+    try:
+        ctx['app_list'] = service.list_applications()
+    except:
+        ctx['render_messages'].append("Error detected while trying to get application list")
+        logger.exception(ctx['render_messages'][-1])
+
+    try:
+        ctx['host_list'] = service.list_hosts()
+    except:
+        ctx['render_messages'].append("Error detected while trying to get host list")
+        logger.exception(ctx['render_messages'][-1])
+
+    try:
+        ctx['error_count'] = service.get_error_count()
+    except:
+        ctx['error_count'] = '?'
+        ctx['render_messages'].append("Error detected while trying to get the count of ERRORs")
+        logger.exception(ctx['render_messages'][-1])
+
+    try:
+        ctx['warn_count'] = service.get_warn_count()
+    except:
+        ctx['warn_count'] = '?'
+        ctx['render_messages'].append("Error detected while trying to get the count of WARNs")
+        logger.exception(ctx['render_messages'][-1])
+
+    try:
+        ctx['info_count'] = service.get_info_count()
+    except:
+        ctx['info_count'] = '?'
+        ctx['render_messages'].append("Error detected while trying to get the count of INFOs")
+        logger.exception(ctx['render_messages'][-1])
+
+    try:
+        ctx['debug_count'] = service.get_debug_count()
+    except:
+        ctx['debug_count'] = '?'
+        ctx['render_messages'].append("Error detected while trying to get the count of DEBUGs")
+        logger.exception(ctx['render_messages'][-1])
 
     return ctx
 
 
+def _parse_datetime_filter(value):
+    """
+    Returns the timestamp (seconds from epoch) of a date formatted with DATETIME_FILTER_FORMAT
+    (in UTC), or None if `value` is empty.
+
+    Raises:
+    - ValueError if the value isn't valid.
+    """
+    value = (value or '').strip()
+    if not value:
+        return None
+    return calendar.timegm(time.strptime(value, DATETIME_FILTER_FORMAT))
+
+
 def home(request):
-    ctx = _ctx()
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service)
         from_col = service.str_to_column_key(request.GET.get('from', None))
+        ctx['show_date_filter'] = True
+        ctx['filter_start'] = request.GET.get('start', '')
+        ctx['filter_end'] = request.GET.get('end', '')
         try:
-            ctx['result'] = service.query(from_col=from_col)
+            start_ts = _parse_datetime_filter(ctx['filter_start'])
+            end_ts = _parse_datetime_filter(ctx['filter_end'])
+        except ValueError:
+            start_ts = end_ts = None
+            ctx['render_messages'].append("Invalid date: use the format 'YYYY-MM-DD HH:MM' (UTC)")
+        try:
+            if start_ts is None and end_ts is None:
+                ctx['result'] = service.query(from_col=from_col, projection=LIST_PROJECTION)
+            else:
+                # The minute of `end_ts` is included
+                if end_ts is not None:
+                    end_ts += 59.999999
+                ctx['result'] = service.query_range(start_ts, end_ts, from_col=from_col,
+                    projection=LIST_PROJECTION)
+                ctx['pagination_query_string'] = '&' + urllib.urlencode((
+                    ('start', ctx['filter_start']), ('end', ctx['filter_end']), ))
             if ctx['result']:
                 ctx['last_message_id'] = ctx['result'][-1]['_id']
         except:
@@ -99,8 +145,8 @@ def home(request):
 
 
 def show_message(request, message_id):
-    ctx = _ctx()
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service)
         message = service.get_by_id(message_id)
     if message is None:
         return HttpResponseNotFound("Message with ID '{0}' was not found".format(message_id))
@@ -110,51 +156,74 @@ def show_message(request, message_id):
 
 
 def search_by_severity(request, severity):
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
         from_col = service.str_to_column_key(request.GET.get('from', None))
-        result = service.query_by_severity(severity, from_col=from_col)
-    if result:
-        last_message_id = result[-1]['_id']
-    else:
-        last_message_id = None
-    ctx = _ctx(result=result, last_message_id=last_message_id,
-        top_message="Showing only '{0}' messages.".format(severity))
+        result = service.query_by_severity(severity, from_col=from_col,
+            projection=LIST_PROJECTION)
+        if result:
+            last_message_id = result[-1]['_id']
+        else:
+            last_message_id = None
+        ctx = _ctx(service, result=result, last_message_id=last_message_id,
+            top_message="Showing only '{0}' messages.".format(severity))
     return HttpResponse(render_to_response('daedalus/frontend/index.html',
         context_instance=RequestContext(request, ctx)))
 
 
 def search_by_application(request, application):
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
         from_col = service.str_to_column_key(request.GET.get('from', None))
-        result = service.query_by_application(application, from_col=from_col)
-    if result:
-        last_message_id = result[-1]['_id']
-    else:
-        last_message_id = None
-    ctx = _ctx(result=result, last_message_id=last_message_id,
-        top_message="Showing only messages of application '{0}'.".format(application))
+        result = service.query_by_application(application, from_col=from_col,
+            projection=LIST_PROJECTION)
+        if result:
+            last_message_id = result[-1]['_id']
+        else:
+            last_message_id = None
+        ctx = _ctx(service, result=result, last_message_id=last_message_id,
+            top_message="Showing only messages of application '{0}'.".format(application))
     return HttpResponse(render_to_response('daedalus/frontend/index.html',
         context_instance=RequestContext(request, ctx)))
 
 
 def search_by_host(request, host):
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
+        from_col = service.str_to_column_key(request.GET.get('from', None))
+        result = service.query_by_host(host, from_col=from_col,
+            projection=LIST_PROJECTION)
+        if result:
+            last_message_id = result[-1]['_id']
+        else:
+            last_message_id = None
+        ctx = _ctx(service, result=result, last_message_id=last_message_id,
+            top_message="Showing only messages from host '{0}'.".format(host))
+    return HttpResponse(render_to_response('daedalus/frontend/index.html',
+        context_instance=RequestContext(request, ctx)))
+
+
+def search(request):
+    search_text = request.GET.get('q', '').strip()
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service, search_text=search_text)
         from_col = service.str_to_column_key(request.GET.get('from', None))
-        result = service.query_by_host(host, from_col=from_col)
-    if result:
-        last_message_id = result[-1]['_id']
-    else:
-        last_message_id = None
-    ctx = _ctx(result=result, last_message_id=last_message_id,
-        top_message="Showing only messages from host '{0}'.".format(host))
+        try:
+            ctx['result'] = service.search(search_text, from_col=from_col,
+                projection=LIST_PROJECTION)
+            if ctx['result']:
+                ctx['last_message_id'] = ctx['result'][-1]['_id']
+        except:
+            ctx['render_messages'].append("Error detected while executing search()")
+            logger.exception(ctx['render_messages'][-1])
+        ctx['top_message'] = u"Showing only messages containing '{0}'.".format(search_text)
+        ctx['pagination_query_string'] = '&' + urllib.urlencode((
+            ('q', search_text.encode('utf-8')), ))
     return HttpResponse(render_to_response('daedalus/frontend/index.html',
         context_instance=RequestContext(request, ctx)))
 
 
 def status(request):
     status_list = []
-    ctx = _ctx(status_list=status_list)
-    with get_service_cm(cache_enabled=False) as service:
+    with get_service_cm(cache_enabled=False, pool_profile='frontend') as service:
+        ctx = _ctx(service, status_list=status_list)
         storage_status = service.get_status()
     for key in sorted(storage_status.keys()):
         status_list.append((key, storage_status[key]))
@@ -163,28 +232,42 @@ def status(request):
 
 
 def get_message_detail(request, message_id):
-    with get_service_cm() as service:
+    with get_service_cm(pool_profile='frontend') as service:
         obj = service.get_by_id(message_id)
     return HttpResponse(json.dumps(obj), mimetype='application/json')
 
 
 def charts(request, chart_type=None):
-    ctx = _ctx()
-    with get_service_cm() as service:
+    breakdown = request.GET.get('breakdown', None)
+    if breakdown not in CHARTS_BREAKDOWNS:
+        breakdown = None
+    severity = request.GET.get('severity', None)
+    if severity not in SEVERITIES or breakdown == 'severity':
+        severity = None
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service)
         if chart_type == '24hs':
-            charts_data = service.generate_24hs_charts_data()
+            charts_data = service.generate_24hs_charts_data(breakdown, severity)
             chart_id = '24hs'
         elif chart_type == '48hs':
-            charts_data = service.generate_48hs_charts_data()
+            charts_data = service.generate_48hs_charts_data(breakdown, severity)
             chart_id = '48hs'
         elif chart_type == '7d':
-            charts_data = service.generate_7d_charts_data()
+            charts_data = service.generate_7d_charts_data(breakdown, severity)
             chart_id = '7d'
         else:
-            charts_data = service.generate_6hs_charts_data()
+            charts_data = service.generate_6hs_charts_data(breakdown, severity)
             chart_id = '6hs'
     ctx['charts_data'] = charts_data
     ctx['chart_id'] = chart_id
+    ctx['breakdown'] = breakdown
+    ctx['severity'] = severity
+    if breakdown is not None and charts_data:
+        ctx['charts_series'] = [value for value, _ in charts_data[0][3]]
+    query_string = [(key, value) for key, value in (('breakdown', breakdown), ('severity', severity))
+        if value is not None]
+    if query_string:
+        ctx['charts_query_string'] = '?' + urllib.urlencode(query_string)
     return HttpResponse(render_to_response('daedalus/frontend/charts.html',
         context_instance=RequestContext(request, ctx)))
 
@@ -195,11 +278,60 @@ def reset_cache(request):
 
 
 def show_multimessage(request, multimessage_id):
-    ctx = _ctx()
-    with get_service_cm() as service:
-        multimessage = service.get_multimessage(multimessage_id)
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service)
+        multimessage = service.get_multimessage(multimessage_id,
+            from_ref=request.GET.get('from', None))
     if multimessage is None:
         return HttpResponseNotFound("MultiMessage with ID '{0}' was not found".format(multimessage_id))
     ctx['multimessage'] = multimessage
     return HttpResponse(render_to_response('daedalus/frontend/multi_message_show.html',
         context_instance=RequestContext(request, ctx)))
+
+
+def list_multimessages(request):
+    """
+    Lists the multi-messages with the status, application and/or host passed as GET
+    parameters, started between 'start' and 'end'. By default lists the OPEN multi-messages.
+    """
+    filter_status = request.GET.get('status', MULTIMSG_STATUS_OPEN)
+    filter_application = request.GET.get('application', '')
+    filter_host = request.GET.get('host', '')
+    with get_service_cm(pool_profile='frontend') as service:
+        ctx = _ctx(service)
+        ctx['statuses'] = MULTIMSG_STATUSES
+        ctx['filter_status'] = filter_status
+        ctx['filter_application'] = filter_application
+        ctx['filter_host'] = filter_host
+        ctx['filter_start'] = request.GET.get('start', '')
+        ctx['filter_end'] = request.GET.get('end', '')
+        ctx['pagination_query_string'] = '&' + urllib.urlencode((
+            ('status', filter_status), ('application', filter_application),
+            ('host', filter_host), ('start', ctx['filter_start']), ('end', ctx['filter_end']), ))
+        try:
+            start_ts = _parse_datetime_filter(ctx['filter_start'])
+            end_ts = _parse_datetime_filter(ctx['filter_end'])
+        except ValueError:
+            start_ts = end_ts = None
+            ctx['render_messages'].append("Invalid date: use the format 'YYYY-MM-DD HH:MM' (UTC)")
+        # The minute of `end_ts` is included
+        if end_ts is not None:
+            end_ts += 59.999999
+
+        if filter_status and not filter_status in MULTIMSG_STATUSES:
+            ctx['render_messages'].append("Invalid status: '{0}'".format(filter_status))
+        elif not (filter_status or filter_application or filter_host):
+            ctx['render_messages'].append("Select a status, application or host")
+        else:
+            try:
+                ctx['result'] = service.list_multimessages(status=filter_status,
+                    application=filter_application, host=filter_host,
+                    from_timestamp=start_ts, to_timestamp=end_ts,
+                    from_id=request.GET.get('from', None))
+                if ctx['result']:
+                    ctx['last_multimessage_id'] = ctx['result'][-1]['multimessage_id']
+            except:
+                ctx['render_messages'].append("Error detected while executing list_multimessages()")
+                logger.exception(ctx['render_messages'][-1])
+    return HttpResponse(render_to_response('daedalus/frontend/multi_message_list.html',
+        context_instance=RequestContext(request, ctx)))
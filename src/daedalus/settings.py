@@ -47,11 +47,40 @@ KEYSPACE = KEYSPACE_REAL
 
 CASSANDRA_HOSTS = ["127.0.0.1"]
 
-CASSANDRA_CONNECT_RETRY_COUNT = 300
+# CASSANDRA_POOL_PROFILES: parameters of the connection pools, by profile:
+# - timeout: timeout (seconds) of each operation
+# - max_retries: times a failed operation is retried by the pool
+# - pool_timeout: seconds to wait for a free connection of the pool
+# - connect_retry_count: attempts to create the pool while all the servers are unavailable
+# - connect_retry_wait / connect_retry_max_wait: initial and max wait (seconds) between
+#   those attempts (the wait is doubled on each attempt, and a random jitter is applied)
+# The 'backend' profile fails fast (the clients can re-send the messages), while the
+# 'frontend' profile waits more before showing an error.
+CASSANDRA_POOL_PROFILES = {
+    'backend': {
+        'timeout': 0.5,
+        'max_retries': 1,
+        'pool_timeout': 0.5,
+        'connect_retry_count': 3,
+        'connect_retry_wait': 0.05,
+        'connect_retry_max_wait': 0.5,
+    },
+    'frontend': {
+        'timeout': 5.0,
+        'max_retries': 5,
+        'pool_timeout': 10.0,
+        'connect_retry_count': 20,
+        'connect_retry_wait': 0.2,
+        'connect_retry_max_wait': 5.0,
+    },
+}
 
-CASSANDRA_CONNECT_RETRY_WAIT = 0.2
+# CASSANDRA_POOL_PROFILE: profile used by default. The views of the backend and the frontend
+# use its own profile, so this is used by the management commands, tests, etc.
+CASSANDRA_POOL_PROFILE = 'backend' if DAEDALUS_ENABLED_SUBSYSTEMS == 'backend' else 'frontend'
 
-CASSANDRA_CONNECTION_POOL_TIMEOUT = 2.0
+# DAEDALUS_SHARED_POOL_CHECK_INTERVAL: seconds between health checks of the shared connection pool
+DAEDALUS_SHARED_POOL_CHECK_INTERVAL = 30
 
 DAEDALUS_CACHE_SEVERITY_COUNT = 30
 
@@ -62,6 +91,77 @@ DAEDALUS_CACHE_CF_LOGS_KEYS = 20
 
 DAEDALUS_FORCE_SERVING_STATIC_FILES = False
 
+# DAEDALUS_MUTATOR_QUEUE_SIZE: how many mutations to queue before sending a batch to Cassandra
+DAEDALUS_MUTATOR_QUEUE_SIZE = 100
+
+# DAEDALUS_SAVE_BULK_BATCH_SIZE: how many messages received by '/backend/save-bulk/' to save on each batch
+DAEDALUS_SAVE_BULK_BATCH_SIZE = 500
+
+# DAEDALUS_QUERY_READ_AHEAD: how many rows (minutes) to read with each multiget while paginating messages
+DAEDALUS_QUERY_READ_AHEAD = 10
+
+# DAEDALUS_SEARCH_INDEX_ENABLED: if the messages are added to the full-text search index when saved
+DAEDALUS_SEARCH_INDEX_ENABLED = True
+
+# DAEDALUS_SEARCH_MAX_TOKENS_PER_MESSAGE: how many tokens of each message to add to the full-text search index
+DAEDALUS_SEARCH_MAX_TOKENS_PER_MESSAGE = 200
+
+# DAEDALUS_SEARCH_CHUNK_SIZE: how many references to read on each step of the intersection of posting lists
+DAEDALUS_SEARCH_CHUNK_SIZE = 500
+
+# DAEDALUS_LOG_VALUE_FORMAT: format of the messages saved on Cassandra: 'compact' (binary,
+# the fields present on the column key aren't repeated) or 'json' (readable by previous
+# versions, useful while upgrading). Messages in both formats can be read.
+DAEDALUS_LOG_VALUE_FORMAT = 'compact'
+
+# DAEDALUS_LOG_VALUE_COMPRESSION_MIN_SIZE: messages of this size (in bytes) or longer are
+# compressed with zlib when saved with the 'compact' format (None: never compress)
+DAEDALUS_LOG_VALUE_COMPRESSION_MIN_SIZE = 512
+
+# DAEDALUS_MESSAGE_TEMPLATES_ENABLED: if the messages are saved as a template (saved once on
+# the CF 'MessageTemplates') plus the parameters (the numbers found in the message). Used only
+# with the 'compact' format. Allows counting the messages by template.
+DAEDALUS_MESSAGE_TEMPLATES_ENABLED = False
+
+# DAEDALUS_MESSAGE_TEMPLATE_MAX_LENGTH: longer messages are saved without template
+DAEDALUS_MESSAGE_TEMPLATE_MAX_LENGTH = 1024
+
+# DAEDALUS_MESSAGE_TEMPLATE_CACHE_SIZE: how many templates to keep in memory (per process)
+DAEDALUS_MESSAGE_TEMPLATE_CACHE_SIZE = 10000
+
+# DAEDALUS_MULTIMESSAGE_PAGE_SIZE: how many messages of a multi-message to show on each page
+DAEDALUS_MULTIMESSAGE_PAGE_SIZE = 500
+
+# DAEDALUS_RETENTION_DEFAULT_DAYS: days to keep the messages (None: keep them forever)
+DAEDALUS_RETENTION_DEFAULT_DAYS = None
+
+# DAEDALUS_RETENTION_POLICIES: list of (application, severity, days) overriding the default
+# retention. The first matching policy is used, and None matches any application or severity.
+# Ex: ((None, 'DEBUG', 2), ('intranet', None, 30), )
+DAEDALUS_RETENTION_POLICIES = ()
+
+# DAEDALUS_SPOOL_MODE: how the backend uses the local spool (see daedalus.backend.spool):
+# - None: the spool isn't used
+# - 'fallback': the messages are spooled only when they couldn't be saved on Cassandra
+# - 'always': the messages are always spooled, and saved on Cassandra by `drain_spool`
+# The spooled messages are saved on Cassandra by the management command `drain_spool`.
+DAEDALUS_SPOOL_MODE = None
+
+# DAEDALUS_SPOOL_DIR: directory of the segments of the spool
+DAEDALUS_SPOOL_DIR = join(DAEDALUS_DIR, 'daedalus-spool')
+
+# DAEDALUS_SPOOL_SEGMENT_MAX_SIZE: bytes to write on a segment of the spool before closing it
+DAEDALUS_SPOOL_SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+
+# DAEDALUS_SPOOL_SEGMENT_MAX_AGE: seconds to write on a segment of the spool before closing it
+DAEDALUS_SPOOL_SEGMENT_MAX_AGE = 60
+
+# DAEDALUS_SPOOL_FSYNC_INTERVAL: min seconds between fsync() of the spool (0: after each write)
+DAEDALUS_SPOOL_FSYNC_INTERVAL = 0.2
+
+# DAEDALUS_SPOOL_DRAIN_INTERVAL: seconds between runs of `drain_spool --loop`
+DAEDALUS_SPOOL_DRAIN_INTERVAL = 1.0
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Django settings
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -19,26 +19,37 @@
 ##    along with daedalus; see the file LICENSE.txt.
 ##-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+import calendar
+import collections
 import contextlib
+import hashlib
+import itertools
 import json
 import logging
+import os
+import random
 import re
+import struct
+import threading
 import time
 import uuid
+import zlib
 
 from django.conf import settings
 from django.core.cache import cache
 from pycassa import ConnectionPool, ColumnFamily
-from pycassa.system_manager import SystemManager, SIMPLE_STRATEGY, UTF8_TYPE
+from pycassa.system_manager import SystemManager, SIMPLE_STRATEGY, UTF8_TYPE, \
+    COUNTER_COLUMN_TYPE
 from pycassa.types import TimeUUIDType, CompositeType, UTF8Type, IntegerType
 from pycassa.batch import Mutator
+from pycassa.index import create_index_expression, create_index_clause, GTE, LTE
 from pycassa.pool import AllServersUnavailable
 from pycassa.util import convert_time_to_uuid
 from pycassa.cassandra.ttypes import NotFoundException
 
 from daedalus.utils import ymd_from_uuid1, ymd_from_epoch,\
     utc_timestamp2datetime, time_series_generator, \
-    ymdhm_from_uuid1
+    ymdhm_from_uuid1, ymdhm_int_from_timestamp
 from daedalus_client import DaedalusException
 
 logger = logging.getLogger(__name__)
@@ -58,13 +69,99 @@ CF_LOGS_BY_SEVERITY = 'Logs_by_severity'
 CF_METADATA = 'Metadata'
 CF_TIMESTAMP_BITMAP = 'TimestampBitmap'
 CF_MULTI_MESSAGELOGS = 'MultiMessageLogs'
+CF_INDEX_BY_HOST = 'IndexByHost'
+CF_INDEX_BY_APPLICATION = 'IndexByApplication'
+CF_INDEX_BY_SEVERITY = 'IndexBySeverity'
+CF_COUNTERS = 'Counters'
+CF_ROLLUPS = 'Rollups'
+CF_SEARCH_INDEX = 'SearchIndex'
+CF_MESSAGE_TEMPLATES = 'MessageTemplates'
+
+# Rows of CF_TIMESTAMP_BITMAP:
+# - TIMESTAMP_BITMAP_DAYS_ROW: index of days (int: yyyymmdd) with messages
+# - TIMESTAMP_BITMAP_DAY_ROW_PREFIX + yyyymmdd: minutes (int: yyyymmddhhmm) of that day with messages
+# - TIMESTAMP_BITMAP_LEGACY_ROW: all the minutes, used in previous versions (see migrate_timestamp_bitmap())
+TIMESTAMP_BITMAP_DAYS_ROW = 'timestamp_bitmap_days'
+TIMESTAMP_BITMAP_DAY_ROW_PREFIX = 'timestamp_bitmap:'
+TIMESTAMP_BITMAP_LEGACY_ROW = 'timestamp_bitmap'
+
+# Rows of CF_COUNTERS:
+# - COUNTERS_TOTAL_ROW: counts of all the messages
+# - COUNTERS_DAY_ROW_PREFIX + yyyymmdd: counts of the messages of that day
+# The columns are: 'all', 'severity:<severity>', 'application:<application>', 'host:<host>'
+# and COUNTERS_TEMPLATE_PREFIX + template_id (only for the messages saved using a template)
+COUNTERS_TOTAL_ROW = 'total'
+COUNTERS_DAY_ROW_PREFIX = 'day:'
+COUNTERS_TEMPLATE_PREFIX = 'template:'
+
+# Granularities (in seconds) of the counts of messages kept on CF_ROLLUPS. The rows are
+# 'rollup:<granularity>:<series>:<yyyymmdd>' (or '<yyyy>' for the daily counts), and the
+# columns are the start of each bucket (int: seconds from epoch, UTC).
+# The series are 'all', 'severity:<severity>', 'application:<application>', 'host:<host>',
+# 'application:<application>:severity:<severity>' and 'host:<host>:severity:<severity>'.
+ROLLUP_GRANULARITIES = (60, 60 * 5, 60 * 20, 60 * 60, 60 * 60 * 24, )
+ROLLUP_SERIES_ALL = 'all'
+
+# Tokens of the full-text search index: sequences of lower case ASCII letters, digits and
+# underscores. The rows of CF_SEARCH_INDEX are '<token>:<yyyymmdd>' and the columns are the
+# column keys of CF_LOGS, like the other index CFs.
+SEARCH_TOKEN_REGEX = re.compile(r'[a-z0-9_]+')
+SEARCH_TOKEN_MIN_LENGTH = 2
+SEARCH_TOKEN_MAX_LENGTH = 64
 
 SECONDS_IN_DAY = 60 * 60 * 24
 
+# Row of CF_METADATA with the days (int: yyyymmdd, in UTC) with rows on CF_ROLLUPS
+ROLLUP_DAYS_ROW = 'rollup_days'
+
+# Row of CF_METADATA with the time (seconds from epoch) of the last run of `prune_expired()`,
+# on the column PRUNE_CHECKPOINT_LAST_RUN
+PRUNE_CHECKPOINT_ROW = 'prune_checkpoint'
+PRUNE_CHECKPOINT_LAST_RUN = 'last_run'
+
+# Rows of CF_METADATA with the tokens of the search index of each day (the rows are
+# SEARCH_TOKENS_DAY_ROW_PREFIX + yyyymmdd, and the columns are the tokens), so
+# `prune_expired()` can remove the expired days of the 'index_days:search:<token>' rows
+SEARCH_TOKENS_DAY_ROW_PREFIX = 'search_tokens:'
+
+# Values of CF_LOGS: the messages saved with previous versions are JSON encoded dicts
+# (starting with '{'). The compact format starts with LOG_VALUE_VERSION_COMPACT, followed by
+# a byte with the LOG_VALUE_FLAG_* flags, the timestamp (double), the multimessage_id (if
+# LOG_VALUE_FLAG_MULTIMESSAGE, prefixed by its length as unsigned short) and the UTF-8 encoded
+# message (compressed with zlib if LOG_VALUE_FLAG_ZLIB). The other fields are taken from the
+# column key (see `decode_log_value()`). If LOG_VALUE_FLAG_TEMPLATE is set, the multimessage_id
+# is followed by the template id (LOG_VALUE_TEMPLATE_ID_LENGTH bytes), and the parameters
+# of the template (separated by spaces) are saved instead of the message.
+LOG_VALUE_FORMAT_JSON = 'json'
+LOG_VALUE_FORMAT_COMPACT = 'compact'
+LOG_VALUE_VERSION_COMPACT = '\x01'
+LOG_VALUE_FLAG_ZLIB = 0x01
+LOG_VALUE_FLAG_MULTIMESSAGE = 0x02
+LOG_VALUE_FLAG_TEMPLATE = 0x04
+LOG_VALUE_TEMPLATE_ID_LENGTH = 8
+LOG_VALUE_HEADER = struct.Struct('!Bd')
+LOG_VALUE_LENGTH = struct.Struct('!H')
+
+# Templates of messages: the numbers (including dates, times, versions, etc.) are the
+# parameters, and are replaced by TEMPLATE_PARAM_MARK. The rows of CF_MESSAGE_TEMPLATES
+# are the template ids (see `get_template_id()`), with the template on the column 'template'.
+TEMPLATE_PARAM_REGEX = re.compile(r'\d+(?:[.,:_/-]\d+)*')
+TEMPLATE_PARAM_MARK = u'\x00'
+TEMPLATE_PARAM_DISPLAY = u'<*>'
+
+SEVERITIES = ('ERROR', 'WARN', 'INFO', 'DEBUG', )
+
 MULTIMSG_STATUS_OPEN = 'OPEN'
 MULTIMSG_STATUS_FINISHED_OK = 'FINISHED_OK'
 MULTIMSG_STATUS_FINISHED_ERROR = 'FINISHED_ERROR'
 MULTIMSG_STATUS_FINISHED_UNKNOWN = 'FINISHED_UNKNOWN'
+MULTIMSG_STATUSES = (MULTIMSG_STATUS_OPEN, MULTIMSG_STATUS_FINISHED_OK,
+    MULTIMSG_STATUS_FINISHED_ERROR, MULTIMSG_STATUS_FINISHED_UNKNOWN, )
+
+# Format of the column 'meta:timestamp' of the multi-messages: with a fixed count of
+# decimals, so the timestamps can be compared as strings by the index expressions
+# (see migrate_multimessage_timestamps() for the multi-messages saved with previous versions)
+MULTIMSG_TIMESTAMP_FORMAT = '{0:0.6f}'
 
 
 #===============================================================================
@@ -74,7 +171,9 @@ MULTIMSG_STATUS_FINISHED_UNKNOWN = 'FINISHED_UNKNOWN'
 def get_service(*args, **kwargs):
     """
     Returns an instance of  StorageService.
+    By default, the instance uses the shared pool of the process (see `get_shared_pool()`).
     """
+    kwargs.setdefault('shared_pool', True)
     #return StorageService(*args, **kwargs)
     #return StorageServiceUniqueMessagePlusReferences(*args, **kwargs)
     return StorageServiceRowPerMinute(*args, **kwargs)
@@ -110,7 +209,7 @@ def _json_cache(key, ttl, callback, *args, **kwargs):
 
 
 def _check_severity(severity):
-    if severity not in ('ERROR', 'WARN', 'INFO', 'DEBUG'):
+    if severity not in SEVERITIES:
         raise(DaedalusException("Invalid value for severity: '{0}'".format(severity)))
 
 
@@ -135,22 +234,419 @@ def _check_message(message):
         raise(DaedalusException("Invalid message: message is empty"))
 
 
-def _get_connection(retry=None, wait_between_retry=None):
+def tokenize(text, max_tokens=None):
+    """
+    Returns the list of distinct tokens of `text`, used by the full-text search index,
+    in the order they appear. If `max_tokens` is not None, returns only the first tokens.
+    """
+    tokens = []
+    seen = set()
+    for token in SEARCH_TOKEN_REGEX.findall(text.lower()):
+        if len(token) < SEARCH_TOKEN_MIN_LENGTH or len(token) > SEARCH_TOKEN_MAX_LENGTH:
+            continue
+        if token in seen:
+            continue
+        seen.add(token)
+        tokens.append(str(token))
+        if max_tokens is not None and len(tokens) >= max_tokens:
+            break
+    return tokens
+
+
+def get_retention_days(application, severity):
+    """
+    Returns the days to keep the messages of `application` with `severity`, using
+    settings.DAEDALUS_RETENTION_POLICIES and settings.DAEDALUS_RETENTION_DEFAULT_DAYS,
+    or None if the messages must be kept forever.
+    """
+    for policy_application, policy_severity, days in settings.DAEDALUS_RETENTION_POLICIES:
+        if policy_application is not None and policy_application != application:
+            continue
+        if policy_severity is not None and policy_severity != severity:
+            continue
+        return days
+    return settings.DAEDALUS_RETENTION_DEFAULT_DAYS
+
+
+def get_retention_ttl(application, severity, timestamp):
+    """
+    Returns the TTL (in seconds) for the columns of a message of `application` with
+    `severity` and `timestamp` (see `get_retention_days()`), or None if the message
+    must be kept forever. The TTL is at least 1 second, even for expired messages.
+    """
+    days = get_retention_days(application, severity)
+    if days is None:
+        return None
+    return max(1, int(timestamp + days * SECONDS_IN_DAY - time.time()))
+
+
+def extract_template(message):
+    """
+    Returns a tuple with (template, params) of `message` (see TEMPLATE_PARAM_REGEX), or
+    None if the message is longer than settings.DAEDALUS_MESSAGE_TEMPLATE_MAX_LENGTH
+    or can't be represented as a template.
+    """
+    if isinstance(message, str):
+        message = message.decode('utf-8')
+    if len(message) > settings.DAEDALUS_MESSAGE_TEMPLATE_MAX_LENGTH:
+        return None
+    if TEMPLATE_PARAM_MARK in message:
+        return None
+    params = [str(param) for param in TEMPLATE_PARAM_REGEX.findall(message)]
+    return TEMPLATE_PARAM_REGEX.sub(TEMPLATE_PARAM_MARK, message), params
+
+
+def get_template_id(template):
+    """
+    Returns the id of `template` (string: hexadecimal). The id depends only on the
+    template, so it's the same for every process saving messages.
+    """
+    digest = hashlib.md5(template.encode('utf-8')).digest()
+    return digest[0:LOG_VALUE_TEMPLATE_ID_LENGTH].encode('hex')
+
+
+def render_template(template, params):
+    """
+    Returns the message generated by replacing the parameters marks of `template` with `params`.
+
+    Raises:
+    - DaedalusException if the count of params doesn't match the template.
+    """
+    parts = template.split(TEMPLATE_PARAM_MARK)
+    if len(parts) != len(params) + 1:
+        raise(DaedalusException("The template has {0} parameters, but {1} were received".format(
+            len(parts) - 1, len(params))))
+    result = [parts[0]]
+    for param, part in zip(params, parts[1:]):
+        result.append(param)
+        result.append(part)
+    return u''.join(result)
+
+
+class _LRUCache(object):
     """
-    Creates a connection to Cassandra.
+    Thread-safe dict with a maximum size. When full, the least recently used item is removed.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# Templates (template_id: template) known to be saved on CF_MESSAGE_TEMPLATES.
+# Templates are never modified, so it's shared by all the instances of the process.
+_template_cache = None
+_template_cache_lock = threading.Lock()
+
+
+def _get_template_cache():
+    global _template_cache
+    with _template_cache_lock:
+        if _template_cache is None:
+            _template_cache = _LRUCache(settings.DAEDALUS_MESSAGE_TEMPLATE_CACHE_SIZE)
+        return _template_cache
+
+
+def encode_log_value(column_key, timestamp, message, multimessage_id=None, template=None):
+    """
+    Returns the value of the column of CF_LOGS for a message, using the format set
+    on settings.DAEDALUS_LOG_VALUE_FORMAT. With the compact format, only the timestamp,
+    the message and the multimessage_id are stored (the other fields are in the column key),
+    and the messages longer than settings.DAEDALUS_LOG_VALUE_COMPRESSION_MIN_SIZE
+    are compressed (only if that reduces its size). If `template` is passed (tuple with
+    (template_id, params)), the parameters are stored instead of the message
+    (the JSON format ignores it).
+
+    Raises:
+    - DaedalusException if settings.DAEDALUS_LOG_VALUE_FORMAT isn't valid.
+    """
+    if settings.DAEDALUS_LOG_VALUE_FORMAT == LOG_VALUE_FORMAT_JSON:
+        event_uuid, host, application, severity = column_key
+        message_dict = {
+            'application': application,
+            'host': host,
+            'severity': severity,
+            'timestamp': timestamp,
+            '_id': ','.join((event_uuid.get_hex(), host, application, severity, )),
+            'message': message,
+        }
+        if multimessage_id:
+            message_dict['multimessage_id'] = multimessage_id
+        return json.dumps(message_dict)
+
+    if settings.DAEDALUS_LOG_VALUE_FORMAT != LOG_VALUE_FORMAT_COMPACT:
+        raise(DaedalusException("Invalid value for DAEDALUS_LOG_VALUE_FORMAT: '{0}'".format(
+            settings.DAEDALUS_LOG_VALUE_FORMAT)))
+
+    flags = 0
+    if template is not None:
+        template_id, params = template
+        message = ' '.join(params)
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    min_size = settings.DAEDALUS_LOG_VALUE_COMPRESSION_MIN_SIZE
+    if min_size is not None and len(message) >= min_size:
+        compressed = zlib.compress(message)
+        if len(compressed) < len(message):
+            message = compressed
+            flags |= LOG_VALUE_FLAG_ZLIB
+
+    parts = []
+    if multimessage_id:
+        flags |= LOG_VALUE_FLAG_MULTIMESSAGE
+        multimessage_id = str(multimessage_id)
+        parts.append(LOG_VALUE_LENGTH.pack(len(multimessage_id)))
+        parts.append(multimessage_id)
+    if template is not None:
+        flags |= LOG_VALUE_FLAG_TEMPLATE
+        parts.append(template_id.decode('hex'))
+    parts.append(message)
+
+    return LOG_VALUE_VERSION_COMPACT + LOG_VALUE_HEADER.pack(flags, float(timestamp)) + \
+        ''.join(parts)
+
+
+def decode_log_value(column_key, value, get_template=None):
+    """
+    Returns the dict of a message, from the column key and the value of the column
+    of CF_LOGS. Both the JSON and the compact format are supported. For messages
+    saved using a template, `get_template` is called with the template id, and
+    must return the template.
+
+    Raises:
+    - DaedalusException if the format of the value is unknown, or if the message
+      was saved using a template and `get_template` is None.
+    """
+    if value.startswith('{'):
+        return json.loads(value)
+
+    if not value.startswith(LOG_VALUE_VERSION_COMPACT):
+        raise(DaedalusException("Unknown format of log message: version {0!r}".format(value[0:1])))
+
+    offset = len(LOG_VALUE_VERSION_COMPACT)
+    flags, timestamp = LOG_VALUE_HEADER.unpack_from(value, offset)
+    offset += LOG_VALUE_HEADER.size
+
+    event_uuid, host, application, severity = column_key
+    message_dict = {
+        'application': application,
+        'host': host,
+        'severity': severity,
+        'timestamp': timestamp,
+        '_id': u','.join((event_uuid.get_hex(), host, application, severity, )),
+    }
+
+    if flags & LOG_VALUE_FLAG_MULTIMESSAGE:
+        length, = LOG_VALUE_LENGTH.unpack_from(value, offset)
+        offset += LOG_VALUE_LENGTH.size
+        message_dict['multimessage_id'] = value[offset:offset + length].decode('utf-8')
+        offset += length
+
+    template_id = None
+    if flags & LOG_VALUE_FLAG_TEMPLATE:
+        if get_template is None:
+            raise(DaedalusException("The message was saved using a template"))
+        template_id = value[offset:offset + LOG_VALUE_TEMPLATE_ID_LENGTH].encode('hex')
+        offset += LOG_VALUE_TEMPLATE_ID_LENGTH
+
+    message = value[offset:]
+    if flags & LOG_VALUE_FLAG_ZLIB:
+        message = zlib.decompress(message)
+    if template_id is None:
+        message_dict['message'] = message.decode('utf-8')
+    else:
+        params = message.split(' ') if message else []
+        message_dict['message'] = render_template(get_template(template_id), params)
+        message_dict['template_id'] = template_id
+
+    return message_dict
+
+
+def validate_log(application, host, severity, timestamp, message):
+    """
+    Validates the fields of a log message.
+
+    Raises:
+    - DaedalusException if any parameter isn't valid.
+
+    Returns:
+    - the timestamp, as float
+    """
+    _check_application(application)
+    _check_severity(severity)
+    _check_host(host)
+    _check_message(message)
+    try:
+        return float(timestamp)
+    except:
+        raise(DaedalusException("The timestamp '{0}' couldn't be "
+            "transformed to a float".format(timestamp)))
+
+
+class Projection(object):
+    """
+    Keys of the log messages to keep in the results of the queries.
+    If `message_max_length` is not None, the 'message' is truncated to that length.
+    """
+
+    def __init__(self, keys, message_max_length=None):
+        self.keys = frozenset(keys)
+        self.message_max_length = message_max_length
+
+    def apply(self, message_dict):
+        """
+        Returns a new dict, with only the keys of the projection.
+        """
+        projected = dict([(key, value) for key, value in message_dict.iteritems() if key in self.keys])
+        if self.message_max_length is not None and 'message' in projected:
+            projected['message'] = projected['message'][0:self.message_max_length]
+        return projected
+
+
+class LogMessage(object):
+    """
+    Log message returned by the queries, to be used as a (read only) dict.
+
+    The '_id', 'host', 'application' and 'severity' are taken from the column key: the
+    value is decoded (see `decode_log_value()`, `get_template` is passed to it) only when
+    other key is accessed. If `projection` is passed, only the keys of the projection are
+    available, and the value is discarded after decoding it.
+    """
+
+    KEYS_FROM_COLUMN_KEY = ('_id', 'host', 'application', 'severity', )
+
+    def __init__(self, column_key, value, projection=None, get_template=None):
+        event_uuid, host, application, severity = column_key
+        self._from_column_key = {
+            '_id': ','.join((event_uuid.get_hex(), host, application, severity, )),
+            'host': host,
+            'application': application,
+            'severity': severity,
+        }
+        self._column_key = column_key
+        self._value = value
+        self._projection = projection
+        self._get_template = get_template
+        self._values = None
+
+    def _get_values(self):
+        if self._values is None:
+            values = decode_log_value(self._column_key, self._value, self._get_template)
+            if self._projection is not None:
+                values = self._projection.apply(values)
+            self._values = values
+            self._value = None
+        return self._values
+
+    def __getitem__(self, key):
+        if self._projection is not None and not key in self._projection.keys:
+            raise KeyError(key)
+        if key in self._from_column_key:
+            return self._from_column_key[key]
+        return self._get_values()[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._get_values())
+
+    def __repr__(self):
+        return repr(self._get_values())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._get_values().keys()
+
+    def items(self):
+        return self._get_values().items()
+
+    def to_dict(self):
+        """
+        Returns a new dict with the (decoded) message
+        """
+        return dict(self._get_values())
+
+
+def _get_pool_profile(profile=None):
+    """
+    Returns the name and the parameters of the pool profile `profile`
+    (default: settings.CASSANDRA_POOL_PROFILE). See settings.CASSANDRA_POOL_PROFILES.
+
+    Raises:
+    - DaedalusException if the profile doesn't exists.
+    """
+    if profile is None:
+        profile = settings.CASSANDRA_POOL_PROFILE
+    try:
+        return profile, settings.CASSANDRA_POOL_PROFILES[profile]
+    except KeyError:
+        raise(DaedalusException("Invalid pool profile: '{0}'".format(profile)))
+
+
+def _get_connection(retry=None, wait_between_retry=None, keyspace=None, profile=None):
+    """
+    Creates a connection to Cassandra, using the parameters of the pool profile `profile`
+    (see `_get_pool_profile()`). While all the servers are unavailable, retries with
+    exponential backoff and jitter.
 
     Returs:
         pool
     """
     num = 0
+    _, params = _get_pool_profile(profile)
+    if keyspace is None:
+        keyspace = settings.KEYSPACE
     if retry is None:
-        retry = settings.CASSANDRA_CONNECT_RETRY_COUNT
+        retry = params['connect_retry_count']
     if wait_between_retry is None:
-        wait_between_retry = settings.CASSANDRA_CONNECT_RETRY_WAIT
+        wait_between_retry = params['connect_retry_wait']
     while True:
         try:
-            pool = ConnectionPool(settings.KEYSPACE, server_list=settings.CASSANDRA_HOSTS,
-                timeout=settings.CASSANDRA_CONNECTION_POOL_TIMEOUT)
+            pool = ConnectionPool(keyspace, server_list=settings.CASSANDRA_HOSTS,
+                timeout=params['timeout'], max_retries=params['max_retries'],
+                pool_timeout=params['pool_timeout'])
             return pool
         except AllServersUnavailable:
             num += 1
@@ -158,7 +654,115 @@ def _get_connection(retry=None, wait_between_retry=None):
                 logger.exception("Giving up after many retries....")
                 raise
             logger.warn("AllServersUnavailable detected. Retrying (%d of %d)...", num, retry)
-            time.sleep(wait_between_retry)
+            # "Full jitter": avoids all the processes retrying at the same time
+            time.sleep(random.uniform(0, wait_between_retry))
+            wait_between_retry = min(wait_between_retry * 2, params['connect_retry_max_wait'])
+
+
+class _SharedPoolRegistry(object):
+    """
+    Keeps one ConnectionPool per keyspace and pool profile, shared by all the StorageService
+    instances of the process (see `get_shared_pool()`).
+
+    The pools are created the first time they're needed, and re-created after a fork().
+    Every `DAEDALUS_SHARED_POOL_CHECK_INTERVAL` seconds the pool is checked, and
+    if the check fails, the pool is disposed and a new one is created.
+    The checks and the connections are done holding only the lock of the pool (and not
+    the lock of the registry), so a node that doesn't respond doesn't block the threads
+    that use the other pools.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pools = {}
+        self._last_check = {}
+        self._pool_locks = {}
+
+    def _is_check_due(self, key):
+        """
+        Returns True if the pool of `key` must be checked. Must be called holding `_lock`.
+        """
+        now = time.time()
+        if now - self._last_check.get(key, 0) < settings.DAEDALUS_SHARED_POOL_CHECK_INTERVAL:
+            return False
+        self._last_check[key] = now
+        return True
+
+    def _is_healthy(self, pool):
+        try:
+            conn = pool.get()
+            try:
+                conn.describe_version()
+            finally:
+                conn.return_to_pool()
+            return True
+        except:
+            logger.exception("Health check of shared pool failed. The pool will be re-created.")
+            return False
+
+    def get_pool(self, keyspace, profile=None):
+        profile, _ = _get_pool_profile(profile)
+        key = (keyspace, profile)
+        with self._lock:
+            if self._pid != os.getpid():
+                # The sockets of the pools created before a fork() are shared
+                # with the parent process: forget them (without disposing them).
+                self._pid = os.getpid()
+                self._pools = {}
+                self._last_check = {}
+                self._pool_locks = {}
+
+            pool = self._pools.get(key, None)
+            if pool is not None and not self._is_check_due(key):
+                return pool
+            pool_lock = self._pool_locks.setdefault(key, threading.Lock())
+
+        with pool_lock:
+            if pool is not None and not self._is_healthy(pool):
+                with self._lock:
+                    if self._pools.get(key, None) is pool:
+                        del self._pools[key]
+                try:
+                    pool.dispose()
+                except:
+                    logger.exception("Error detected when disposing unhealthy pool")
+                pool = None
+
+            if pool is None:
+                # Other thread could have created the pool while waiting for `pool_lock`
+                with self._lock:
+                    pool = self._pools.get(key, None)
+            if pool is None:
+                pool = _get_connection(keyspace=keyspace, profile=profile)
+                with self._lock:
+                    self._pools[key] = pool
+                    self._last_check[key] = time.time()
+
+            return pool
+
+    def dispose(self):
+        """
+        Disposes all the pools of this process.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                for pool in self._pools.values():
+                    pool.dispose()
+            self._pools = {}
+            self._last_check = {}
+
+
+_shared_pool_registry = _SharedPoolRegistry()
+
+
+def get_shared_pool(profile=None):
+    """
+    Returns the ConnectionPool of the current process for `settings.KEYSPACE`
+    and the pool profile `profile` (see `_get_pool_profile()`).
+    The returned pool must not be disposed.
+    """
+    return _shared_pool_registry.get_pool(settings.KEYSPACE, profile)
 
 
 class StorageService(object):
@@ -177,8 +781,10 @@ class StorageService(object):
     """
     # FIXME: ensure close() is called on every instance created elsewhere
 
-    def __init__(self, cache_enabled=True):
+    def __init__(self, cache_enabled=True, shared_pool=False, pool_profile=None):
         self._cache_enabled = cache_enabled
+        self._shared_pool = shared_pool
+        self._pool_profile = pool_profile
         self._pool = None
         self._cf_logs = None
         self._cf_logs_by_app = None
@@ -187,7 +793,10 @@ class StorageService(object):
 
     def _get_pool(self):
         if self._pool is None:
-            self._pool = _get_connection()
+            if self._shared_pool:
+                self._pool = get_shared_pool(self._pool_profile)
+            else:
+                self._pool = _get_connection(profile=self._pool_profile)
         return self._pool
 
     def _get_cf_logs(self):
@@ -212,7 +821,9 @@ class StorageService(object):
 
     def close(self):
         if self._pool is not None:
-            self._pool.dispose()
+            # The shared pool is not disposed: it's owned by the registry
+            if not self._shared_pool:
+                self._pool.dispose()
             self._pool = None
 
     def create_keyspace(self):
@@ -474,7 +1085,7 @@ class StorageService(object):
         status = {}
         _logger = logging.getLogger(__name__ + '.get_status')
         try:
-            pool = _get_connection()
+            pool = _get_connection(profile=self._pool_profile)
             pool.dispose()
             status['get_connection'] = "ok"
         except:
@@ -550,7 +1161,10 @@ class StorageService(object):
 
         return status
 
-    def _generate_chart_data(self, granularity, count):
+    def _generate_chart_data(self, granularity, count, breakdown=None, severity=None):
+
+        if breakdown is not None or severity is not None:
+            raise(DaedalusException("Breakdown of charts is not supported by this storage"))
 
         counts = []
         time_series_limits = time_series_generator(granularity, count)
@@ -585,33 +1199,33 @@ class StorageService(object):
 
         return counts
 
-    def generate_6hs_charts_data(self):
+    def generate_6hs_charts_data(self, breakdown=None, severity=None):
         """
         Returns the data from the last 6 hours.
         """
         FIVE_MIN = 60 * 5
-        return self._generate_chart_data(FIVE_MIN, 12 * 6)
+        return self._generate_chart_data(FIVE_MIN, 12 * 6, breakdown, severity)
 
-    def generate_24hs_charts_data(self):
+    def generate_24hs_charts_data(self, breakdown=None, severity=None):
         """
         Returns the data from the last 24 hours.
         """
         TWENTY_MIN = 60 * 20
-        return self._generate_chart_data(TWENTY_MIN, 3 * 24)
+        return self._generate_chart_data(TWENTY_MIN, 3 * 24, breakdown, severity)
 
-    def generate_48hs_charts_data(self):
+    def generate_48hs_charts_data(self, breakdown=None, severity=None):
         """
         Returns the data from the last 48 hours.
         """
         THIRTY_MIN = 60 * 30
-        return self._generate_chart_data(THIRTY_MIN, 2 * 48)
+        return self._generate_chart_data(THIRTY_MIN, 2 * 48, breakdown, severity)
 
-    def generate_7d_charts_data(self):
+    def generate_7d_charts_data(self, breakdown=None, severity=None):
         """
         Returns the data from the last 7 days.
         """
         TWO_HOURS = 60 * 60 * 2 # 6 per day
-        return self._generate_chart_data(TWO_HOURS, 6 * 7)
+        return self._generate_chart_data(TWO_HOURS, 6 * 7, breakdown, severity)
 
     #    def column_key_to_str(self, col_key):
     #        """
@@ -809,11 +1423,34 @@ class StorageServiceRowPerMinute(StorageService):
     """
     # FIXME: ensure close() is called on every instance created elsewhere
 
+    # Secondary indexes. For each dimension: (column family, position on column key).
+    # The rows of the index CFs are '<value>:<yyyymmdd>', and the columns are the
+    # column keys of CF_LOGS (with empty values). The days with messages of each
+    # value are saved on the CF_METADATA row 'index_days:<dimension>:<value>'.
+    INDEXES = {
+        'host': (CF_INDEX_BY_HOST, 1),
+        'application': (CF_INDEX_BY_APPLICATION, 2),
+        'severity': (CF_INDEX_BY_SEVERITY, 3),
+    }
+
     def __init__(self, *args, **kwargs):
         StorageService.__init__(self, *args, **kwargs)
         self._app_cache = {}
         self._host_cache = {}
         self._timestamp_bitmap_cache = {}
+        self._timestamp_bitmap_days_cache = {}
+        self._index_days_cache = {}
+        self._rollup_days_cache = {}
+        self._cf_indexes = {}
+        # Increments of CF_COUNTERS and CF_ROLLUPS to send after the current batch:
+        # {(cf_name, row_key, column): count}
+        self._pending_counters = {}
+        self._cf_counters = None
+        self._cf_rollups = None
+        self._cf_search_index = None
+        self._cf_message_templates = None
+        # Templates queued on the current batch: {template_id: template}
+        self._pending_templates = {}
         # METADATA cf has 2 rows:
         # - applications
         # - hosts
@@ -836,6 +1473,31 @@ class StorageServiceRowPerMinute(StorageService):
             self._cf_multi_messsagelogs = ColumnFamily(self._get_pool(), CF_MULTI_MESSAGELOGS)
         return self._cf_multi_messsagelogs
 
+    def _get_cf_counters(self):
+        if self._cf_counters is None:
+            self._cf_counters = ColumnFamily(self._get_pool(), CF_COUNTERS)
+        return self._cf_counters
+
+    def _get_cf_rollups(self):
+        if self._cf_rollups is None:
+            self._cf_rollups = ColumnFamily(self._get_pool(), CF_ROLLUPS)
+        return self._cf_rollups
+
+    def _get_cf_search_index(self):
+        if self._cf_search_index is None:
+            self._cf_search_index = ColumnFamily(self._get_pool(), CF_SEARCH_INDEX)
+        return self._cf_search_index
+
+    def _get_cf_message_templates(self):
+        if self._cf_message_templates is None:
+            self._cf_message_templates = ColumnFamily(self._get_pool(), CF_MESSAGE_TEMPLATES)
+        return self._cf_message_templates
+
+    def _get_cf_index(self, dimension):
+        if not dimension in self._cf_indexes:
+            self._cf_indexes[dimension] = ColumnFamily(self._get_pool(), self.INDEXES[dimension][0])
+        return self._cf_indexes[dimension]
+
     def create_cfs(self):
         """
         Creates the Cassandra Column Families (if not exist)
@@ -868,6 +1530,22 @@ class StorageServiceRowPerMinute(StorageService):
                 cf = ColumnFamily(pool, CF_LOGS)
                 # cf.get_count(str(uuid.uuid4()))
 
+            for cf_name in [a_cf_name for a_cf_name, _ in self.INDEXES.values()] + [CF_SEARCH_INDEX]:
+                try:
+                    cf = ColumnFamily(pool, cf_name)
+                except:
+                    logger.info("create_cfs(): Creating column family %s", cf_name)
+                    # Same column keys than CF_LOGS
+                    comparator = CompositeType(
+                        TimeUUIDType(),
+                        UTF8Type(),
+                        UTF8Type(),
+                        UTF8Type()
+                    )
+                    sys_mgr.create_column_family(settings.KEYSPACE,
+                        cf_name, comparator_type=comparator)
+                    cf = ColumnFamily(pool, cf_name)
+
             try:
                 cf = ColumnFamily(pool, CF_METADATA)
             except:
@@ -900,6 +1578,32 @@ class StorageServiceRowPerMinute(StorageService):
                 sys_mgr.create_index(settings.KEYSPACE, CF_MULTI_MESSAGELOGS,
                     'meta:status', UTF8_TYPE, index_name='multimsg_finish_status_index')
 
+            try:
+                cf = ColumnFamily(pool, CF_COUNTERS)
+            except:
+                logger.info("create_cfs(): Creating column family %s", CF_COUNTERS)
+                sys_mgr.create_column_family(settings.KEYSPACE,
+                    CF_COUNTERS, comparator_type=UTF8Type(),
+                    default_validation_class=COUNTER_COLUMN_TYPE)
+                cf = ColumnFamily(pool, CF_COUNTERS)
+
+            try:
+                cf = ColumnFamily(pool, CF_MESSAGE_TEMPLATES)
+            except:
+                logger.info("create_cfs(): Creating column family %s", CF_MESSAGE_TEMPLATES)
+                sys_mgr.create_column_family(settings.KEYSPACE,
+                    CF_MESSAGE_TEMPLATES, comparator_type=UTF8Type())
+                cf = ColumnFamily(pool, CF_MESSAGE_TEMPLATES)
+
+            try:
+                cf = ColumnFamily(pool, CF_ROLLUPS)
+            except:
+                logger.info("create_cfs(): Creating column family %s", CF_ROLLUPS)
+                sys_mgr.create_column_family(settings.KEYSPACE,
+                    CF_ROLLUPS, comparator_type=IntegerType(),
+                    default_validation_class=COUNTER_COLUMN_TYPE)
+                cf = ColumnFamily(pool, CF_ROLLUPS)
+
         finally:
             if pool:
                 pool.dispose()
@@ -911,27 +1615,689 @@ class StorageServiceRowPerMinute(StorageService):
         key_for_bitmap = int(row_key)
         return key_for_bitmap
 
-    def save_log(self, application, host, severity, timestamp, message,
-        multi_message=False, multimessage_id=None):
+    def _get_bitmap_day_row_key(self, day):
+        return TIMESTAMP_BITMAP_DAY_ROW_PREFIX + str(day)
+
+    def _prepare_bitmap(self, batch, key_for_bitmap):
         """
-        Saves a log message.
+        Queues on `batch` the inserts on CF_TIMESTAMP_BITMAP needed to register the minute
+        `key_for_bitmap` (int: yyyymmddhhmm), if not yet done by this instance.
+        """
+        if key_for_bitmap in self._timestamp_bitmap_cache:
+            return
+        self._timestamp_bitmap_cache[key_for_bitmap] = True
+        day = key_for_bitmap // 10000
+        batch.insert(self._get_cf_timestamp_bitmap(), self._get_bitmap_day_row_key(day),
+            {key_for_bitmap: ''})
+        if not day in self._timestamp_bitmap_days_cache:
+            self._timestamp_bitmap_days_cache[day] = True
+            batch.insert(self._get_cf_timestamp_bitmap(), TIMESTAMP_BITMAP_DAYS_ROW, {day: ''})
+
+    def _get_index_row_key(self, value, day):
+        return '{0}:{1}'.format(value, day)
+
+    def _get_index_days_row_key(self, dimension, value):
+        return 'index_days:{0}:{1}'.format(dimension, value)
+
+    def _prepare_indexes(self, batch, row_key, column_key, ttl=None):
+        """
+        Queues on `batch` the inserts on the index CFs (see INDEXES) for the message
+        saved on CF_LOGS with `row_key` and `column_key`, using `ttl` (see `get_retention_ttl()`).
+        """
+        day = row_key[:8]
+        for dimension, (_, position) in self.INDEXES.iteritems():
+            value = column_key[position]
+            batch.insert(self._get_cf_index(dimension), self._get_index_row_key(value, day),
+                {column_key: ''}, ttl=ttl)
+            if not (dimension, value, day) in self._index_days_cache:
+                self._index_days_cache[(dimension, value, day)] = True
+                batch.insert(self._get_cf_metadata(), self._get_index_days_row_key(dimension, value),
+                    {day: ''})
+
+    def _query_index(self, dimension, value, from_col=None, projection=None, start_ts=None,
+        end_ts=None, filter_callback=None, limit=100):
+        """
+        Returns list of LogMessage, with the messages where `dimension` is `value`, from
+        newest to oldest. Only the index rows with matching messages are read.
+        See `query_range()` for the other parameters.
+        """
+        days_kwargs = {'column_reversed': True}
+        index_kwargs = {'column_reversed': True}
+        if from_col is not None:
+            days_kwargs['column_start'] = ymd_from_uuid1(from_col[0])
+            index_kwargs['column_start'] = from_col
+        elif end_ts is not None:
+            days_kwargs['column_start'] = str(ymdhm_int_from_timestamp(end_ts))[0:8]
+            index_kwargs['column_start'] = (end_ts, )
+        if start_ts is not None:
+            days_kwargs['column_finish'] = str(ymdhm_int_from_timestamp(start_ts))[0:8]
+            index_kwargs['column_finish'] = (start_ts, )
+
+        column_keys = []
+        days_generator = self._get_cf_metadata().xget(
+            self._get_index_days_row_key(dimension, value), **days_kwargs)
+        for day, _ in days_generator:
+            index_generator = self._get_cf_index(dimension).xget(
+                self._get_index_row_key(value, day), **index_kwargs)
+            for column_key, _ in index_generator:
+                if from_col is not None and from_col == column_key:
+                    continue
+                if filter_callback is not None and filter_callback(column_key) is False:
+                    continue
+                column_keys.append(column_key)
+                if len(column_keys) == limit:
+                    break
+            if len(column_keys) == limit:
+                break
+
+        return self._get_logs_by_column_keys(column_keys, projection)
+
+    def _get_logs_by_column_keys(self, column_keys, projection=None):
+        """
+        Returns list of LogMessage, with the messages of CF_LOGS referenced by `column_keys`,
+        in the same order. Non-existing messages are ignored.
+        """
+        if not column_keys:
+            return []
+        row_keys = dict([(column_key, ymdhm_from_uuid1(column_key[0])) for column_key in column_keys])
+        rows = self._get_cf_logs().multiget(list(set(row_keys.values())), columns=column_keys)
+        result = []
+        for column_key in column_keys:
+            columns = rows.get(row_keys[column_key], {})
+            if column_key in columns:
+                result.append(LogMessage(column_key, columns[column_key], projection,
+                    self._get_template))
+        return result
+
+    def rebuild_indexes(self):
+        """
+        Writes the index CFs (see INDEXES) and the full-text search index for all
+        the messages saved on CF_LOGS. Needed for the messages saved with previous versions.
+
+        Returns:
+        - count of messages indexed
+        """
+        count = 0
+        with self._get_mutator() as batch:
+            for key_for_bitmap in self._iter_bitmap_keys():
+                row_key = str(key_for_bitmap)
+                for column_key, column_value in self._get_cf_logs().xget(row_key):
+                    message = self._decode_log_value(column_key, column_value)
+                    ttl = get_retention_ttl(column_key[2], column_key[3], message['timestamp'])
+                    self._prepare_indexes(batch, row_key, column_key, ttl)
+                    self._prepare_search_index(batch, row_key, column_key, message['message'], ttl)
+                    count += 1
+        return count
+
+    def _prepare_search_index(self, batch, row_key, column_key, message, ttl=None):
+        """
+        Queues on `batch` the inserts on CF_SEARCH_INDEX for the tokens of `message`
+        (up to settings.DAEDALUS_SEARCH_MAX_TOKENS_PER_MESSAGE), using `ttl`.
+        """
+        if not settings.DAEDALUS_SEARCH_INDEX_ENABLED:
+            return
+        day = row_key[:8]
+        for token in tokenize(message, settings.DAEDALUS_SEARCH_MAX_TOKENS_PER_MESSAGE):
+            batch.insert(self._get_cf_search_index(), self._get_index_row_key(token, day),
+                {column_key: ''}, ttl=ttl)
+            if not ('search', token, day) in self._index_days_cache:
+                self._index_days_cache[('search', token, day)] = True
+                batch.insert(self._get_cf_metadata(), self._get_index_days_row_key('search', token),
+                    {day: ''})
+                batch.insert(self._get_cf_metadata(), SEARCH_TOKENS_DAY_ROW_PREFIX + day, {token: ''})
+
+    def search(self, text, from_col=None, limit=100, projection=None):
+        """
+        Returns list of LogMessage, with the messages that contains all the tokens
+        of `text` (see `tokenize()`), from newest to oldest.
+
+        The posting list (on CF_SEARCH_INDEX) of the token found on less days is read in
+        chunks, and each chunk is intersected with the posting lists of the other tokens,
+        reading only the columns of the chunk.
+
+        Parameters:
+        - from_col: column key of the last message of the previous page.
+        - limit: max count of messages to return.
+        - projection: instance of Projection, to keep only some keys of the messages.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+
+        days_kwargs = {'column_reversed': True}
+        if from_col is not None:
+            days_kwargs['column_start'] = ymd_from_uuid1(from_col[0])
+        days_by_token = {}
+        for token in tokens:
+            days_by_token[token] = set([day for day, _ in self._get_cf_metadata().xget(
+                self._get_index_days_row_key('search', token), **days_kwargs)])
+        days = reduce(lambda days_1, days_2: days_1 & days_2, days_by_token.values())
+
+        # The token on less days (or the longest) is expected to have the shortest posting lists
+        driving_token = min(tokens, key=lambda token: (len(days_by_token[token]), -len(token)))
+        other_tokens = [token for token in tokens if token != driving_token]
+
+        cf = self._get_cf_search_index()
+        chunk_size = max(1, int(settings.DAEDALUS_SEARCH_CHUNK_SIZE))
+        column_keys = []
+        for day in sorted(days, reverse=True):
+            if from_col is None:
+                postings = cf.xget(self._get_index_row_key(driving_token, day), column_reversed=True,
+                    buffer_size=chunk_size)
+            else:
+                postings = cf.xget(self._get_index_row_key(driving_token, day), column_reversed=True,
+                    column_start=from_col, buffer_size=chunk_size)
+            postings = iter(postings)
+            while len(column_keys) < limit:
+                chunk = [column_key for column_key, _ in itertools.islice(postings, chunk_size)]
+                if not chunk:
+                    break
+                # `column_start` is inclusive: the chunk could have only `from_col`
+                candidates = [column_key for column_key in chunk if column_key != from_col]
+                for token in other_tokens:
+                    if not candidates:
+                        break
+                    try:
+                        found = cf.get(self._get_index_row_key(token, day), columns=candidates)
+                    except NotFoundException:
+                        found = {}
+                    candidates = [column_key for column_key in candidates if column_key in found]
+                column_keys.extend(candidates)
+            if len(column_keys) >= limit:
+                break
+
+        return self._get_logs_by_column_keys(column_keys[0:limit], projection)
+
+    def _prepare_counters(self, row_key, column_key):
+        """
+        Adds to the pending increments of CF_COUNTERS the message saved on CF_LOGS with
+        `row_key` and `column_key`. The increments are sent by `_get_mutator()`,
+        grouped by counter, after sending the batch (see `_send_pending_counters()`).
+        """
+        _, host, application, severity = column_key
+        columns = ('all', 'severity:' + severity, 'application:' + application, 'host:' + host, )
+        for counters_row_key in (COUNTERS_TOTAL_ROW, COUNTERS_DAY_ROW_PREFIX + row_key[:8]):
+            for column in columns:
+                key = (CF_COUNTERS, counters_row_key, column)
+                self._pending_counters[key] = self._pending_counters.get(key, 0) + 1
+
+    def _prepare_template(self, batch, row_key, message):
+        """
+        If settings.DAEDALUS_MESSAGE_TEMPLATES_ENABLED, extracts the template of `message`,
+        queues on `batch` the insert of the template on CF_MESSAGE_TEMPLATES (if isn't
+        known to be already saved), and adds the message to the counts of the template.
+        Templates are only used with the compact format, and never expire.
+
+        Returns:
+        - tuple with (template_id, params), or None if the message must be saved without template
+        """
+        if not settings.DAEDALUS_MESSAGE_TEMPLATES_ENABLED:
+            return None
+        if settings.DAEDALUS_LOG_VALUE_FORMAT != LOG_VALUE_FORMAT_COMPACT:
+            return None
+        extracted = extract_template(message)
+        if extracted is None:
+            return None
+        template, params = extracted
+        template_id = get_template_id(template)
+
+        if not template_id in self._pending_templates and \
+                not template_id in _get_template_cache():
+            self._pending_templates[template_id] = template
+            batch.insert(self._get_cf_message_templates(), template_id,
+                {'template': template.encode('utf-8')})
+
+        column = COUNTERS_TEMPLATE_PREFIX + template_id
+        for counters_row_key in (COUNTERS_TOTAL_ROW, COUNTERS_DAY_ROW_PREFIX + row_key[:8]):
+            key = (CF_COUNTERS, counters_row_key, column)
+            self._pending_counters[key] = self._pending_counters.get(key, 0) + 1
+
+        return (template_id, params)
+
+    def _get_template(self, template_id):
+        """
+        Returns the template with id `template_id`, from the cache of templates
+        or from CF_MESSAGE_TEMPLATES.
 
         Raises:
-        - DaedalusException if any parameter isn't valid.
+        - DaedalusException if the template doesn't exists.
+        """
+        template_cache = _get_template_cache()
+        template = template_cache.get(template_id)
+        if template is None:
+            try:
+                template = self._get_cf_message_templates().get(template_id,
+                    columns=['template'])['template'].decode('utf-8')
+            except NotFoundException:
+                raise(DaedalusException("The template '{0}' doesn't exists".format(template_id)))
+            template_cache.set(template_id, template)
+        return template
+
+    def _decode_log_value(self, column_key, value):
+        return decode_log_value(column_key, value, self._get_template)
+
+    def list_templates(self, day=None, limit=100):
+        """
+        Returns the templates of the messages, with the count of messages of each one
+        (read from CF_COUNTERS), ordered by count.
+
+        Parameters:
+        - day: to count only the messages of a day (string: yyyymmdd).
+          If None, counts the messages of all the days.
+        - limit: max count of templates to return
 
         Returns:
-        - tuple with (row_key, column_key, multimessage_id)
+        - list of dicts, with the keys 'template_id', 'template' (with TEMPLATE_PARAM_DISPLAY
+          in place of each parameter) and 'count'
         """
-        _check_application(application)
-        _check_severity(severity)
-        _check_host(host)
-        _check_message(message)
+        if day is None:
+            counters_row_key = COUNTERS_TOTAL_ROW
+        else:
+            counters_row_key = COUNTERS_DAY_ROW_PREFIX + str(day)
         try:
-            timestamp = float(timestamp)
+            columns = self._get_cf_counters().get(counters_row_key,
+                column_start=COUNTERS_TEMPLATE_PREFIX, column_finish=COUNTERS_TEMPLATE_PREFIX + '~',
+                column_count=999999)
+        except NotFoundException:
+            return []
+
+        counts = sorted(((count, column[len(COUNTERS_TEMPLATE_PREFIX):])
+            for column, count in columns.iteritems()), reverse=True)[0:limit]
+        result = []
+        for count, template_id in counts:
+            try:
+                template = self._get_template(template_id)
+            except DaedalusException:
+                continue
+            result.append({
+                'template_id': template_id,
+                'template': template.replace(TEMPLATE_PARAM_MARK, TEMPLATE_PARAM_DISPLAY),
+                'count': count,
+            })
+        return result
+
+    def _get_rollup_row_key(self, granularity, series, bucket):
+        if granularity == SECONDS_IN_DAY:
+            period = time.strftime('%Y', time.gmtime(bucket))
+        else:
+            period = time.strftime('%Y%m%d', time.gmtime(bucket))
+        return 'rollup:{0}:{1}:{2}'.format(granularity, series, period)
+
+    def _prepare_rollups(self, batch, timestamp, column_key):
+        """
+        Adds to the pending increments of CF_ROLLUPS the message with `timestamp`,
+        for each of the ROLLUP_GRANULARITIES and series. Queues on `batch` the insert
+        of the day on the ROLLUP_DAYS_ROW of CF_METADATA (used by `prune_expired()`),
+        if not yet done by this instance.
+        """
+        _, host, application, severity = column_key
+        series_list = (ROLLUP_SERIES_ALL, 'severity:' + severity, 'application:' + application,
+            'host:' + host, 'application:{0}:severity:{1}'.format(application, severity),
+            'host:{0}:severity:{1}'.format(host, severity), )
+        seconds = int(timestamp)
+        for granularity in ROLLUP_GRANULARITIES:
+            bucket = seconds - seconds % granularity
+            for series in series_list:
+                key = (CF_ROLLUPS, self._get_rollup_row_key(granularity, series, bucket), bucket)
+                self._pending_counters[key] = self._pending_counters.get(key, 0) + 1
+        day = int(time.strftime('%Y%m%d', time.gmtime(seconds)))
+        if not day in self._rollup_days_cache:
+            self._rollup_days_cache[day] = True
+            batch.insert(self._get_cf_metadata(), ROLLUP_DAYS_ROW, {str(day): ''})
+
+    def _send_pending_counters(self):
+        """
+        Sends the pending increments of CF_COUNTERS and CF_ROLLUPS, using a Mutator
+        without retries: the increments aren't idempotent, so a retried `batch_mutate`
+        (ex: after a timeout) could apply them twice. Must be called after the batch with the
+        messages was sent. If the increments can't be sent, they're dropped (and logged).
+        """
+        if not self._pending_counters:
+            return
+        rows = {}
+        for (cf_name, counters_row_key, column), count in self._pending_counters.iteritems():
+            if not (cf_name, counters_row_key) in rows:
+                rows[(cf_name, counters_row_key)] = {}
+            rows[(cf_name, counters_row_key)][column] = count
+        self._pending_counters.clear()
+        column_families = {
+            CF_COUNTERS: self._get_cf_counters,
+            CF_ROLLUPS: self._get_cf_rollups,
+        }
+        try:
+            batch = Mutator(self._get_pool(), queue_size=settings.DAEDALUS_MUTATOR_QUEUE_SIZE,
+                allow_retries=False)
+            for cf_name, counters_row_key in sorted(rows.keys()):
+                batch.insert(column_families[cf_name](), counters_row_key, rows[(cf_name, counters_row_key)])
+            batch.send()
+        except Exception:
+            logger.exception("Couldn't send the increments of %d counters. The increments were dropped",
+                sum([len(columns) for columns in rows.itervalues()]))
+
+    def get_rollup_counts(self, granularity, from_timestamp, to_timestamp, series=ROLLUP_SERIES_ALL):
+        """
+        Returns a dict {bucket: count} with the count of messages of the buckets of
+        `granularity` seconds (one of ROLLUP_GRANULARITIES) between `from_timestamp`
+        and `to_timestamp`. The buckets are identified by its start (int: seconds from
+        epoch), and the buckets without messages are not included.
+
+        All the rows are read with a single multiget.
+        """
+        return self.get_rollup_counts_by_series(granularity, from_timestamp, to_timestamp,
+            [series])[series]
+
+    def get_rollup_counts_by_series(self, granularity, from_timestamp, to_timestamp, series_list):
+        """
+        Same as `get_rollup_counts()`, for many series. Returns a dict
+        {series: {bucket: count}}. All the rows are read with a single multiget.
+        """
+        assert granularity in ROLLUP_GRANULARITIES
+        counts = dict([(series, {}) for series in series_list])
+        if to_timestamp <= from_timestamp or not series_list:
+            return counts
+        first_bucket = int(from_timestamp) - int(from_timestamp) % granularity
+        last_bucket = int(to_timestamp) - 1
+        last_bucket = last_bucket - last_bucket % granularity
+
+        # {row_key: series}
+        row_keys = {}
+        for series in series_list:
+            a_time = first_bucket
+            while a_time <= last_bucket + SECONDS_IN_DAY:
+                row_keys[self._get_rollup_row_key(granularity, series, min(a_time, last_bucket))] = series
+                a_time += SECONDS_IN_DAY
+
+        rows = self._get_cf_rollups().multiget(row_keys.keys(), column_start=first_bucket,
+            column_finish=last_bucket, column_count=(last_bucket - first_bucket) // granularity + 1)
+        for row_key, columns in rows.iteritems():
+            counts[row_keys[row_key]].update(columns)
+        return counts
+
+    def get_count(self, dimension=None, value=None, day=None):
+        """
+        Returns the count of messages, read from CF_COUNTERS.
+
+        Parameters:
+        - dimension, value: to count only the messages where `dimension` ('severity',
+          'application' or 'host') is `value`. If None, counts all the messages.
+        - day: to count only the messages of a day (string: yyyymmdd).
+          If None, counts the messages of all the days.
+        """
+        if dimension is None:
+            column = 'all'
+        else:
+            assert dimension in self.INDEXES
+            column = '{0}:{1}'.format(dimension, value)
+        if day is None:
+            counters_row_key = COUNTERS_TOTAL_ROW
+        else:
+            counters_row_key = COUNTERS_DAY_ROW_PREFIX + str(day)
+        try:
+            return self._get_cf_counters().get(counters_row_key, columns=[column])[column]
+        except NotFoundException:
+            return 0
+
+    def _iter_bitmap_keys(self, from_bitmap_key=None, to_bitmap_key=None):
+        """
+        Generator of the minutes (int: yyyymmddhhmm) with messages, from newest to oldest.
+        Reads the index of days, and then the row of each day, so no single row is
+        read (or written) for all the minutes.
+
+        If `from_bitmap_key` is passed, starts from that minute (inclusive).
+        If `to_bitmap_key` is passed, stops on that minute (inclusive).
+        """
+        cf = self._get_cf_timestamp_bitmap()
+        days_kwargs = {'column_reversed': True}
+        minutes_kwargs = {'column_reversed': True}
+        if from_bitmap_key is not None:
+            days_kwargs['column_start'] = from_bitmap_key // 10000
+            minutes_kwargs['column_start'] = from_bitmap_key
+        if to_bitmap_key is not None:
+            days_kwargs['column_finish'] = to_bitmap_key // 10000
+            minutes_kwargs['column_finish'] = to_bitmap_key
+
+        for day, _ in cf.xget(TIMESTAMP_BITMAP_DAYS_ROW, **days_kwargs):
+            for key_for_bitmap, _ in cf.xget(self._get_bitmap_day_row_key(day), **minutes_kwargs):
+                yield key_for_bitmap
+
+    def migrate_timestamp_bitmap(self):
+        """
+        Copies the minutes of the legacy (single row) timestamp bitmap to the rows
+        per day, and removes the legacy row.
+
+        Returns:
+        - count of minutes migrated
+        """
+        count = 0
+        with self._get_mutator() as batch:
+            for key_for_bitmap, _ in self._get_cf_timestamp_bitmap().xget(TIMESTAMP_BITMAP_LEGACY_ROW):
+                self._prepare_bitmap(batch, key_for_bitmap)
+                count += 1
+            if count:
+                batch.remove(self._get_cf_timestamp_bitmap(), TIMESTAMP_BITMAP_LEGACY_ROW)
+        return count
+
+    def prune_expired(self, full=False):
+        """
+        Removes the references to the minutes whose messages expired (see
+        settings.DAEDALUS_RETENTION_POLICIES): the minutes and days of CF_TIMESTAMP_BITMAP
+        and of the index days rows (including the search index), the rows of CF_ROLLUPS
+        (except the daily rollups) and the multi-messages whose start message expired.
+        The messages and the index CFs are written with TTL, so Cassandra removes them.
+        CF_COUNTERS isn't pruned: counters can't have TTL.
+
+        Only the minutes and multi-messages that could have expired since the previous run
+        (see PRUNE_CHECKPOINT_ROW) are checked: for each retention, the ones between the
+        previous cutoff and the current one. Pass `full=True` to check all the minutes and
+        multi-messages older than the shortest retention (ex: after changing the policies).
+
+        Returns:
+        - dict with the count of minutes, days, rollup rows and multimessages removed
+        """
+        counts = {'minutes': 0, 'days': 0, 'rollup_rows': 0, 'multimessages': 0}
+        retention_days = [days for _, _, days in settings.DAEDALUS_RETENTION_POLICIES]
+        retention_days.append(settings.DAEDALUS_RETENTION_DEFAULT_DAYS)
+        finite_retention_days = [days for days in retention_days if days is not None]
+        if not finite_retention_days:
+            return counts
+
+        now = time.time()
+        # Older minutes could have expired messages
+        cutoff_bitmap_key = ymdhm_int_from_timestamp(now - min(finite_retention_days) * SECONDS_IN_DAY)
+        cutoff_day = cutoff_bitmap_key // 10000
+
+        last_run = None
+        if not full:
+            try:
+                last_run = float(self._get_cf_metadata().get(PRUNE_CHECKPOINT_ROW,
+                    columns=[PRUNE_CHECKPOINT_LAST_RUN])[PRUNE_CHECKPOINT_LAST_RUN])
+            except NotFoundException:
+                pass
+
+        # Ranges (from_timestamp, to_timestamp) of the messages that could have expired
+        # since the previous run (from_timestamp is None if all the older ones must be checked)
+        if last_run is None:
+            expired_ranges = [(None, now - min(finite_retention_days) * SECONDS_IN_DAY)]
+        else:
+            expired_ranges = [(last_run - days * SECONDS_IN_DAY, now - days * SECONDS_IN_DAY)
+                for days in sorted(set(finite_retention_days))]
+
+        try:
+            index_values = {
+                'severity': SEVERITIES,
+                'application': self.list_applications(),
+                'host': self.list_hosts(),
+            }
+        except NotFoundException:
+            index_values = {}
+
+        # The days are read from the index of days (and not from the minutes found), so
+        # the days whose row of minutes is empty (or doesn't exist) are removed too.
+        cf_bitmap = self._get_cf_timestamp_bitmap()
+        minute_ranges_by_day = {}
+        for from_timestamp, to_timestamp in expired_ranges:
+            to_bitmap_key = ymdhm_int_from_timestamp(to_timestamp)
+            from_bitmap_key = None
+            days_kwargs = {'column_finish': to_bitmap_key // 10000}
+            if from_timestamp is not None:
+                from_bitmap_key = ymdhm_int_from_timestamp(from_timestamp)
+                days_kwargs['column_start'] = from_bitmap_key // 10000
+            for day, _ in cf_bitmap.xget(TIMESTAMP_BITMAP_DAYS_ROW, **days_kwargs):
+                minute_ranges_by_day.setdefault(day, []).append((from_bitmap_key, to_bitmap_key))
+
+        with self._get_mutator() as batch:
+            for day in sorted(minute_ranges_by_day.keys(), reverse=True):
+                day_row_key = self._get_bitmap_day_row_key(day)
+                checked_minutes = set()
+                removed_minutes = set()
+                for from_bitmap_key, to_bitmap_key in minute_ranges_by_day[day]:
+                    minutes_kwargs = {'column_finish': to_bitmap_key}
+                    if from_bitmap_key is not None:
+                        minutes_kwargs['column_start'] = from_bitmap_key
+                    for key_for_bitmap, _ in cf_bitmap.xget(day_row_key, **minutes_kwargs):
+                        if key_for_bitmap in checked_minutes:
+                            continue
+                        checked_minutes.add(key_for_bitmap)
+                        try:
+                            self._get_cf_logs().get(str(key_for_bitmap), column_count=1)
+                        except NotFoundException:
+                            batch.remove(cf_bitmap, day_row_key, columns=[key_for_bitmap])
+                            removed_minutes.add(key_for_bitmap)
+                            counts['minutes'] += 1
+
+                # The cutoff day could have newer minutes, so it's never removed
+                if day == cutoff_day:
+                    continue
+                remaining_minutes = [key_for_bitmap for key_for_bitmap, _ in cf_bitmap.xget(day_row_key,
+                    column_count=len(removed_minutes) + 1) if not key_for_bitmap in removed_minutes]
+                if not remaining_minutes:
+                    batch.remove(cf_bitmap, day_row_key)
+                    batch.remove(cf_bitmap, TIMESTAMP_BITMAP_DAYS_ROW, columns=[day])
+                    for dimension, values in index_values.iteritems():
+                        for value in values:
+                            batch.remove(self._get_cf_metadata(),
+                                self._get_index_days_row_key(dimension, value), columns=[str(day)])
+                    search_tokens_row_key = SEARCH_TOKENS_DAY_ROW_PREFIX + str(day)
+                    for token, _ in self._get_cf_metadata().xget(search_tokens_row_key):
+                        batch.remove(self._get_cf_metadata(),
+                            self._get_index_days_row_key('search', token), columns=[str(day)])
+                    batch.remove(self._get_cf_metadata(), search_tokens_row_key)
+                    counts['days'] += 1
+
+            # The rollups are removed only when all the messages of the day expired
+            if not None in retention_days:
+                cutoff_rollup_day = int(time.strftime('%Y%m%d',
+                    time.gmtime(now - max(retention_days) * SECONDS_IN_DAY)))
+                series_list = [ROLLUP_SERIES_ALL]
+                for severity in SEVERITIES:
+                    series_list.append('severity:' + severity)
+                    for dimension in ('application', 'host'):
+                        for value in index_values.get(dimension, []):
+                            series_list.append('{0}:{1}:severity:{2}'.format(dimension, value, severity))
+                for dimension in ('application', 'host'):
+                    for value in index_values.get(dimension, []):
+                        series_list.append('{0}:{1}'.format(dimension, value))
+                rollup_days = self._get_cf_metadata().xget(ROLLUP_DAYS_ROW,
+                    column_finish=str(cutoff_rollup_day - 1))
+                for day, _ in rollup_days:
+                    bucket = calendar.timegm(time.strptime(day, '%Y%m%d'))
+                    for granularity in ROLLUP_GRANULARITIES:
+                        if granularity == SECONDS_IN_DAY:
+                            continue
+                        for series in series_list:
+                            batch.remove(self._get_cf_rollups(),
+                                self._get_rollup_row_key(granularity, series, bucket))
+                            counts['rollup_rows'] += 1
+                    batch.remove(self._get_cf_metadata(), ROLLUP_DAYS_ROW, columns=[day])
+
+        # The multi-messages are found using the secondary index of 'meta:status'
+        cf_multimessages = self._get_cf_multi_messsagelogs()
+        with self._get_mutator() as batch:
+            checked_multimessages = set()
+            for from_timestamp, to_timestamp in expired_ranges:
+                for status in MULTIMSG_STATUSES:
+                    expressions = [
+                        create_index_expression('meta:status', status),
+                        create_index_expression('meta:timestamp',
+                            MULTIMSG_TIMESTAMP_FORMAT.format(to_timestamp), LTE),
+                    ]
+                    if from_timestamp is not None:
+                        expressions.append(create_index_expression('meta:timestamp',
+                            MULTIMSG_TIMESTAMP_FORMAT.format(from_timestamp), GTE))
+                    index_clause = create_index_clause(expressions, count=2 ** 31 - 1)
+                    for multimessage_id, columns in cf_multimessages.get_indexed_slices(index_clause,
+                            columns=['meta:start_message']):
+                        if multimessage_id in checked_multimessages:
+                            continue
+                        checked_multimessages.add(multimessage_id)
+                        row_key, str_column_key = columns['meta:start_message'].split(',', 1)
+                        try:
+                            self._get_cf_logs().get(row_key,
+                                columns=[self.str_to_column_key(str_column_key)])
+                        except NotFoundException:
+                            batch.remove(cf_multimessages, multimessage_id)
+                            counts['multimessages'] += 1
+
+        self._get_cf_metadata().insert(PRUNE_CHECKPOINT_ROW, {PRUNE_CHECKPOINT_LAST_RUN: repr(now)})
+
+        # The minutes and days removed must be written again if new messages arrive
+        self._reset_write_caches()
+        return counts
+
+    def _reset_write_caches(self):
+        """
+        Forgets the applications, hosts, minutes and days already saved on CF_METADATA
+        and CF_TIMESTAMP_BITMAP by this instance, and the templates queued on the batch.
+        Used when a batch fails, since those inserts could be lost.
+        """
+        self._app_cache.clear()
+        self._host_cache.clear()
+        self._timestamp_bitmap_cache.clear()
+        self._timestamp_bitmap_days_cache.clear()
+        self._index_days_cache.clear()
+        self._rollup_days_cache.clear()
+        self._pending_counters.clear()
+        self._pending_templates.clear()
+
+    @contextlib.contextmanager
+    def _get_mutator(self, queue_size=None):
+        """
+        Generates context manager for a Mutator. The mutations are sent when the
+        queue reaches `queue_size`, and when the block finish.
+
+        Use:
+            with self._get_mutator() as batch:
+                batch.insert(...)
+        """
+        if queue_size is None:
+            queue_size = settings.DAEDALUS_MUTATOR_QUEUE_SIZE
+        batch = Mutator(self._get_pool(), queue_size=queue_size)
+        try:
+            yield batch
+            batch.send()
+            self._send_pending_counters()
+            template_cache = _get_template_cache()
+            for template_id, template in self._pending_templates.iteritems():
+                template_cache.set(template_id, template)
+            self._pending_templates.clear()
         except:
-            raise(DaedalusException("The timestamp '{0}' couldn't be "
-                "transformed to a float".format(timestamp)))
+            self._reset_write_caches()
+            raise
+
+    def _prepare_log(self, batch, application, host, severity, timestamp, message,
+        multi_message=False, multimessage_id=None):
+        """
+        Generates the column to insert on CF_LOGS for a log message, and queues on `batch`
+        the inserts on the index CFs (including the full-text search index), and the inserts
+        on CF_METADATA and CF_TIMESTAMP_BITMAP not yet done by this instance. The increments
+        of CF_COUNTERS and CF_ROLLUPS are sent after the batch (see `_send_pending_counters()`).
+        The index CFs are written with the TTL of the retention policy (see `get_retention_ttl()`),
+        and the caller must insert the column on CF_LOGS with the same TTL.
+        The parameters must be already validated (see `validate_log()`).
 
+        Returns:
+        - tuple with (row_key, column_key, column_value, multimessage_id, ttl)
+        """
         assert multi_message in (True, False,)
 
         event_uuid = convert_time_to_uuid(timestamp, randomize=True)
@@ -940,141 +2306,482 @@ class StorageServiceRowPerMinute(StorageService):
 
         if not application in self._app_cache:
             self._app_cache[application] = True
-            self._get_cf_metadata().insert('applications', {application: ''})
+            batch.insert(self._get_cf_metadata(), 'applications', {application: ''})
 
         if not host in self._host_cache:
             self._host_cache[host] = True
-            self._get_cf_metadata().insert('hosts', {host: ''})
+            batch.insert(self._get_cf_metadata(), 'hosts', {host: ''})
 
         row_key = ymdhm_from_uuid1(event_uuid)
-        key_for_bitmap = int(row_key)
-        if not key_for_bitmap in self._timestamp_bitmap_cache:
-            self._timestamp_bitmap_cache[key_for_bitmap] = True
-            self._get_cf_timestamp_bitmap().insert('timestamp_bitmap', {key_for_bitmap: ''})
-
-        message_dict = {
-            'application': application,
-            'host': host,
-            'severity': severity,
-            'timestamp': timestamp,
-            '_id': _id,
-            'message': message,
-        }
+        ttl = get_retention_ttl(application, severity, timestamp)
+        self._prepare_bitmap(batch, int(row_key))
+        self._prepare_indexes(batch, row_key, column_key, ttl)
+        self._prepare_counters(row_key, column_key)
+        self._prepare_rollups(batch, timestamp, column_key)
+        self._prepare_search_index(batch, row_key, column_key, message, ttl)
 
         if multi_message: # this message is part of a multi-message
-            if multimessage_id:
-                # The multi-message key was passed as parameter
-                message_dict['multimessage_id'] = multimessage_id
-            else:
-                message_dict['multimessage_id'] = ','.join([row_key, _id])
+            if not multimessage_id:
+                # The multi-message key wasn't passed as parameter
+                multimessage_id = ','.join([row_key, _id])
+        else:
+            multimessage_id = None
 
-        self._get_cf_logs().insert(row_key, {
-            column_key: json.dumps(message_dict),
-        })
+        template = self._prepare_template(batch, row_key, message)
+        column_value = encode_log_value(column_key, timestamp, message, multimessage_id, template)
+        return (row_key, column_key, column_value, multimessage_id, ttl)
+
+    def save_log(self, application, host, severity, timestamp, message,
+        multi_message=False, multimessage_id=None):
+        """
+        Saves a log message.
+
+        Raises:
+        - DaedalusException if any parameter isn't valid.
+
+        Returns:
+        - tuple with (row_key, column_key, multimessage_id)
+        """
+        timestamp = validate_log(application, host, severity, timestamp, message)
 
-        return (row_key, column_key, message_dict.get('multimessage_id', None))
+        with self._get_mutator() as batch:
+            row_key, column_key, column_value, multimessage_id, ttl = self._prepare_log(batch,
+                application, host, severity, timestamp, message,
+                multi_message=multi_message, multimessage_id=multimessage_id)
+            batch.insert(self._get_cf_logs(), row_key, {
+                column_key: column_value,
+            }, ttl=ttl)
+
+        return (row_key, column_key, multimessage_id)
+
+    def save_logs(self, messages, queue_size=None):
+        """
+        Saves many log messages using a single Mutator. The columns are grouped
+        by row (minute) and TTL, so each row is inserted only once per retention policy.
+
+        Parameters:
+        - messages: iterable of dicts, with the keys 'application', 'host',
+          'severity', 'timestamp' and 'message'.
+        - queue_size: mutations to queue before sending them to Cassandra
+          (default: settings.DAEDALUS_MUTATOR_QUEUE_SIZE).
+
+        Raises:
+        - DaedalusException if any message isn't valid. All the messages are
+          validated before sending anything, so nothing is saved in that case.
+
+        Returns:
+        - list of tuples with (row_key, column_key, multimessage_id), in the
+          same order of `messages`
+        """
+        validated_messages = []
+        for a_message in messages:
+            timestamp = validate_log(a_message.get('application'), a_message.get('host'),
+                a_message.get('severity'), a_message.get('timestamp'), a_message.get('message'))
+            validated_messages.append((a_message['application'], a_message['host'],
+                a_message['severity'], timestamp, a_message['message'], ))
+
+        result = []
+        rows = {}
+        with self._get_mutator(queue_size) as batch:
+            for application, host, severity, timestamp, message in validated_messages:
+                row_key, column_key, column_value, multimessage_id, ttl = self._prepare_log(batch,
+                    application, host, severity, timestamp, message)
+                if not (row_key, ttl) in rows:
+                    rows[(row_key, ttl)] = {}
+                rows[(row_key, ttl)][column_key] = column_value
+                result.append((row_key, column_key, multimessage_id, ))
+
+            for row_key, ttl in sorted(rows.keys()):
+                batch.insert(self._get_cf_logs(), row_key, rows[(row_key, ttl)], ttl=ttl)
+
+        return result
+
+    def _prepare_multimessage_parts(self, batch, validated_messages, multimessage_id=None):
+        """
+        Queues on `batch` the inserts on CF_LOGS of messages that are part of a multi-message
+        (see `_prepare_log()`). The messages must be already validated (list of tuples with
+        (application, host, severity, timestamp, message)). If `multimessage_id` is None,
+        the first message starts a new multi-message.
+
+        Returns:
+        - tuple with (multimessage_id, parts, references), where `parts` is a list of tuples
+          with (row_key, column_key, reference, ttl), in the same order of `validated_messages`,
+          and `references` is a dict {ttl: columns} with the columns to insert on
+          CF_MULTI_MESSAGELOGS
+        """
+        rows = {}
+        parts = []
+        references = {}
+        for application, host, severity, timestamp, message in validated_messages:
+            row_key, column_key, column_value, multimessage_id, ttl = self._prepare_log(batch,
+                application, host, severity, timestamp, message,
+                multi_message=True, multimessage_id=multimessage_id)
+            if not (row_key, ttl) in rows:
+                rows[(row_key, ttl)] = {}
+            rows[(row_key, ttl)][column_key] = column_value
+            reference = ','.join([row_key] + [str(i) for i in column_key])
+            if not ttl in references:
+                references[ttl] = {}
+            references[ttl][reference] = EMPTY_VALUE
+            parts.append((row_key, column_key, reference, ttl, ))
+
+        for row_key, ttl in sorted(rows.keys()):
+            batch.insert(self._get_cf_logs(), row_key, rows[(row_key, ttl)], ttl=ttl)
+
+        return (multimessage_id, parts, references)
 
     def start_multimessage(self, application, host, severity, timestamp, message):
         """
-        Starts a multi-message log and returns the identifier
-        """
-        row_key, column_key, multimessage_id = self.save_log(application, host, severity, timestamp,
-            message, multi_message=True)
-        assert row_key is not None
-        assert column_key is not None
-        assert multimessage_id is not None
-
-        reference_to_msg = ','.join([row_key] + [str(i) for i in column_key])
-
-        self._get_cf_multi_messsagelogs().insert(multimessage_id, {
-            'meta:application': application,
-            'meta:host': host,
-            'meta:timestamp': timestamp,
-            'meta:start_message': reference_to_msg,
-            'meta:finish_message': '',
-            'meta:status': MULTIMSG_STATUS_OPEN,
-            'meta:last_message_received': reference_to_msg,
-            reference_to_msg: '',
-        })
+        Starts a multi-message log and returns the identifier. The message and the
+        multi-message are saved using a single Mutator.
+
+        Raises:
+        - DaedalusException if any parameter isn't valid.
+        """
+        validated_timestamp = validate_log(application, host, severity, timestamp, message)
+
+        with self._get_mutator() as batch:
+            multimessage_id, parts, references = self._prepare_multimessage_parts(batch,
+                [(application, host, severity, validated_timestamp, message, )])
+            _, _, reference_to_msg, ttl = parts[0]
+            references[ttl].update({
+                'meta:application': application,
+                'meta:host': host,
+                'meta:timestamp': MULTIMSG_TIMESTAMP_FORMAT.format(validated_timestamp),
+                'meta:start_message': reference_to_msg,
+                'meta:finish_message': '',
+                'meta:status': MULTIMSG_STATUS_OPEN,
+                'meta:last_message_received': reference_to_msg,
+            })
+            batch.insert(self._get_cf_multi_messsagelogs(), multimessage_id, references[ttl], ttl=ttl)
 
         return multimessage_id
 
+    def save_multimessage_logs(self, multimessage_id, messages, final_status=None):
+        """
+        Saves many messages of a multi-message using a single Mutator: the columns of
+        CF_LOGS and the references on CF_MULTI_MESSAGELOGS are sent in the same batch.
+
+        Parameters:
+        - multimessage_id: the identifier returned by `start_multimessage()`.
+        - messages: iterable of dicts, with the keys 'application', 'host',
+          'severity', 'timestamp' and 'message'.
+        - final_status: if not None, finishes the multi-message with this status,
+          using the last message as the finish message.
+
+        Raises:
+        - DaedalusException if any message isn't valid. All the messages are
+          validated before sending anything, so nothing is saved in that case.
+
+        Returns:
+        - list of tuples with (row_key, column_key), in the same order of `messages`
+        """
+        assert final_status in (None, MULTIMSG_STATUS_FINISHED_ERROR, MULTIMSG_STATUS_FINISHED_OK,
+            MULTIMSG_STATUS_FINISHED_UNKNOWN)
+
+        validated_messages = []
+        for a_message in messages:
+            timestamp = validate_log(a_message.get('application'), a_message.get('host'),
+                a_message.get('severity'), a_message.get('timestamp'), a_message.get('message'))
+            validated_messages.append((a_message['application'], a_message['host'],
+                a_message['severity'], timestamp, a_message['message'], ))
+        if not validated_messages:
+            return []
+
+        with self._get_mutator() as batch:
+            _, parts, references = self._prepare_multimessage_parts(batch, validated_messages,
+                multimessage_id=multimessage_id)
+            _, _, last_reference, last_ttl = parts[-1]
+            references[last_ttl]['meta:last_message_received'] = last_reference
+            if final_status is not None:
+                references[last_ttl]['meta:status'] = final_status
+                references[last_ttl]['meta:finish_message'] = last_reference
+            for ttl in sorted(references.keys()):
+                batch.insert(self._get_cf_multi_messsagelogs(), multimessage_id,
+                    references[ttl], ttl=ttl)
+
+        return [part[0:2] for part in parts]
+
     def finish_multimessage(self, application, host, severity, timestamp,
         message, multimessage_id, final_status=MULTIMSG_STATUS_FINISHED_OK):
-
+        """
+        Saves the last message of a multi-message, and sets its final status.
+        """
         assert final_status in (MULTIMSG_STATUS_FINISHED_ERROR, MULTIMSG_STATUS_FINISHED_OK,
             MULTIMSG_STATUS_FINISHED_UNKNOWN)
 
-        row_key, column_key, _ = self.save_log(application, host, severity, timestamp, message,
-            multi_message=True, multimessage_id=multimessage_id)
-        reference_to_msg = ','.join([row_key] + [str(i) for i in column_key])
-        self._get_cf_multi_messsagelogs().insert(multimessage_id, {
-            'meta:status': final_status,
-            'meta:finish_message': reference_to_msg,
-            'meta:last_message_received': reference_to_msg,
-            reference_to_msg: '',
-        })
+        self.save_multimessage_logs(multimessage_id, [{
+            'application': application,
+            'host': host,
+            'severity': severity,
+            'timestamp': timestamp,
+            'message': message,
+        }], final_status=final_status)
 
     def save_multimessage_log(self, application, host, severity, timestamp, message, multimessage_id):
-        row_key, column_key, _ = self.save_log(application, host, severity, timestamp, message,
-            multi_message=True, multimessage_id=multimessage_id)
-        reference_to_msg = ','.join([row_key] + [str(i) for i in column_key])
-        self._get_cf_multi_messsagelogs().insert(multimessage_id, {
-            reference_to_msg: '',
-            'meta:last_message_received': reference_to_msg,
-        })
+        """
+        Saves a message of a multi-message (see `save_multimessage_logs()`).
+        """
+        self.save_multimessage_logs(multimessage_id, [{
+            'application': application,
+            'host': host,
+            'severity': severity,
+            'timestamp': timestamp,
+            'message': message,
+        }])
 
-    def get_multimessage(self, multimessage_id):
+    def get_multimessage(self, multimessage_id, from_ref=None, limit=None):
+        """
+        Returns a dict with the metadata ('meta') and the messages ('messages': list of
+        LogMessage, ordered by timestamp) of a multi-message, or None if it doesn't exists.
+        The messages of all the referenced minutes are read with a single multiget.
+
+        The messages are returned in pages of up to `limit` messages (default:
+        settings.DAEDALUS_MULTIMESSAGE_PAGE_SIZE). If there are more messages, 'next_ref'
+        has the value to pass as `from_ref` to get the next page (else is None).
+        The page could end in the middle of a minute: the references of the minute of
+        `from_ref` are read again and sorted by time, to skip the already returned ones.
+        """
+        if limit is None:
+            limit = settings.DAEDALUS_MULTIMESSAGE_PAGE_SIZE
+        cf = self._get_cf_multi_messsagelogs()
         try:
-            cass_multimessage = self._get_cf_multi_messsagelogs().get(multimessage_id)
+            cass_meta = cf.get(multimessage_id, column_start='meta:', column_finish='meta:~',
+                column_count=999)
         except NotFoundException:
             return None
 
         multimessage = {
-            'meta': dict([(key.split(':')[1], value)
-                for key, value in cass_multimessage.iteritems() if key.startswith('meta:')]),
+            'meta': dict([(key.split(':', 1)[1], value) for key, value in cass_meta.iteritems()]),
             'messages': [],
+            'next_ref': None,
         }
 
-        messages_ids = [key for key, value in cass_multimessage.iteritems() if not key.startswith('meta:')]
-        query = {}
-        for a_message_id in messages_ids:
-            row_key, k1, k2, k3, k4 = a_message_id.split(',')
-            column_key = self.str_to_column_key(','.join([k1, k2, k3, k4]))
-            if not row_key in query:
-                query[row_key] = []
-            query[row_key].append(column_key)
-
-        for row_key in sorted(query.keys()):
-            columns = self._get_cf_logs().get(row_key, columns=query[row_key]) # column_reversed
-            # print columns
-            for _, col_value in columns.iteritems():
-                multimessage['messages'].append(json.loads(col_value))
+        def _sort_key(reference):
+            row_key, column_key_str = reference.split(',', 1)
+            return (row_key, self.str_to_column_key(column_key_str)[0].time, reference)
+
+        # The references ('<row_key>,<column_key>') are sorted by minute, before the 'meta:' columns
+        references = []
+        xget_kwargs = {'column_finish': 'meta:', 'buffer_size': limit + 1}
+        from_sort_key = None
+        if from_ref is not None:
+            xget_kwargs['column_start'] = from_ref.split(',', 1)[0] + ','
+            from_sort_key = _sort_key(from_ref)
+        minutes = itertools.groupby((reference for reference, _ in cf.xget(multimessage_id, **xget_kwargs)
+            if not reference.startswith('meta:')), lambda reference: reference.split(',', 1)[0])
+        for _, references_of_minute in minutes:
+            references_of_minute = sorted(references_of_minute, key=_sort_key)
+            if from_sort_key is not None:
+                references_of_minute = [reference for reference in references_of_minute
+                    if _sort_key(reference) > from_sort_key]
+            if not references_of_minute:
+                continue
+            if len(references) + len(references_of_minute) > limit:
+                references.extend(references_of_minute[:limit - len(references)])
+                multimessage['next_ref'] = references[-1] if references else None
+                break
+            references.extend(references_of_minute)
+
+        column_keys = []
+        for reference in references:
+            _, column_key_str = reference.split(',', 1)
+            column_keys.append(self.str_to_column_key(column_key_str))
+        multimessage['messages'] = self._get_logs_by_column_keys(column_keys)
 
         return multimessage
 
-    def query(self, from_col=None, filter_callback=None):
+    def migrate_multimessage_timestamps(self):
         """
-        Returns list of dicts.
+        Re-writes the column 'meta:timestamp' of the multi-messages saved with previous
+        versions using MULTIMSG_TIMESTAMP_FORMAT, so `list_multimessages()` can filter
+        them by time. The column is written with the TTL of the start message.
+
+        Returns:
+        - count of multi-messages migrated
+        """
+        count = 0
+        cf = self._get_cf_multi_messsagelogs()
+        with self._get_mutator() as batch:
+            for multimessage_id, columns in cf.get_range(
+                    columns=['meta:timestamp', 'meta:start_message']):
+                if not 'meta:timestamp' in columns or not 'meta:start_message' in columns:
+                    continue
+                try:
+                    timestamp = float(columns['meta:timestamp'])
+                except ValueError:
+                    continue
+                formatted_timestamp = MULTIMSG_TIMESTAMP_FORMAT.format(timestamp)
+                if formatted_timestamp == columns['meta:timestamp']:
+                    continue
+                _, str_column_key = columns['meta:start_message'].split(',', 1)
+                _, _, application, severity = self.str_to_column_key(str_column_key)
+                batch.insert(cf, multimessage_id, {'meta:timestamp': formatted_timestamp},
+                    ttl=get_retention_ttl(application, severity, timestamp))
+                count += 1
+        return count
+
+    def list_multimessages(self, status=None, application=None, host=None,
+        from_timestamp=None, to_timestamp=None, from_id=None, limit=100):
+        """
+        Returns a list of multi-messages, using the secondary indexes of CF_MULTI_MESSAGELOGS.
+        At least one of `status`, `application` or `host` must be passed. The list isn't
+        ordered by time: pass the 'multimessage_id' of the last item as `from_id` to get
+        the next page.
+
+        Parameters:
+        - status, application, host: to return only the multi-messages with these values
+        - from_timestamp, to_timestamp: to return only the multi-messages started on this
+          range (seconds from epoch, inclusive). The range is part of the index clause, so
+          Cassandra filters the multi-messages (see MULTIMSG_TIMESTAMP_FORMAT: the ones saved
+          with previous versions must be migrated with `migrate_multimessage_timestamps()`)
+        - from_id: the 'multimessage_id' of the last item of the previous page
+        - limit: max count of multi-messages to return
+
+        Raises:
+        - DaedalusException if no status, application nor host was passed.
+
+        Returns:
+        - list of dicts, with the 'multimessage_id' and the metadata of each multi-message
+          ('application', 'host', 'timestamp', 'status', 'start_message', 'finish_message'
+          and 'last_message_received')
         """
+        expressions = []
+        for column, value in (('meta:status', status), ('meta:application', application),
+            ('meta:host', host), ):
+            if value:
+                expressions.append(create_index_expression(column, value))
+        if not expressions:
+            raise(DaedalusException("A status, application or host is needed to list multi-messages"))
+        if from_timestamp is not None:
+            expressions.append(create_index_expression('meta:timestamp',
+                MULTIMSG_TIMESTAMP_FORMAT.format(from_timestamp), GTE))
+        if to_timestamp is not None:
+            expressions.append(create_index_expression('meta:timestamp',
+                MULTIMSG_TIMESTAMP_FORMAT.format(to_timestamp), LTE))
+
+        index_clause = create_index_clause(expressions, start_key=from_id or '', count=2 ** 31 - 1)
         result = []
+        for multimessage_id, columns in self._get_cf_multi_messsagelogs().get_indexed_slices(
+            index_clause, column_start='meta:', column_finish='meta:~', column_count=999,
+            buffer_size=limit + 1):
+            if multimessage_id == from_id:
+                continue
+            multimessage = dict([(key.split(':', 1)[1], value) for key, value in columns.iteritems()])
+            multimessage['multimessage_id'] = multimessage_id
+            result.append(multimessage)
+            if len(result) >= limit:
+                break
+        return result
+
+    def query(self, from_col=None, filter_callback=None, projection=None):
+        """
+        Returns list of LogMessage, from newest to oldest.
 
+        Parameters:
+        - from_col: column key of the last message of the previous page.
+        - filter_callback: function that receives the column key, and returns False
+          if the message should be ignored (the message is not decoded in that case).
+        - projection: instance of Projection, to keep only some keys of the messages.
+        """
         # As of https://issues.apache.org/jira/browse/CASSANDRA-295, I think Daedalus should
         # not depend on the type of partitioner configured, since it's configured cluster-wide
         # and since RandomPartitioner is the default and sugested, we should work with it.
 
         # Fist, get "minutes" with messages using bitmap
+        if from_col:
+            bitmap_keys_generator = self._iter_bitmap_keys(
+                self._get_bitmap_key_from_event_uuid(from_col[0]))
+        else:
+            bitmap_keys_generator = self._iter_bitmap_keys()
+
+        # FIXME: StorageServiceRowPerMinute if the query stops because of `max_rows`,
+        # and the results == 0, could be more results (that would be accesible if
+        # used 'max_rows=200'.. BUT the UI won't show the 'next>>>'
+        # link to continue the pagination. This should be fixed!
+        return self._query_minutes(bitmap_keys_generator, column_start=from_col,
+            skip_col=from_col, filter_callback=filter_callback, projection=projection,
+            max_rows=100)
+
+    def query_range(self, start_ts=None, end_ts=None, filters=None, limit=100,
+        from_col=None, projection=None):
+        """
+        Returns list of LogMessage, with the messages between `start_ts` and `end_ts`,
+        from newest to oldest. The query starts on the minute of `end_ts` (the newer
+        messages are not read).
+
+        Parameters:
+        - start_ts, end_ts: seconds from epoch (UTC), inclusive. None means no limit.
+        - filters: dict with the values to filter, using the keys 'host', 'application'
+          and/or 'severity'. The messages are read using the index CFs in that case.
+        - limit: max count of messages to return.
+        - from_col: column key of the last message of the previous page.
+        - projection: instance of Projection, to keep only some keys of the messages.
+
+        Raises:
+        - DaedalusException if any parameter isn't valid.
+        """
         try:
-            if from_col:
-                from_column_key = self._get_bitmap_key_from_event_uuid(from_col[0])
-                bitmap_keys_generator = self._get_cf_timestamp_bitmap().xget('timestamp_bitmap',
-                    column_start=from_column_key,
-                    column_reversed=True)
-            else:
-                bitmap_keys_generator = self._get_cf_timestamp_bitmap().xget('timestamp_bitmap',
-                    column_reversed=True)
-        except NotFoundException:
-            return result
+            if start_ts is not None:
+                start_ts = float(start_ts)
+            if end_ts is not None:
+                end_ts = float(end_ts)
+        except ValueError:
+            raise(DaedalusException("Invalid value for start_ts or end_ts"))
+        filters = dict(filters or {})
+        for dimension in filters:
+            if not dimension in self.INDEXES:
+                raise(DaedalusException("Invalid filter: '{0}'".format(dimension)))
+
+        def filter_callback(col_key):
+            for dimension, value in filters.iteritems():
+                if col_key[self.INDEXES[dimension][1]] != value:
+                    return False
+            return True
+
+        if filters:
+            dimension = [a_dimension for a_dimension in ('host', 'application', 'severity')
+                if a_dimension in filters][0]
+            return self._query_index(dimension, filters[dimension], from_col=from_col,
+                projection=projection, start_ts=start_ts, end_ts=end_ts,
+                filter_callback=filter_callback, limit=limit)
+
+        if from_col is not None:
+            column_start = from_col
+            from_bitmap_key = self._get_bitmap_key_from_event_uuid(from_col[0])
+        elif end_ts is not None:
+            column_start = (end_ts, )
+            from_bitmap_key = ymdhm_int_from_timestamp(end_ts)
+        else:
+            column_start = None
+            from_bitmap_key = None
+
+        if start_ts is not None:
+            column_finish = (start_ts, )
+            to_bitmap_key = ymdhm_int_from_timestamp(start_ts)
+        else:
+            column_finish = None
+            to_bitmap_key = None
+
+        return self._query_minutes(self._iter_bitmap_keys(from_bitmap_key, to_bitmap_key),
+            column_start=column_start, column_finish=column_finish, skip_col=from_col,
+            projection=projection, limit=limit)
+
+    def _query_minutes(self, bitmap_keys_generator, column_start=None, column_finish=None,
+        skip_col=None, filter_callback=None, projection=None, limit=100, max_rows=None):
+        """
+        Returns list of LogMessage, with up to `limit` messages read from the rows of CF_LOGS
+        generated by `bitmap_keys_generator`, from newest to oldest.
+
+        Parameters:
+        - column_start, column_finish: slice of each row to read (with `column_reversed`,
+          so `column_start` is the newer). A tuple with a timestamp can be used as
+          partial column key.
+        - skip_col: column key to ignore (the last message of the previous page).
+        - filter_callback: see `query()`.
+        - max_rows: max count of rows to read (None means no limit).
+        """
+        result = []
 
         #    - ROW key -> yyyymmddhhmm
         #        + COL key -> host:app:severity:uuidtime
@@ -1086,87 +2793,129 @@ class StorageServiceRowPerMinute(StorageService):
         #        + COL key -> host:app:severity:uuidtime
         #            + COL value -> json
 
-        # for row_key in row_keys:
+        slice_kwargs = {'column_reversed': True}
+        if column_finish is not None:
+            slice_kwargs['column_finish'] = column_finish
+
+        # The rows are read with multiget, `read_ahead` rows at a time. The columns of
+        # each row are read until the page is complete (if the row has more columns than
+        # the read by multiget, the rest are read with xget).
+        read_ahead = max(1, int(settings.DAEDALUS_QUERY_READ_AHEAD))
         bitmap_keys_iter = iter(bitmap_keys_generator)
-        iteration_count_control = iter(xrange(1, 101))
-        # FIXME: StorageServiceRowPerMinute if the following 'while' breaks because iteration_count_control,
-        # and the results == 0, could be more results (that would be accesible if
-        # used 'iteration_count_control < 200'.. BUT the UI won't show the 'next>>>'
-        # link to continue the pagination. This should be fixed!
-        while len(result) < 100 and iteration_count_control.next() <= 100:
-            try:
-                bitmap_col_key, _ = bitmap_keys_iter.next()
-            except StopIteration:
+        rows_read = 0
+        while len(result) < limit and (max_rows is None or rows_read < max_rows):
+            if max_rows is None:
+                rows_to_read = read_ahead
+            else:
+                rows_to_read = min(read_ahead, max_rows - rows_read)
+            row_keys = [str(bitmap_col_key) for bitmap_col_key in
+                itertools.islice(bitmap_keys_iter, rows_to_read)]
+            if not row_keys:
                 break
-            row_key = str(bitmap_col_key)
-            try:
-                if from_col is None:
-                    cass_result = self._get_cf_logs().xget(row_key, column_reversed=True)
-                else:
-                    cass_result = self._get_cf_logs().xget(row_key, column_reversed=True,
-                        column_start=from_col)
+            rows_read += len(row_keys)
+
+            # One more column, since `skip_col` is skipped
+            column_count = limit - len(result) + 1
+            if column_start is None:
+                rows = self._get_cf_logs().multiget(row_keys, column_count=column_count,
+                    **slice_kwargs)
+            else:
+                rows = self._get_cf_logs().multiget(row_keys, column_count=column_count,
+                    column_start=column_start, **slice_kwargs)
+
+            # `rows` has the same order of `row_keys` (missing rows are not included)
+            for row_key, columns in rows.iteritems():
+                cass_result = columns.iteritems()
+                if len(columns) == column_count:
+                    # The row could have more columns
+                    last_col_key = columns.keys()[-1]
+                    cass_result = itertools.chain(cass_result, itertools.islice(
+                        self._get_cf_logs().xget(row_key, column_start=last_col_key,
+                            **slice_kwargs), 1, None))
 
                 for col_key, col_val in cass_result:
-                    if from_col is not None and from_col == col_key:
+                    if skip_col is not None and skip_col == col_key:
                         continue
                     if filter_callback is not None and filter_callback(col_key) is False:
                         continue
-                    if len(result) < 100:
-                        result.append(json.loads(col_val))
+                    if len(result) < limit:
+                        result.append(LogMessage(col_key, col_val, projection,
+                            self._get_template))
                     else:
                         return result
-            except NotFoundException:
-                # FIXME: try to avoid this kind of exception starting the search in the right row
-                # logger.exception("---------- NotFoundException {0} ----------".format(row_key))
-                pass
 
         return result
 
-    def query_by_severity(self, severity, from_col=None):
-        def filter_callback(col_key):
-            # col_key[0] -> UUID + Timestamp
-            # col_key[1] -> Host / Origin
-            # col_key[2] -> Application
-            # col_key[3] -> Severiry
-            assert col_key is not None
-            return col_key[3] == severity
-        return self.query(from_col, filter_callback=filter_callback)
+    def query_by_severity(self, severity, from_col=None, projection=None):
+        return self._query_index('severity', severity, from_col, projection)
 
-    def query_by_application(self, application, from_col=None):
-        def filter_callback(col_key):
-            # col_key[0] -> UUID + Timestamp
-            # col_key[1] -> Host / Origin
-            # col_key[2] -> Application
-            # col_key[3] -> Severiry
-            assert col_key is not None
-            return col_key[2] == application
-        return self.query(from_col, filter_callback=filter_callback)
+    def query_by_application(self, application, from_col=None, projection=None):
+        return self._query_index('application', application, from_col, projection)
 
-    def query_by_host(self, host, from_col=None):
-        def filter_callback(col_key):
-            # col_key[0] -> UUID + Timestamp
-            # col_key[1] -> Host / Origin
-            # col_key[2] -> Application
-            # col_key[3] -> Severiry
-            assert col_key is not None
-            return col_key[1] == host
-        return self.query(from_col, filter_callback=filter_callback)
+    def query_by_host(self, host, from_col=None, projection=None):
+        return self._query_index('host', host, from_col, projection)
+
+    def _generate_chart_data(self, granularity, count, breakdown=None, severity=None):
+        """
+        Returns list of tuples (start_datetime, end_datetime, count), computed from the counts
+        of the biggest granularity of CF_ROLLUPS that fits on `granularity`.
+
+        If `breakdown` is 'severity', 'application' or 'host', each tuple has a 4th element:
+        a list of tuples (value, count), with the count of each severity, application or host.
+        If `severity` is passed, only the messages with that severity are counted (can't be
+        used with the breakdown by 'severity').
+        """
+        time_series_limits = time_series_generator(granularity, count)
+        rollup_granularity = max([a_granularity for a_granularity in ROLLUP_GRANULARITIES
+            if granularity % a_granularity == 0])
+
+        if breakdown is None:
+            values = []
+        elif breakdown == 'severity':
+            values = list(SEVERITIES)
+        elif breakdown == 'application':
+            values = sorted(self.list_applications())
+        elif breakdown == 'host':
+            values = sorted(self.list_hosts())
+        else:
+            raise(DaedalusException("Invalid value for breakdown: '{0}'".format(breakdown)))
+
+        if severity is None:
+            series_list = [ROLLUP_SERIES_ALL] + ['{0}:{1}'.format(breakdown, value) for value in values]
+        else:
+            _check_severity(severity)
+            if breakdown == 'severity':
+                raise(DaedalusException("The breakdown by severity can't be filtered by severity"))
+            series_list = ['severity:' + severity] + ['{0}:{1}:severity:{2}'.format(breakdown, value,
+                severity) for value in values]
+        rollup_counts = self.get_rollup_counts_by_series(rollup_granularity,
+            time_series_limits[0][0], time_series_limits[-1][1], series_list)
+
+        def _sum(series, lower_limit, upper_limit):
+            return sum([rollup_counts[series].get(bucket, 0) for bucket in
+                xrange(lower_limit, upper_limit, rollup_granularity)])
+
+        counts = []
+        for lower_limit, upper_limit in time_series_limits:
+            item = (utc_timestamp2datetime(lower_limit), utc_timestamp2datetime(upper_limit),
+                _sum(series_list[0], lower_limit, upper_limit), )
+            if breakdown is not None:
+                item += ([(value, _sum(series, lower_limit, upper_limit))
+                    for value, series in zip(values, series_list[1:])], )
+            counts.append(item)
+        return counts
 
     def get_error_count(self):
-        # FIXME: StorageServiceRowPerMinute: IMPLEMENT
-        return 0
-    
+        return self.get_count('severity', 'ERROR')
+
     def get_warn_count(self):
-        # FIXME: StorageServiceRowPerMinute: IMPLEMENT
-        return 0
-    
+        return self.get_count('severity', 'WARN')
+
     def get_info_count(self):
-        # FIXME: StorageServiceRowPerMinute: IMPLEMENT
-        return 0
-    
+        return self.get_count('severity', 'INFO')
+
     def get_debug_count(self):
-        # FIXME: StorageServiceRowPerMinute: IMPLEMENT
-        return 0
+        return self.get_count('severity', 'DEBUG')
 
     def list_applications(self):
         """
@@ -1186,10 +2935,10 @@ class StorageServiceRowPerMinute(StorageService):
         column_key = self.str_to_column_key(message_id)
         row_key = ymdhm_from_uuid1(column_key[0])
         try:
-            json_str = self._get_cf_logs().get(row_key, columns=[column_key])[column_key]
+            value = self._get_cf_logs().get(row_key, columns=[column_key])[column_key]
         except NotFoundException:
             return None
-        return json.loads(json_str)
+        return self._decode_log_value(column_key, value)
 
     def column_key_to_str(self, column_key):
         """
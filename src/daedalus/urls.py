@@ -32,6 +32,7 @@ urlpatterns = patterns('',
 if settings.DAEDALUS_ENABLED_SUBSYSTEMS in ('backend', 'both'):
     urlpatterns += patterns('',
         url(r'^backend/save/', backend_views.save_log),
+        url(r'^backend/save-bulk/', backend_views.save_bulk),
         url(r'^backend/$', backend_views.home),
     )
     handler403 = 'daedalus.backend.views.error_403'
@@ -43,11 +44,13 @@ if settings.DAEDALUS_ENABLED_SUBSYSTEMS in ('frontend', 'both'):
         url(r'^$', redirect_to, {'url': '/frontend/'}), # Redirect
         url(r'^frontend/$', frontend_views.home),
         url(r'^frontend/status/', frontend_views.status),
+        url(r'^frontend/search/$', frontend_views.search),
         url(r'^frontend/search/severity/(.*)/', frontend_views.search_by_severity),
         url(r'^frontend/search/host/(.*)/', frontend_views.search_by_host),
         url(r'^frontend/search/application/(.*)/', frontend_views.search_by_application),
         url(r'^frontend/message/get/(.*)/', frontend_views.get_message_detail),
         url(r'^frontend/message/view/(.*)/', frontend_views.show_message),
+        url(r'^frontend/multimessage/list/$', frontend_views.list_multimessages),
         url(r'^frontend/multimessage/view/(.*)/', frontend_views.show_multimessage),
         url(r'^frontend/charts/(.+)/', frontend_views.charts),
         url(r'^frontend/charts/', frontend_views.charts),